@@ -0,0 +1,94 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, statusCode, retryAfter, reason):
+        super().__init__(reason)
+        self.statusCode = statusCode
+        self.retryAfter = retryAfter
+        self.reason = reason
+
+
+class Ticket:
+    """A granted generation slot; releasing it twice is harmless."""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller.release()
+
+
+class AdmissionController:
+    """Bounded priority queue in front of the generation slots.
+
+    Up to `maxConcurrent` generations run at once. Further requests wait in a
+    priority queue (lower number first, FIFO within a priority) holding at most
+    `maxQueue` entries; beyond that they are rejected with 429. A request that
+    waits longer than `maxWait` seconds is shed with 503 before any LLM work
+    starts, since its caller has most likely timed out already.
+    """
+
+    def __init__(self, metrics, maxConcurrent=4, maxQueue=32, maxWait=30.0, retryAfter=5):
+        self.metrics = metrics
+        self.maxConcurrent = maxConcurrent
+        self.maxQueue = maxQueue
+        self.maxWait = maxWait
+        self.retryAfter = retryAfter
+        self.available = maxConcurrent
+        self.waiters = []
+        self.queued = 0
+        self.sequence = itertools.count()
+
+    def inFlight(self):
+        return self.maxConcurrent - self.available
+
+    async def acquire(self, priority=0, timeout=None):
+        """Waits for a slot, for at most `maxWait` or `timeout` seconds, whichever is shorter."""
+        enqueuedAt = time.monotonic()
+        if self.available > 0 and self.queued == 0:
+            self.available -= 1
+            self.metrics.observe("admission_queue_seconds", 0.0)
+            return Ticket(self)
+
+        if self.queued >= self.maxQueue:
+            self.metrics.inc("admission_rejected")
+            raise AdmissionRejected(429, self.retryAfter, "Generation queue is full")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        self.queued += 1
+        try:
+            maxWait = self.maxWait if timeout is None else min(self.maxWait, timeout)
+            await asyncio.wait_for(future, max(maxWait, 0))
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # Handed a slot as the wait ran out; pass it on rather than lose it
+                self.release()
+            self.metrics.inc("admission_shed")
+            raise AdmissionRejected(503, self.retryAfter, "Timed out waiting for a generation slot")
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before the caller went away
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            self.queued -= 1
+
+        self.metrics.observe("admission_queue_seconds", time.monotonic() - enqueuedAt)
+        return Ticket(self)
+
+    def release(self):
+        # Hand the slot straight to the next live waiter; timed-out entries are skipped
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.available += 1
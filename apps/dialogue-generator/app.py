@@ -1,34 +1,229 @@
+import asyncio
+import functools
 import json
 import logging
 import os
+import sys
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import List, Optional
 
 import uvicorn
-from dapr.clients import DaprClient
-from dapr.clients.grpc._state import StateItem
-from fastapi import FastAPI
-from langchain_community.llms import Ollama
+from dapr.actor import ActorId, ActorProxyFactory
+from dapr.clients.grpc._state import Concurrency, StateItem, StateOptions
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
+
+from admission import AdmissionController, AdmissionRejected
+from backends import BackendPool
+from compaction import ConversationCompactor
+from conversation_log import ConversationLog
+from dapr_clients import DaprClientPool
+from history_cache import RecentHistory
+from metrics import Metrics
+from outbox import OutboxRelay
+from prompt_cache import PromptContextCache
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
-app = FastAPI()
-
 # Set environment variables
 llmName = os.getenv("OLLAMA_LLM_NAME", "llama3")
 llmUrl = os.getenv("OLLAMA_LLM_URL", "http://ollama.zuru.local:11434")
-
-# Initialize the Ollama model
-llm = Ollama(model=llmName, base_url=llmUrl)
+# Comma-separated list of Ollama hosts; defaults to the single OLLAMA_LLM_URL
+llmUrls = [url.strip() for url in os.getenv("OLLAMA_LLM_URLS", llmUrl).split(",") if url.strip()]
+
+# Async Ollama clients, one per host, so streaming never blocks the event loop
+backends = BackendPool(
+    llmUrls, refreshInterval=float(os.getenv("OLLAMA_REFRESH_INTERVAL_SECONDS", "15"))
+)
+
+# How long Ollama keeps the model (and its KV cache) loaded between turns
+ollamaKeepAlive = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+
+# Ollama contexts from each agent's last turn, so repeated turns only evaluate the new tail
+promptCache = PromptContextCache(
+    maxEntries=int(os.getenv("PROMPT_CACHE_SIZE", "1024")),
+    maxContextTokens=int(os.getenv("PROMPT_CONTEXT_MAX_TOKENS", "2048")),
+)
+
+# Tea pays for generated tokens: the response is capped to what the agent can afford
+tokensPerMl = int(os.getenv("TOKENS_PER_ML", "100"))
+maxGenerationTokens = int(os.getenv("MAX_GENERATION_TOKENS", "512"))
+
+# Generations still running after this many seconds are aborted
+generationDeadlineSeconds = float(os.getenv("GENERATION_DEADLINE_SECONDS", "120"))
+disconnectPollSeconds = float(os.getenv("DISCONNECT_POLL_SECONDS", "0.5"))
+# Cancelled candidates are flagged in the state store, where every replica polls for them
+cancellationPollSeconds = float(os.getenv("CANCELLATION_POLL_SECONDS", "1"))
+
+# With agent actors, tea is reserved from the agent's actor before generating and the usage committed after
+agentActorsEnabled = os.getenv("AGENT_ACTORS_ENABLED", "false").lower() == "true"
+agentActorType = os.getenv("AGENT_ACTOR_TYPE", "AgentActor")
+# Reservations expire this long after the generation deadline, time enough to hand a candidate over
+reservationGraceSeconds = float(os.getenv("TEA_RESERVATION_GRACE_SECONDS", "15"))
+
+# Upper bound on generations streaming at the same time
+maxConcurrentGenerations = int(os.getenv("MAX_CONCURRENT_GENERATIONS", "4"))
 
 # Dapr Pub/Sub names
 pubsubName = os.getenv("DAPR_PUBSUB_NAME", "pubsub")
 agentsTopic = os.getenv("DAPR_AGENTS_TOPIC", "agents")
 conversationsTopic = os.getenv("DAPR_CONVERSATIONS_TOPIC", "conversations")
+partialsTopic = os.getenv("DAPR_PARTIALS_TOPIC", "conversation-partials")
+
+# Publish incremental "partial" events while a response is generated
+publishPartialEvents = os.getenv("PUBLISH_PARTIAL_EVENTS", "false").lower() == "true"
+partialEventChunks = int(os.getenv("PARTIAL_EVENT_CHUNKS", "8"))
 
 # State store name
 stateStore = os.getenv("DAPR_STATE_STORE", "statestore")
 
+# Generations with a caller-chosen id are completed once however often the caller retries them:
+# the first attempt claims the id for a short while and then keeps its result for the retries
+completionClaimSeconds = int(os.getenv("GENERATION_COMPLETION_CLAIM_SECONDS", "60"))
+completionTtlSeconds = int(os.getenv("GENERATION_COMPLETION_TTL_SECONDS", "3600"))
+
+# Conversation log layout
+defaultConversationId = "shared_events_chat"
+conversationSegmentSize = int(os.getenv("CONVERSATION_SEGMENT_SIZE", "50"))
+
+# Number of recent messages used to build the prompt
+historyWindowSize = int(os.getenv("HISTORY_WINDOW_SIZE", "12"))
+historyMaxAgeSeconds = float(os.getenv("HISTORY_MAX_AGE_SECONDS", "30"))
+# Rough prompt size limit, in words, for the summary plus the recent messages
+promptTokenBudget = int(os.getenv("PROMPT_TOKEN_BUDGET", "1024"))
+
+# Fold old history into a rolling summary and prune the folded segments
+compactionEnabled = os.getenv("COMPACTION_ENABLED", "false").lower() == "true"
+compactionIntervalSeconds = float(os.getenv("COMPACTION_INTERVAL_SECONDS", "300"))
+summaryMaxTokens = int(os.getenv("SUMMARY_MAX_TOKENS", "256"))
+
+conversationLogs = {}
+# Conversation summaries, keyed by conversation id, with the time they were loaded
+conversationSummaries = {}
+recentHistory = RecentHistory(window=historyWindowSize, maxAge=historyMaxAgeSeconds)
+
+# Long-lived Dapr channels shared by every request
+daprPool = DaprClientPool(size=int(os.getenv("DAPR_CLIENT_POOL_SIZE", "4")))
+
+metrics = Metrics()
+metrics.gauge("dapr_client_pool", daprPool.metrics)
+metrics.gauge("history_cache_hits", lambda: recentHistory.hits)
+metrics.gauge("history_cache_misses", lambda: recentHistory.misses)
+metrics.gauge("prompt_cache_hits", lambda: promptCache.hits)
+metrics.gauge("prompt_cache_misses", lambda: promptCache.misses)
+metrics.gauge("ollama_backends", backends.metrics)
+
+# Bounded priority queue in front of the generation slots
+admission = AdmissionController(
+    metrics,
+    maxConcurrent=maxConcurrentGenerations,
+    maxQueue=int(os.getenv("GENERATION_QUEUE_SIZE", "32")),
+    maxWait=float(os.getenv("GENERATION_QUEUE_MAX_WAIT_SECONDS", "30")),
+    retryAfter=int(os.getenv("GENERATION_RETRY_AFTER_SECONDS", "5")),
+)
+metrics.gauge("generations_in_flight", admission.inFlight)
+metrics.gauge("generation_queue_depth", lambda: admission.queued)
+# Running /generate and /generate/stream requests by generation id, so callers can cancel them
+activeGenerations = {}
+
+# Persist each message and its events atomically and publish them from an outbox
+outboxEnabled = os.getenv("OUTBOX_ENABLED", "false").lower() == "true"
+outboxSweepIntervalSeconds = float(os.getenv("OUTBOX_SWEEP_INTERVAL_SECONDS", "30"))
+# publishToDapr is defined further down, resolve it lazily
+outboxRelay = OutboxRelay(lambda *args: publishToDapr(*args), metrics)
+
+# summarizeMessages is defined further down, resolve it lazily
+compactor = ConversationCompactor(
+    lambda *args: summarizeMessages(*args),
+    metrics,
+    retain=int(os.getenv("COMPACTION_RETAIN_MESSAGES", "200")),
+    minBatch=int(os.getenv("COMPACTION_MIN_BATCH", "50")),
+)
+
+
+def getConversationLog(conversationId):
+    if conversationId not in conversationLogs:
+        conversationLogs[conversationId] = ConversationLog(
+            daprPool.client, stateStore, conversationId, segmentSize=conversationSegmentSize
+        )
+    return conversationLogs[conversationId]
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await daprPool.start()
+    # Warm the recent history so the first prompts don't hit the state store
+    await loadState(defaultConversationId)
+    backendRefresher = asyncio.create_task(backends.run())
+    sweeper = asyncio.create_task(sweepOutboxes()) if outboxEnabled else None
+    compactionLoop = asyncio.create_task(compactConversations()) if compactionEnabled else None
+    cancellationWatcher = asyncio.create_task(watchCancellations())
+    yield
+    backendRefresher.cancel()
+    for task in (sweeper, compactionLoop, cancellationWatcher):
+        if task:
+            task.cancel()
+    await daprPool.close()
+
+
+async def sweepOutboxes():
+    """Re-publishes outbox entries left behind by a crash or a failed publish."""
+    getConversationLog(defaultConversationId)
+    while True:
+        for conversationLog in list(conversationLogs.values()):
+            try:
+                await outboxRelay.sweep(conversationLog)
+            except Exception as e:
+                logging.error(f"Failed to sweep outbox of {conversationLog.key}: {e}")
+        await asyncio.sleep(outboxSweepIntervalSeconds)
+
+
+async def compactConversations():
+    """Periodically folds old messages of every known conversation into its summary."""
+    getConversationLog(defaultConversationId)
+    while True:
+        await asyncio.sleep(compactionIntervalSeconds)
+        for conversationId, conversationLog in list(conversationLogs.items()):
+            try:
+                if await compactor.compact(conversationLog):
+                    conversationSummaries.pop(conversationId, None)
+            except Exception as e:
+                logging.error(f"Failed to compact {conversationLog.key}: {e}")
+
+
+def cancellationKey(generationId):
+    return f"generation_cancelled:{generationId}"
+
+
+async def applyCancellations():
+    """Flags the candidates of this replica that were cancelled through any replica."""
+    pending = [g for g in activeGenerations.values() if g.candidate and not g.cancelled]
+    if not pending:
+        return
+    async with daprPool.client() as client:
+        response = await client.get_bulk_state(stateStore, [cancellationKey(g.generationId) for g in pending])
+    cancelledKeys = {item.key for item in response.items if item.data}
+    for generation in pending:
+        if cancellationKey(generation.generationId) in cancelledKeys:
+            generation.cancelled = True
+
+
+async def watchCancellations():
+    while True:
+        await asyncio.sleep(cancellationPollSeconds)
+        try:
+            await applyCancellations()
+        except Exception as e:
+            logging.error(f"Failed to check for cancelled generations: {e}")
+
+
+app = FastAPI(lifespan=lifespan)
+
 
 class Agent(BaseModel):
     id: str
@@ -39,6 +234,52 @@ class Agent(BaseModel):
 class DialogueRequest(BaseModel):
     agent: Agent
     message: str
+    conversation_id: str = defaultConversationId
+    # Position of the requested message since the conversation was bootstrapped, echoed in the result
+    turn: int = 0
+    # Lower values are admitted first when generations queue up
+    priority: int = 0
+    # Overrides GENERATION_DEADLINE_SECONDS for this request
+    deadline_seconds: Optional[float] = None
+    # Whether to publish the message to the conversations topic; the orchestrator's turn workflow publishes it itself
+    publish: bool = True
+    # Chosen by the caller, so it can cancel the generation through /generate/cancel
+    generation_id: Optional[str] = None
+    # Only generate: return the reply and keep its tea reserved until /generate/accept or /generate/release
+    candidate: bool = False
+
+
+class CandidateAcceptance(DialogueRequest):
+    """A candidate reply chosen by the caller, to be charged and persisted."""
+
+    reply: str
+    token_count: int
+    reservation_id: Optional[str] = None
+
+
+class CandidateRelease(BaseModel):
+    agent_id: str
+    reservation_id: Optional[str] = None
+
+
+class CandidateCancellation(BaseModel):
+    generation_ids: List[str]
+
+
+class GenerationAborted(Exception):
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+@app.exception_handler(AdmissionRejected)
+async def admissionRejectedHandler(request, exc: AdmissionRejected):
+    return JSONResponse(
+        status_code=exc.statusCode,
+        # Dapr's HTTP invoker drops response headers, so callers find Retry-After in the body too
+        content={"detail": exc.reason, "retry_after": exc.retryAfter},
+        headers={"Retry-After": str(exc.retryAfter)},
+    )
 
 
 @app.get("/dapr/subscribe")
@@ -51,111 +292,683 @@ async def dapr_config():
     # Return an empty dictionary as this app doesn't provide any specific configuration for the Dapr sidecar
     return {}
 
-def loadState():
-    client = DaprClient()
-    key = "shared_events_chat"
+@app.get("/metrics")
+async def getMetrics():
+    await daprPool.checkHealth()
+    return metrics.snapshot()
+
+async def loadState(conversationId):
+    """Returns the recent messages of a conversation and the log version they end at."""
     try:
-        # Retrieve the current state
-        resp = client.get_state(store_name=stateStore, key=key)
-        if resp and resp.data:
-            # Decode and parse the stored data
-            storedData = json.loads(resp.data.decode("utf-8"))
-            return storedData
-        else:
-            # If there's no current state, return an empty list
-            return []
+        # Serve from the in-process ring buffer when no replica appended since it was filled
+        count = await getConversationLog(conversationId).count()
+        cached = recentHistory.get(conversationId, count)
+        if cached is not None:
+            return cached
+        # Only the segments holding the last window of messages are read
+        messages, count = await getConversationLog(conversationId).read(
+            historyWindowSize
+        )
+        recentHistory.warm(conversationId, messages, count)
+        return messages, count
     except Exception as e:
         logging.error(f"Failed to load state: {e}")
-        return []
+        return [], 0
 
-@app.post("/generate")
-async def invokeDialogueGenerator(request: DialogueRequest):
-    data = request.dict()
+async def loadSummary(conversationId):
+    """Returns the rolling summary of the conversation's pruned history, if any."""
+    cached = conversationSummaries.get(conversationId)
+    if cached is not None and time.monotonic() - cached[1] < historyMaxAgeSeconds:
+        return cached[0]
+    try:
+        summary, _ = await getConversationLog(conversationId).loadSummary()
+    except Exception as e:
+        logging.error(f"Failed to load summary: {e}")
+        return ""
+    conversationSummaries[conversationId] = (summary["summary"], time.monotonic())
+    return summary["summary"]
 
-    agent = data.get("agent")
-    message = data.get("message")
+async def summarizeMessages(previousSummary, messages):
+    """Asks the LLM to fold a batch of old messages into the previous summary."""
+    messagesStr = "\n".join([msg["message"] for msg in messages])
+    prompt = f"""Summary so far: {previousSummary or "Nothing has happened yet."}
 
-    senderName = agent.get("name")
-    description = agent.get("description")
+    New Messages: {messagesStr}
 
-    storedData = loadState()
-    lastMessages = storedData[-12:]  
+    Rewrite the summary so it also covers the new messages. Keep the names, running jokes and open threads, and stay under {summaryMaxTokens} words.
 
+    Summary:"""
+    # Compaction is background work, so it queues behind every caller-facing generation
+    ticket = await admission.acquire(priority=sys.maxsize)
+    try:
+        async with backends.acquire(llmName) as backend:
+            response = await backend.client.generate(
+                model=llmName,
+                prompt=prompt,
+                keep_alive=ollamaKeepAlive,
+                options={"num_predict": summaryMaxTokens},
+            )
+    finally:
+        ticket.release()
+    return response["response"].strip()
+
+def trimToBudget(summary, lastMessages):
+    """Drops the oldest messages until the summary and the rest fit the prompt budget."""
+    budget = promptTokenBudget - len(summary.split())
+    kept = []
+    for msg in reversed(lastMessages):
+        budget -= len(msg["message"].split())
+        if budget < 0 and kept:
+            break
+        kept.append(msg)
+    return kept[::-1]
+
+def buildPrompt(description, lastMessages, summary=""):
+    lastMessages = trimToBudget(summary, lastMessages)
     lastMessagesStr = "\n".join([msg["message"] for msg in lastMessages])
+    summaryStr = f"\n\n    Summary: {summary}" if summary else ""
 
-    prompt = f"""Character Description: {description}
+    # The per-agent part comes first so consecutive prompts share a stable prefix
+    return f"""Character Description: {description}
+
+    Context: The conversation is light-hearted and humorous, unfolding over a cup of tea. It's brief but engaging, offering a glimpse into the character's quirky personality.{summaryStr}
 
     Latest Messages: {lastMessagesStr}
 
-    Context: The conversation is light-hearted and humorous, unfolding over a cup of tea. It's brief but engaging, offering a glimpse into the character's quirky personality.
+    Response:"""
+
+
+def buildContinuationPrompt(newMessages):
+    newMessagesStr = "\n".join([msg["message"] for msg in newMessages])
+
+    return f"""
+
+    Latest Messages: {newMessagesStr}
 
     Response:"""
 
-    # ... (rest of the code)
 
-    tokenCount = 0
-    responseChunks = []
-    for chunk in llm.stream(prompt):
-        responseChunks.append(chunk)
-        tokenCount += len(chunk.split())  # Count the words in each chunk
+class Generation:
+    """State of one generation, shared by the streaming and completion helpers."""
+
+    def __init__(self, request: DialogueRequest):
+        data = request.dict()
+        self.agent = data.get("agent")
+        self.message = data.get("message")
+        self.conversationId = data.get("conversation_id")
+        self.priority = data.get("priority")
+        self.turn = data.get("turn")
+        self.publish = data.get("publish", True)
+        self.candidate = data.get("candidate", False)
+        self.cancelled = False
+        self.reservationId = None
+        # Only a caller that chose the id can retry the generation under it
+        self.retryable = data.get("generation_id") is not None
+        self.generationId = data.get("generation_id") or str(uuid.uuid4())
+        self.prompt = None
+        # Ollama context to continue from, and the log version the prompt covers
+        self.context = None
+        self.historyVersion = 0
+        self.finalContext = None
+        self.responseChunks = []
+        self.tokenCount = 0
+        # Token budget derived from the agent's remaining tea
+        self.maxTokens = min(maxGenerationTokens, self.agent["tea_amount_ml"] * tokensPerMl)
+        self.deadline = time.monotonic() + (data.get("deadline_seconds") or generationDeadlineSeconds)
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+
+def recordAbort(generation, reason):
+    logging.info(f"Aborted generation {generation.generationId}: {reason}")
+    metrics.inc(f"generations_aborted_{reason}")
+    metrics.inc("aborted_tokens", generation.tokenCount)
+
+
+@functools.cache
+def actorProxyFactory():
+    # Created on first use, as it waits for the sidecar to be healthy
+    return ActorProxyFactory()
+
+
+async def callAgentActor(agentId, method, data):
+    proxy = actorProxyFactory().create(agentActorType, ActorId(agentId))
+    return json.loads(await proxy.invoke_method(method, json.dumps(data).encode()))
+
+
+async def reserveTea(generation):
+    """Holds the tea the generation may spend, capping its tokens to what was granted."""
+    reservation = await callAgentActor(
+        generation.agent["id"],
+        "ReserveTea",
+        {
+            "ml": -(-maxGenerationTokens // tokensPerMl),
+            # Bounded by the deadline, so a generator that crashed or was cut off doesn't hold the tea for long
+            "ttl_seconds": max(generation.remaining(), 0) + reservationGraceSeconds,
+        },
+    )
+    generation.reservationId = reservation["reservation_id"]
+    if reservation["profile"] is not None:
+        generation.agent["tea_amount_ml"] = reservation["profile"]["tea_amount_ml"]
+    generation.maxTokens = min(maxGenerationTokens, reservation["granted_ml"] * tokensPerMl)
+
+
+async def commitTea(generation, usedMl):
+    """Charges the generation's usage to its reservation; returns the resulting `tea_delta` event, or None."""
+    reservationId, generation.reservationId = generation.reservationId, None
+    if reservationId is None:
+        return None
+    return await callAgentActor(
+        generation.agent["id"], "CommitUsage", {"reservation_id": reservationId, "used_ml": usedMl}
+    )
+
+
+async def releaseTea(generation):
+    """Gives back the tea of a generation that didn't complete."""
+    try:
+        await commitTea(generation, 0)
+    except Exception as e:
+        # The reservation expires on its own
+        logging.error(f"Failed to release tea of generation {generation.generationId}: {e}")
+
+
+async def finishGeneration(generation, ticket):
+    ticket.release()
+    await releaseTea(generation)
+
+
+async def admit(generation):
+    """Rejects agents without tea, then queues for a slot within the request deadline."""
+    if agentActorsEnabled:
+        await reserveTea(generation)
+    if generation.maxTokens <= 0:
+        metrics.inc("generations_rejected_no_tea")
+        raise HTTPException(status_code=402, detail="Agent has no tea left")
+    try:
+        ticket = await admission.acquire(generation.priority, timeout=generation.remaining())
+    except BaseException:
+        await releaseTea(generation)
+        raise
+    if generation.cancelled:
+        # Cancelled while queued: give the slot and the tea back before reaching the LLM
+        await finishGeneration(generation, ticket)
+        raise GenerationAborted("cancelled")
+    return ticket
+
+
+async def prepareGeneration(generation):
+    """Builds the prompt, continuing from the agent's cached context when possible."""
+    description = generation.agent.get("description")
+    lastMessages, version = await loadState(generation.conversationId)
+    generation.historyVersion = version
+
+    cached = promptCache.lookup(
+        generation.agent["id"],
+        llmName,
+        generation.conversationId,
+        description,
+        version,
+        len(lastMessages),
+    )
+    if cached is not None:
+        generation.context, newCount = cached
+        newMessages = lastMessages[len(lastMessages) - newCount :]
+        generation.prompt = buildContinuationPrompt(newMessages)
+    else:
+        summary = await loadSummary(generation.conversationId)
+        generation.prompt = buildPrompt(description, lastMessages, summary)
+
+
+async def streamResponse(generation):
+    """Yields response chunks as they arrive, publishing partial events when enabled."""
+    sequence = 0
+    pendingChunks = []
+    async with backends.acquire(llmName) as backend:
+        stream = await backend.client.generate(
+            model=llmName,
+            prompt=generation.prompt,
+            context=generation.context,
+            keep_alive=ollamaKeepAlive,
+            options={"num_predict": generation.maxTokens},
+            stream=True,
+        )
+        async for part in stream:
+            if generation.remaining() <= 0:
+                # Leaving the loop closes the HTTP stream, which stops Ollama generating
+                raise GenerationAborted("deadline")
+            if part.get("done"):
+                generation.finalContext = part.get("context")
+            chunk = part["response"]
+            if not chunk:
+                continue
+            generation.responseChunks.append(chunk)
+            generation.tokenCount += len(chunk.split())  # Count the words in each chunk
+            yield chunk
+            if publishPartialEvents:
+                pendingChunks.append(chunk)
+                if len(pendingChunks) >= partialEventChunks:
+                    await publishPartial(generation, sequence, pendingChunks)
+                    sequence += 1
+                    pendingChunks = []
+    if publishPartialEvents and pendingChunks:
+        await publishPartial(generation, sequence, pendingChunks)
+
+
+async def publishPartial(generation, sequence, chunks):
+    partialData = {
+        "type": "partial",
+        "generation_id": generation.generationId,
+        "sequence": sequence,
+        "text": "".join(chunks),
+        "name": generation.agent["name"],
+        "conversation_id": generation.conversationId,
+    }
+    await publishToDapr(pubsubName, partialsTopic, json.dumps(partialData))
+
+
+def completionKey(generationId):
+    return f"generation_completion:{generationId}"
+
+
+async def loadCompletion(generation):
+    """Returns the completion record of a retryable generation, or None."""
+    async with daprPool.client() as client:
+        resp = await client.get_state(stateStore, completionKey(generation.generationId))
+    return json.loads(resp.data) if resp.data else None
+
+
+async def completedMessage(generation):
+    """Returns the message a retryable generation was completed with already, or None."""
+    completion = await loadCompletion(generation)
+    return completion.get("message_data") if completion else None
+
+
+async def claimCompletion(generation):
+    """Claims charging and persisting the generation; returns its message if an earlier attempt did so already.
+
+    Raises a 409 while another attempt holds the claim, so the caller retries later.
+    """
+    try:
+        async with daprPool.client() as client:
+            await client.save_state(
+                stateStore,
+                completionKey(generation.generationId),
+                json.dumps({"completing": True}),
+                options=StateOptions(concurrency=Concurrency.first_write),
+                state_metadata={"ttlInSeconds": str(completionClaimSeconds)},
+            )
+        return None
+    except Exception:
+        completion = await loadCompletion(generation)
+        if completion is None:
+            raise
+    if "message_data" in completion:
+        return completion["message_data"]
+    raise HTTPException(status_code=409, detail="Generation is being completed")
+
+
+async def recordCompletion(generation, messageData):
+    try:
+        async with daprPool.client() as client:
+            await client.save_state(
+                stateStore,
+                completionKey(generation.generationId),
+                json.dumps({"message_data": messageData}),
+                state_metadata={"ttlInSeconds": str(completionTtlSeconds)},
+            )
+    except Exception as e:
+        # The claim expires, after which a retry would complete the generation again
+        logging.error(f"Failed to record the completion of generation {generation.generationId}: {e}")
+
 
-    generatedResponse = "".join(responseChunks).strip()
+async def dropClaim(generation):
+    try:
+        async with daprPool.client() as client:
+            await client.delete_state(stateStore, completionKey(generation.generationId))
+    except Exception as e:
+        logging.error(f"Failed to drop the completion claim of generation {generation.generationId}: {e}")
+
+
+async def completeGeneration(generation):
+    """Charges and persists the finished response once, also when the caller retries the generation."""
+    if not generation.retryable:
+        return await commitGeneration(generation)
+    messageData = await claimCompletion(generation)
+    if messageData is not None:
+        # Completed by an earlier attempt: this one's tea goes back
+        await releaseTea(generation)
+        metrics.inc("generations_deduplicated")
+        return messageData
+    try:
+        messageData = await commitGeneration(generation)
+    except BaseException:
+        await dropClaim(generation)
+        raise
+    await recordCompletion(generation, messageData)
+    return messageData
+
+
+async def commitGeneration(generation):
+    """Charges tea, then publishes and persists the finished response."""
+    agent = generation.agent
+    conversationId = generation.conversationId
+    generatedResponse = "".join(generation.responseChunks).strip()
+
+    promptCache.store(
+        agent["id"],
+        llmName,
+        conversationId,
+        agent.get("description"),
+        generation.historyVersion,
+        generation.finalContext,
+    )
 
     # Adjust tea_amount_ml based on token count
-    teaAmountMlAdjusted = agent["tea_amount_ml"] - int(tokenCount / 100)
-    agent["tea_amount_ml"] = max(
-        teaAmountMlAdjusted, 0
-    )  # Ensure it doesn't go negative
+    usedMl = int(generation.tokenCount / tokensPerMl)
+    # Only the change is published, not the whole agent
+    agentData = await commitTea(generation, usedMl) if agentActorsEnabled else None
+    if agentData is None:
+        agentData = {
+            "type": "tea_delta",
+            "id": agent["id"],
+            "delta_ml": -usedMl,
+            "tea_amount_ml": max(agent["tea_amount_ml"] - usedMl, 0),  # Ensure it doesn't go negative
+        }
+    agent["tea_amount_ml"] = agentData["tea_amount_ml"]
 
     # Prepare data for publishing
-    agentData = agent
-    messageData = {"message": generatedResponse, "name": senderName}
+    messageData = {
+        "type": "complete",
+        "generation_id": generation.generationId,
+        "message": generatedResponse,
+        "name": agent["name"],
+        "conversation_id": conversationId,
+        "turn": generation.turn,
+    }
+    record = {"agent": agent, "message": generation.message}
+
+    if outboxEnabled:
+        await saveWithOutbox(conversationId, record, agentData, messageData if generation.publish else None)
+        return messageData
+
+    # Publish updated agent info and the generated message, and save the state, concurrently
+    logging.info(f"Publishing tea delta to {agentsTopic}")
+    tasks = [
+        publishToDapr(pubsubName, agentsTopic, json.dumps(agentData), agent["id"]),
+        saveToState(conversationId, record),
+    ]
+    if generation.publish:
+        logging.info(f"Publishing generated message to {conversationsTopic}")
+        tasks.append(publishToDapr(pubsubName, conversationsTopic, json.dumps(messageData), conversationId))
+    logging.info("Saving agent data to state store")
+    await asyncio.gather(*tasks)
+    return messageData
+
+
+async def saveWithOutbox(conversationId, record, agentData, messageData):
+    """Persists the message and its events in one transaction, then relays the events.
+
+    `messageData` is None when the message isn't to be published.
+    """
+    conversationLog = getConversationLog(conversationId)
+    events = [
+        {
+            "pubsub": pubsubName,
+            "topic": agentsTopic,
+            "data": json.dumps(agentData),
+            "partition_key": agentData["id"],
+        },
+    ]
+    if messageData is not None:
+        events.append(
+            {
+                "pubsub": pubsubName,
+                "topic": conversationsTopic,
+                "data": json.dumps(messageData),
+                "partition_key": conversationId,
+            }
+        )
+    entry = OutboxRelay.entry(events)
+    logging.info("Saving message and outbox entry to state store")
+    index = await conversationLog.append(record, outboxEntry=entry)
+    recentHistory.append(conversationId, record, index)
+    outboxRelay.schedule(conversationLog, index, entry)
+
+
+async def abortReason(generation, httpRequest):
+    """Why a running generation has to stop, or None if it may go on."""
+    if generation.cancelled:
+        return "cancelled"
+    if await httpRequest.is_disconnected():
+        return "disconnect"
+    if generation.remaining() <= 0:
+        return "deadline"
+    return None
+
+
+def supervisionTimeout(generation):
+    return min(disconnectPollSeconds, max(generation.remaining(), 0))
+
+
+async def superviseGeneration(generation, httpRequest):
+    """Consumes the response, cancelling it once the deadline passes or the caller disconnects."""
+
+    async def consume():
+        async for _ in streamResponse(generation):
+            pass
+
+    task = asyncio.create_task(consume())
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=supervisionTimeout(generation))
+        if done:
+            return task.result()
+        reason = await abortReason(generation, httpRequest)
+        if reason is None:
+            continue
+        # Cancelling closes the stream to Ollama mid-generation
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        raise GenerationAborted(reason)
+
+
+async def superviseStream(generation, httpRequest):
+    """Yields the response's chunks, aborting it like `superviseGeneration` even while no chunk arrives."""
+    chunks = asyncio.Queue()
+
+    async def produce():
+        async for chunk in streamResponse(generation):
+            chunks.put_nowait(chunk)
+
+    task = asyncio.create_task(produce())
+    nextChunk = None
+    try:
+        while True:
+            while not chunks.empty():
+                yield chunks.get_nowait()
+            if task.done():
+                # Raises what ended the stream early, if anything did
+                task.result()
+                return
+            nextChunk = asyncio.create_task(chunks.get())
+            done, _ = await asyncio.wait(
+                {task, nextChunk}, timeout=supervisionTimeout(generation), return_when=asyncio.FIRST_COMPLETED
+            )
+            if nextChunk in done:
+                yield nextChunk.result()
+                continue
+            nextChunk.cancel()
+            if task in done:
+                continue
+            reason = await abortReason(generation, httpRequest)
+            if reason is not None:
+                raise GenerationAborted(reason)
+    finally:
+        if nextChunk is not None:
+            nextChunk.cancel()
+        # Cancelling closes the stream to Ollama mid-generation
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
 
-    # Publish updated agent info
-    logging.info(f"Publishing updated agent info to {agentsTopic}")
-    publishToDapr(pubsubName, agentsTopic, json.dumps(agentData))
-    # Publish generated message
-    logging.info(f"Publishing generated message to {conversationsTopic}")
-    publishToDapr(pubsubName, conversationsTopic, json.dumps(messageData))
 
-    logging.info("Saving agent data to state store")
-    saveToState(data)
+@app.post("/generate")
+async def invokeDialogueGenerator(request: DialogueRequest, httpRequest: Request):
+    generation = Generation(request)
+    messageData = await completedMessage(generation) if generation.retryable and not generation.candidate else None
+    if messageData is not None:
+        # A retry of a generation that completed already is answered without generating again
+        metrics.inc("generations_deduplicated")
+        return {"content_type": "text/plain", "data": messageData["message"], "generation_id": generation.generationId}
+    # Registered while still queued, so a cancel stops it before it takes a slot
+    activeGenerations[generation.generationId] = generation
+    ticket = None
+    try:
+        # Queue for a slot first, so shed requests never reach the LLM
+        ticket = await admit(generation)
+        await prepareGeneration(generation)
+        await superviseGeneration(generation, httpRequest)
+        if generation.candidate:
+            return handOverCandidate(generation)
+        messageData = await completeGeneration(generation)
+    except GenerationAborted as e:
+        recordAbort(generation, e.reason)
+        raise HTTPException(status_code=504, detail=f"Generation aborted: {e.reason}")
+    finally:
+        activeGenerations.pop(generation.generationId, None)
+        if ticket is not None:
+            await finishGeneration(generation, ticket)
+
+    return {"content_type": "text/plain", "data": messageData["message"], "generation_id": generation.generationId}
+
+
+def handOverCandidate(generation):
+    """Returns a candidate's reply; its tea reservation now belongs to the caller."""
+    if generation.cancelled:
+        # Lost while finishing: the reservation is released here rather than handed to a caller that moved on
+        raise GenerationAborted("cancelled")
+    reservationId, generation.reservationId = generation.reservationId, None
+    metrics.inc("candidates_generated")
+    return {
+        "content_type": "text/plain",
+        "data": "".join(generation.responseChunks).strip(),
+        "generation_id": generation.generationId,
+        "token_count": generation.tokenCount,
+        "reservation_id": reservationId,
+    }
+
+
+@app.post("/generate/accept")
+async def acceptCandidate(request: CandidateAcceptance):
+    """Charges and persists a candidate reply, like a completed /generate."""
+    generation = Generation(request)
+    generation.responseChunks = [request.reply]
+    generation.tokenCount = request.token_count
+    generation.reservationId = request.reservation_id
+    messageData = await completeGeneration(generation)
+    metrics.inc("candidates_accepted")
+    return {"content_type": "text/plain", "data": messageData["message"], "generation_id": generation.generationId}
+
+
+@app.post("/generate/release")
+async def releaseCandidate(request: CandidateRelease):
+    """Gives back the tea held for a candidate reply that wasn't chosen."""
+    if agentActorsEnabled and request.reservation_id is not None:
+        await callAgentActor(request.agent_id, "CommitUsage", {"reservation_id": request.reservation_id, "used_ml": 0})
+    metrics.inc("candidates_released")
+    return {"released": True}
+
+
+@app.post("/generate/cancel")
+async def cancelGenerations(request: CandidateCancellation):
+    """Aborts queued or running generations; their tea is released as with any aborted generation.
+
+    Generations of this replica stop at once. The cancellation is also flagged in the state
+    store, where the other replicas pick it up within `cancellationPollSeconds`.
+    """
+    cancelled = 0
+    for generationId in request.generation_ids:
+        generation = activeGenerations.get(generationId)
+        if generation is not None:
+            generation.cancelled = True
+            cancelled += 1
+    if request.generation_ids:
+        # Expires with the longest generation it could still stop
+        ttl = str(int(generationDeadlineSeconds + reservationGraceSeconds))
+        states = [
+            StateItem(key=cancellationKey(generationId), value="1", metadata={"ttlInSeconds": ttl})
+            for generationId in request.generation_ids
+        ]
+        async with daprPool.client() as client:
+            await client.save_bulk_state(stateStore, states)
+    return {"cancelled": cancelled}
+
+
+@app.post("/generate/stream")
+async def streamDialogueGenerator(request: DialogueRequest, httpRequest: Request):
+    """Same as /generate, but sends chunks to the caller as server-sent events."""
+    generation = Generation(request)
+    # Admission happens before the response starts, so rejections can still be a 429/503
+    ticket = await admit(generation)
+    activeGenerations[generation.generationId] = generation
+    try:
+        await prepareGeneration(generation)
+    except Exception:
+        await finishStream(generation, ticket)
+        raise
+
+    async def events():
+        try:
+            sequence = 0
+            async for chunk in superviseStream(generation, httpRequest):
+                chunkData = {"generation_id": generation.generationId, "sequence": sequence, "text": chunk}
+                yield f"event: chunk\ndata: {json.dumps(chunkData)}\n\n"
+                sequence += 1
+
+            if generation.candidate:
+                # Like /generate: neither charged nor persisted until the caller accepts it
+                yield f"event: candidate\ndata: {json.dumps(handOverCandidate(generation))}\n\n"
+                return
+            messageData = await completeGeneration(generation)
+            yield f"event: complete\ndata: {json.dumps(messageData)}\n\n"
+        except GenerationAborted as e:
+            recordAbort(generation, e.reason)
+            yield f"event: aborted\ndata: {json.dumps({'reason': e.reason})}\n\n"
+        except (asyncio.CancelledError, GeneratorExit):
+            # Starlette cancels the stream when the client disconnects
+            recordAbort(generation, "disconnect")
+            raise
+
+    # Releases the slot and any unspent tea once the stream ends, also after the client disconnected
+    return StreamingResponse(
+        events(), media_type="text/event-stream", background=BackgroundTask(finishStream, generation, ticket)
+    )
 
-    return {"content_type": "text/plain", "data": generatedResponse}
 
+async def finishStream(generation, ticket):
+    activeGenerations.pop(generation.generationId, None)
+    await finishGeneration(generation, ticket)
 
-def publishToDapr(pubsub, topicName, data):
-    client = DaprClient()
-    logging.info(f"Publishing data to {topicName} in {pubsub}")
-    client.publish_event(
-        pubsub_name=pubsub,
-        topic_name=topicName,
-        data=data,
-        data_content_type="application/json",
-    )
 
-def saveToState(data):
-    client = DaprClient()
-    key = "shared_events_chat"
+async def publishToDapr(pubsub, topicName, data, partitionKey=None):
+    async with daprPool.client() as client:
+        logging.info(f"Publishing data to {topicName} in {pubsub}")
+        await client.publish_event(
+            pubsub_name=pubsub,
+            topic_name=topicName,
+            data=data,
+            data_content_type="application/json",
+            # Keeps the events of one conversation (or agent) in order on partitioned brokers
+            publish_metadata={"partitionKey": partitionKey} if partitionKey else {},
+        )
+
+async def saveToState(conversationId, data):
     try:
-        # Retrieve the current state
-        resp = client.get_state(store_name=stateStore, key=key)
-        if resp and resp.data:
-            # Decode and parse the stored data
-            storedData = json.loads(resp.data.decode("utf-8"))
-        else:
-            # If there's no current state, start a new list of messages
-            storedData = []
-
-        # Append the new message to the list of messages
-        storedData.append(data)
-
-        # Convert the updated list of messages to a byte string
-        data_bytes = json.dumps(storedData).encode("utf-8")
-        # Save the updated state
-        client.save_state(store_name=stateStore, key=key, value=data_bytes)
-        logging.info(f"Saved updated conversations to state store under key {key}")
+        # Append to the tail segment instead of rewriting the whole history
+        index = await getConversationLog(conversationId).append(data)
+        recentHistory.append(conversationId, data, index)
+        logging.info(f"Saved message {index} to state store under key {conversationId}")
     except Exception as e:
+        recentHistory.invalidate(conversationId)
         logging.error(f"Failed to save state: {e}")
 
 if __name__ == "__main__":
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+import httpx
+from ollama import AsyncClient, ResponseError
+
+
+def modelName(name):
+    """Normalizes a model name so `llama3` and `llama3:latest` compare equal."""
+    return name if ":" in name else f"{name}:latest"
+
+
+class OllamaBackend:
+    def __init__(self, url, clientFactory=AsyncClient):
+        self.url = url
+        self.client = clientFactory(host=url)
+        self.inFlight = 0
+        self.healthy = True
+        # Models currently loaded in memory, and models pulled on disk
+        self.loadedModels = set()
+        self.availableModels = set()
+        self.served = 0
+        self.failures = 0
+
+    def metrics(self):
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "in_flight": self.inFlight,
+            "served": self.served,
+            "failures": self.failures,
+            "loaded_models": sorted(self.loadedModels),
+        }
+
+
+class BackendPool:
+    """Routes generations across several Ollama hosts.
+
+    Each generation goes to the healthy backend with the fewest in-flight
+    requests, preferring backends that already have the model loaded, then
+    backends that have it pulled. Health and model availability are refreshed
+    in the background from Ollama's /api/ps and /api/tags endpoints; a failed
+    request marks its backend unhealthy until the next successful refresh.
+    """
+
+    def __init__(self, urls, clientFactory=AsyncClient, refreshInterval=15.0):
+        if not urls:
+            # Caught at startup rather than as a failure deep in the first generation
+            raise ValueError("No Ollama backends configured; set OLLAMA_LLM_URLS or OLLAMA_LLM_URL")
+        self.backends = [OllamaBackend(url, clientFactory) for url in urls]
+        self.refreshInterval = refreshInterval
+
+    def choose(self, model):
+        model = modelName(model)
+        # Fall back to unhealthy backends rather than failing outright; one may have recovered
+        candidates = [backend for backend in self.backends if backend.healthy] or self.backends
+        for hasModel in (
+            lambda backend: model in backend.loadedModels,
+            lambda backend: model in backend.availableModels,
+            lambda backend: True,
+        ):
+            matching = [backend for backend in candidates if hasModel(backend)]
+            if matching:
+                return min(matching, key=lambda backend: backend.inFlight)
+
+    @asynccontextmanager
+    async def acquire(self, model):
+        """Lends the least-loaded suitable backend for the duration of one generation."""
+        backend = self.choose(model)
+        backend.inFlight += 1
+        try:
+            yield backend
+            backend.served += 1
+            # A successful generation leaves the model loaded on that host
+            backend.loadedModels.add(modelName(model))
+        except ResponseError as e:
+            backend.failures += 1
+            if e.status_code == 404:
+                # The host is fine, it just doesn't have this model
+                backend.loadedModels.discard(modelName(model))
+                backend.availableModels.discard(modelName(model))
+            else:
+                backend.healthy = False
+            raise
+        except (ConnectionError, httpx.HTTPError):
+            backend.failures += 1
+            backend.healthy = False
+            raise
+        finally:
+            backend.inFlight -= 1
+
+    async def refreshBackend(self, backend):
+        try:
+            loaded, available = await asyncio.gather(backend.client.ps(), backend.client.list())
+            backend.loadedModels = {modelName(m.model) for m in loaded.models if m.model}
+            backend.availableModels = {modelName(m.model) for m in available.models if m.model}
+            backend.healthy = True
+        except Exception as e:
+            if backend.healthy:
+                logging.warning(f"Ollama backend {backend.url} is unhealthy: {e}")
+            backend.healthy = False
+
+    async def refresh(self):
+        await asyncio.gather(*(self.refreshBackend(backend) for backend in self.backends))
+
+    async def run(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.refreshInterval)
+
+    def metrics(self):
+        return [backend.metrics() for backend in self.backends]
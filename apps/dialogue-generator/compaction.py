@@ -0,0 +1,45 @@
+import logging
+
+
+class ConversationCompactor:
+    """Folds old messages into a per-conversation rolling summary and prunes them.
+
+    Every pass looks at the messages between the summary's `through` mark and
+    the retention window. Once at least `minBatch` of them have piled up they
+    are summarized together with the previous summary, the summary is saved
+    (etag-guarded, so only one replica wins a race) and the segments that are
+    entirely covered by it are deleted from the log.
+    """
+
+    def __init__(self, summarize, metrics, retain=200, minBatch=50):
+        self.summarize = summarize
+        self.metrics = metrics
+        self.retain = retain
+        self.minBatch = minBatch
+
+    async def compact(self, conversationLog):
+        summary, etag = await conversationLog.loadSummary()
+        _, count = await conversationLog.read(0)
+        foldUntil = count - self.retain
+        if foldUntil - summary["through"] < self.minBatch:
+            return False
+
+        messages = await conversationLog.readRange(summary["through"], foldUntil)
+        newSummary = {
+            "summary": await self.summarize(summary["summary"], messages),
+            "through": foldUntil,
+        }
+        try:
+            await conversationLog.saveSummary(newSummary, etag)
+        except Exception as e:
+            # Another replica compacted this conversation concurrently
+            logging.info(f"Skipped compaction of {conversationLog.key}: {e}")
+            return False
+
+        pruned = await conversationLog.prune(foldUntil)
+        self.metrics.inc("compaction_folded_messages", foldUntil - summary["through"])
+        self.metrics.inc("compaction_pruned_messages", pruned)
+        logging.info(
+            f"Compacted {conversationLog.key}: summary through {foldUntil}, pruned {pruned} messages"
+        )
+        return True
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The state store tests run against the in-memory Dapr stand-in from the load test
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "load-test"))
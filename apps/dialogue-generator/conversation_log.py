@@ -0,0 +1,270 @@
+import json
+import logging
+
+from dapr.clients.grpc._request import TransactionalStateOperation, TransactionOperationType
+from dapr.clients.grpc._state import Concurrency, StateOptions
+
+
+class ConversationLog:
+    """Append-only conversation log split into fixed-size segment keys.
+
+    Layout in the state store:
+        <key>:head          {"segmentSize": S, "count": N, "base": B}
+        <key>:segment:<i>   JSON list holding messages i*S .. i*S+S-1
+        <key>:outbox:<n>    events still to be published for message n
+        <key>:summary       rolling summary of messages before "through"
+
+    Messages below the head's base have been folded into the summary and
+    their segments deleted.
+
+    An append only reads the head and the tail segment and writes both back in
+    one transaction guarded by the head etag, so a concurrent writer makes the
+    transaction fail instead of silently dropping a message.
+    """
+
+    def __init__(self, clientFactory, storeName, key, segmentSize=50, maxRetries=5):
+        self.clientFactory = clientFactory
+        self.storeName = storeName
+        self.key = key
+        self.segmentSize = segmentSize
+        self.maxRetries = maxRetries
+
+    def headKey(self):
+        return f"{self.key}:head"
+
+    def segmentKey(self, index):
+        return f"{self.key}:segment:{index}"
+
+    def outboxKey(self, index):
+        return f"{self.key}:outbox:{index}"
+
+    def summaryKey(self):
+        return f"{self.key}:summary"
+
+    async def loadHead(self, client, create=False):
+        """Returns the head dict and its etag, creating it if `create` and migrating the legacy layout.
+
+        The head is created on its own with a first write, so of two writers
+        starting a conversation only one succeeds and the other reloads; every
+        later write of the head is guarded by its etag. A conversation with no
+        head yet reads as empty with no etag.
+        """
+        for attempt in range(1, self.maxRetries + 1):
+            resp = await client.get_state(store_name=self.storeName, key=self.headKey())
+            if resp and resp.data:
+                head = json.loads(resp.data.decode("utf-8"))
+                if not head.get("migrating"):
+                    return head, resp.etag
+                try:
+                    await self.migrateLegacy(client, resp.etag)
+                except Exception as e:
+                    logging.warning("Migrating %s failed on attempt %d: %s", self.key, attempt, e)
+                continue
+            legacy = await client.get_state(store_name=self.storeName, key=self.key)
+            hasLegacy = bool(legacy and legacy.data)
+            if not create and not hasLegacy:
+                return {"segmentSize": self.segmentSize, "count": 0}, None
+            # A legacy list is migrated under this head's etag, by whichever writer gets to it first
+            head = {"segmentSize": self.segmentSize, "count": 0}
+            if hasLegacy:
+                head["migrating"] = True
+            try:
+                await client.save_state(
+                    store_name=self.storeName,
+                    key=self.headKey(),
+                    value=json.dumps(head),
+                    options=StateOptions(concurrency=Concurrency.first_write),
+                )
+            except Exception as e:
+                logging.info("Head of %s was created concurrently: %s", self.key, e)
+        raise RuntimeError(f"Failed to load the head of {self.key} after {self.maxRetries} attempts")
+
+    async def migrateLegacy(self, client, headEtag):
+        """Splits a pre-existing single JSON list stored under the bare key into segments."""
+        resp = await client.get_state(store_name=self.storeName, key=self.key)
+        messages = json.loads(resp.data.decode("utf-8")) if resp and resp.data else []
+        operations = []
+        for start in range(0, len(messages), self.segmentSize):
+            operations.append(
+                TransactionalStateOperation(
+                    key=self.segmentKey(start // self.segmentSize),
+                    data=json.dumps(messages[start : start + self.segmentSize]),
+                )
+            )
+        head = {"segmentSize": self.segmentSize, "count": len(messages)}
+        operations.append(
+            TransactionalStateOperation(key=self.headKey(), data=json.dumps(head), etag=headEtag)
+        )
+        await client.execute_state_transaction(store_name=self.storeName, operations=operations)
+        logging.info(
+            "Migrated %d messages from %s into %d segments",
+            len(messages),
+            self.key,
+            (len(messages) + self.segmentSize - 1) // self.segmentSize,
+        )
+
+    async def append(self, message, outboxEntry=None):
+        """Appends one message, touching only the head and the tail segment.
+
+        When `outboxEntry` is given it is stored under the message's outbox key
+        in the same transaction, so the message and the events to publish for
+        it are persisted atomically.
+        """
+        async with self.clientFactory() as client:
+            for attempt in range(1, self.maxRetries + 1):
+                head, headEtag = await self.loadHead(client, create=True)
+                segmentSize = head["segmentSize"]
+                index = head["count"]
+                segmentIndex = index // segmentSize
+
+                if index % segmentSize == 0:
+                    segment = []
+                else:
+                    resp = await client.get_state(
+                        store_name=self.storeName, key=self.segmentKey(segmentIndex)
+                    )
+                    segment = json.loads(resp.data.decode("utf-8")) if resp.data else []
+
+                segment.append(message)
+                head["count"] = index + 1
+                operations = [
+                    TransactionalStateOperation(
+                        key=self.segmentKey(segmentIndex), data=json.dumps(segment)
+                    ),
+                    TransactionalStateOperation(
+                        key=self.headKey(), data=json.dumps(head), etag=headEtag
+                    ),
+                ]
+                if outboxEntry:
+                    operations.append(
+                        TransactionalStateOperation(
+                            key=self.outboxKey(index), data=json.dumps(outboxEntry)
+                        )
+                    )
+                try:
+                    await client.execute_state_transaction(
+                        store_name=self.storeName, operations=operations
+                    )
+                    return index
+                except Exception as e:
+                    # Most likely an etag conflict with another replica; reload and retry.
+                    logging.warning(
+                        "Append to %s failed on attempt %d: %s", self.key, attempt, e
+                    )
+            raise RuntimeError(f"Failed to append to {self.key} after {self.maxRetries} attempts")
+
+    async def count(self):
+        """Returns the number of messages in the log, reading only the head."""
+        async with self.clientFactory() as client:
+            head, _ = await self.loadHead(client)
+            return head["count"]
+
+    async def tail(self, limit):
+        """Returns the last `limit` messages, reading only the segments that hold them."""
+        messages, _ = await self.read(limit)
+        return messages
+
+    async def read(self, limit):
+        """Returns the last `limit` messages together with the total message count."""
+        async with self.clientFactory() as client:
+            head, _ = await self.loadHead(client)
+            count = head["count"]
+            if count == 0 or limit <= 0:
+                return [], count
+            first = max(count - limit, head.get("base", 0))
+            return await self.readSegments(client, head["segmentSize"], first, count), count
+
+    async def readRange(self, start, end):
+        """Returns messages start .. end-1 that have not been pruned yet."""
+        async with self.clientFactory() as client:
+            head, _ = await self.loadHead(client)
+            start = max(start, head.get("base", 0))
+            end = min(end, head["count"])
+            if start >= end:
+                return []
+            return await self.readSegments(client, head["segmentSize"], start, end)
+
+    async def readSegments(self, client, segmentSize, first, end):
+        keys = [
+            self.segmentKey(i) for i in range(first // segmentSize, (end - 1) // segmentSize + 1)
+        ]
+        items = (await client.get_bulk_state(store_name=self.storeName, keys=keys)).items
+        segments = {item.key: item.data for item in items}
+
+        messages = []
+        for key in keys:
+            if segments.get(key):
+                messages.extend(json.loads(segments[key]))
+        offset = first % segmentSize
+        return messages[offset : offset + end - first]
+
+    async def loadSummary(self):
+        """Returns the rolling summary dict and its etag."""
+        async with self.clientFactory() as client:
+            resp = await client.get_state(store_name=self.storeName, key=self.summaryKey())
+            if resp and resp.data:
+                return json.loads(resp.data.decode("utf-8")), resp.etag
+            return {"summary": "", "through": 0}, None
+
+    async def saveSummary(self, summary, etag):
+        async with self.clientFactory() as client:
+            await client.save_state(
+                store_name=self.storeName,
+                key=self.summaryKey(),
+                value=json.dumps(summary),
+                etag=etag,
+                options=StateOptions(concurrency=Concurrency.first_write),
+            )
+
+    async def prune(self, before):
+        """Deletes whole segments below message `before` and moves the head's base past them."""
+        async with self.clientFactory() as client:
+            for attempt in range(1, self.maxRetries + 1):
+                head, headEtag = await self.loadHead(client)
+                segmentSize = head["segmentSize"]
+                base = head.get("base", 0)
+                newBase = (min(before, head["count"]) // segmentSize) * segmentSize
+                if newBase <= base:
+                    return 0
+                head["base"] = newBase
+                operations = [
+                    TransactionalStateOperation(
+                        key=self.segmentKey(i), operation_type=TransactionOperationType.delete
+                    )
+                    for i in range(base // segmentSize, newBase // segmentSize)
+                ]
+                operations.append(
+                    TransactionalStateOperation(
+                        key=self.headKey(), data=json.dumps(head), etag=headEtag
+                    )
+                )
+                try:
+                    await client.execute_state_transaction(
+                        store_name=self.storeName, operations=operations
+                    )
+                    return newBase - base
+                except Exception as e:
+                    logging.warning(
+                        "Pruning %s failed on attempt %d: %s", self.key, attempt, e
+                    )
+            raise RuntimeError(f"Failed to prune {self.key} after {self.maxRetries} attempts")
+
+    async def pendingOutbox(self, window):
+        """Returns (index, entry) for unpublished outbox entries among the last `window` messages."""
+        async with self.clientFactory() as client:
+            head, _ = await self.loadHead(client)
+            count = head["count"]
+            keys = [self.outboxKey(i) for i in range(max(count - window, 0), count)]
+            if not keys:
+                return []
+            items = (await client.get_bulk_state(store_name=self.storeName, keys=keys)).items
+            pending = []
+            for item in items:
+                if item.data:
+                    index = int(item.key.rsplit(":", 1)[1])
+                    pending.append((index, json.loads(item.data)))
+            return sorted(pending, key=lambda entry: entry[0])
+
+    async def clearOutbox(self, index):
+        async with self.clientFactory() as client:
+            await client.delete_state(store_name=self.storeName, key=self.outboxKey(index))
@@ -0,0 +1,64 @@
+import time
+from collections import deque
+
+
+class HistoryEntry:
+    def __init__(self, messages, version, window):
+        self.messages = deque(messages, maxlen=window)
+        # Number of messages in the durable log that this buffer has seen
+        self.version = version
+        self.loadedAt = time.monotonic()
+
+
+class RecentHistory:
+    """Bounded per-conversation ring buffer of the most recent messages.
+
+    The buffer remembers the log position (version) it is in sync with. An
+    append is only applied when it lands exactly at that position; otherwise
+    another replica wrote in between and the entry is dropped so the next read
+    reloads it from the state store. Appends made by other replicas are
+    caught by passing the log's current count to `get`, and entries older
+    than `maxAge` seconds are treated as misses.
+    """
+
+    def __init__(self, window=12, maxAge=30.0):
+        self.window = window
+        self.maxAge = maxAge
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, conversationId, version=None):
+        """Returns the buffered messages and their log version, or None when the caller must reload.
+
+        `version` is the message count in the durable log; a buffer at another
+        version missed appends and is dropped.
+        """
+        entry = self.entries.get(conversationId)
+        if entry is not None and version is not None and entry.version != version:
+            del self.entries[conversationId]
+            entry = None
+        if entry is None or time.monotonic() - entry.loadedAt > self.maxAge:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return list(entry.messages), entry.version
+
+    def warm(self, conversationId, messages, version):
+        self.entries[conversationId] = HistoryEntry(messages, version, self.window)
+
+    def append(self, conversationId, message, index):
+        """Records a message written at log position `index`."""
+        entry = self.entries.get(conversationId)
+        if entry is None:
+            return
+        if entry.version != index:
+            # Someone else appended in between; our view is no longer contiguous
+            del self.entries[conversationId]
+            return
+        entry.messages.append(message)
+        entry.version = index + 1
+        entry.loadedAt = time.monotonic()
+
+    def invalidate(self, conversationId):
+        self.entries.pop(conversationId, None)
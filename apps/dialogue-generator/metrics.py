@@ -0,0 +1,36 @@
+import time
+from collections import defaultdict
+
+
+class Metrics:
+    """Minimal in-process counters, gauges and timings exposed on /metrics."""
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.timings = {}
+        self.startedAt = time.time()
+
+    def inc(self, name, value=1):
+        self.counters[name] += value
+
+    def gauge(self, name, source):
+        """Registers a callable evaluated whenever a snapshot is taken."""
+        self.gauges[name] = source
+
+    def observe(self, name, seconds):
+        timing = self.timings.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0})
+        timing["count"] += 1
+        timing["sum"] += seconds
+        timing["max"] = max(timing["max"], seconds)
+
+    def snapshot(self):
+        return {
+            "uptime_seconds": time.time() - self.startedAt,
+            "counters": dict(self.counters),
+            "gauges": {name: source() for name, source in self.gauges.items()},
+            "timings": {
+                name: dict(timing, avg=timing["sum"] / timing["count"])
+                for name, timing in self.timings.items()
+            },
+        }
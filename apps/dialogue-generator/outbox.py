@@ -0,0 +1,61 @@
+import asyncio
+import logging
+import time
+
+
+class OutboxRelay:
+    """Publishes events that were committed to a conversation log's outbox.
+
+    The generator writes a message and its outbox entry in one state
+    transaction. The relay then publishes the entry's events off the request
+    path and deletes the entry. If the pod dies before that, `sweep` finds the
+    leftover entries and publishes them again (at-least-once delivery).
+    """
+
+    def __init__(self, publish, metrics, recoveryWindow=100, minAge=10.0):
+        self.publish = publish
+        self.metrics = metrics
+        self.recoveryWindow = recoveryWindow
+        # Entries younger than this are most likely still being relayed by their writer
+        self.minAge = minAge
+        self.inFlight = set()
+        self.tasks = set()
+
+    @staticmethod
+    def entry(events):
+        return {"created_at": time.time(), "events": events}
+
+    def schedule(self, conversationLog, index, entry):
+        """Relays in the background; keeps a reference so the task isn't collected."""
+        task = asyncio.create_task(self.relay(conversationLog, index, entry))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def relay(self, conversationLog, index, entry):
+        token = (conversationLog.key, index)
+        if token in self.inFlight:
+            return
+        self.inFlight.add(token)
+        try:
+            await asyncio.gather(
+                *(
+                    self.publish(event["pubsub"], event["topic"], event["data"], event.get("partition_key"))
+                    for event in entry["events"]
+                )
+            )
+            await conversationLog.clearOutbox(index)
+            self.metrics.inc("outbox_relayed")
+        except Exception as e:
+            # The entry stays in the outbox and is picked up by a later sweep
+            self.metrics.inc("outbox_relay_failures")
+            logging.error(f"Failed to relay outbox entry {index} of {conversationLog.key}: {e}")
+        finally:
+            self.inFlight.discard(token)
+
+    async def sweep(self, conversationLog):
+        for index, entry in await conversationLog.pendingOutbox(self.recoveryWindow):
+            if time.time() - entry["created_at"] < self.minAge:
+                continue
+            logging.info(f"Relaying leftover outbox entry {index} of {conversationLog.key}")
+            self.metrics.inc("outbox_recovered")
+            await self.relay(conversationLog, index, entry)
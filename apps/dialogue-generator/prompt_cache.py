@@ -0,0 +1,53 @@
+from collections import OrderedDict
+
+
+class PromptContext:
+    def __init__(self, conversationId, description, version, context):
+        self.conversationId = conversationId
+        self.description = description
+        # Log position the agent's last prompt covered
+        self.version = version
+        self.context = context
+
+
+class PromptContextCache:
+    """LRU cache of the Ollama `context` returned at the end of an agent's turn.
+
+    Keyed by agent id and model. When the same agent speaks again in the same
+    conversation, the generator passes the cached context back to Ollama and
+    only sends the messages appended since that turn, so the character
+    description and older history are not evaluated again.
+    """
+
+    def __init__(self, maxEntries=1024, maxContextTokens=2048):
+        self.maxEntries = maxEntries
+        # Past this size the model would truncate anyway; rebuild from a fresh prompt
+        self.maxContextTokens = maxContextTokens
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, agentId, model, conversationId, description, version, window):
+        """Returns (context, newMessageCount) when the agent can continue from its last turn."""
+        entry = self.entries.get((agentId, model))
+        if (
+            entry is None
+            or entry.conversationId != conversationId
+            or entry.description != description
+            or not 0 <= version - entry.version <= window
+        ):
+            self.misses += 1
+            return None
+        self.entries.move_to_end((agentId, model))
+        self.hits += 1
+        return entry.context, version - entry.version
+
+    def store(self, agentId, model, conversationId, description, version, context):
+        key = (agentId, model)
+        if not context or len(context) > self.maxContextTokens:
+            self.entries.pop(key, None)
+            return
+        self.entries[key] = PromptContext(conversationId, description, version, context)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
@@ -0,0 +1,98 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from admission import AdmissionController, AdmissionRejected
+from metrics import Metrics
+
+
+class AdmissionControllerTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.admission = AdmissionController(self.metrics, maxConcurrent=1, maxQueue=2, maxWait=5, retryAfter=7)
+
+    def test_slots_are_handed_to_waiters_by_priority(self):
+        async def scenario():
+            ticket = await self.admission.acquire()
+            order = []
+
+            async def wait(priority):
+                (await self.admission.acquire(priority)).release()
+                order.append(priority)
+
+            waiters = [asyncio.create_task(wait(priority)) for priority in (5, 1)]
+            await asyncio.sleep(0)
+            self.assertEqual(self.admission.queued, 2)
+            ticket.release()
+            ticket.release()
+            await asyncio.gather(*waiters)
+            return order
+
+        self.assertEqual(asyncio.run(scenario()), [1, 5])
+        self.assertEqual((self.admission.available, self.admission.queued), (1, 0))
+
+    def test_a_full_queue_rejects_with_429(self):
+        async def scenario():
+            await self.admission.acquire()
+            waiters = [asyncio.create_task(self.admission.acquire()) for _ in range(2)]
+            await asyncio.sleep(0)
+            try:
+                await self.admission.acquire()
+            finally:
+                for waiter in waiters:
+                    waiter.cancel()
+
+        with self.assertRaises(AdmissionRejected) as rejected:
+            asyncio.run(scenario())
+        self.assertEqual((rejected.exception.statusCode, rejected.exception.retryAfter), (429, 7))
+
+    def test_a_waiter_past_its_timeout_is_shed_with_503(self):
+        async def scenario():
+            ticket = await self.admission.acquire()
+            with self.assertRaises(AdmissionRejected) as rejected:
+                await self.admission.acquire(timeout=0.01)
+            self.assertEqual(rejected.exception.statusCode, 503)
+            # The shed waiter is skipped; the slot goes back to the pool
+            ticket.release()
+
+        asyncio.run(scenario())
+        self.assertEqual((self.admission.available, self.admission.queued), (1, 0))
+        self.assertEqual(self.metrics.counters["admission_shed"], 1)
+
+    def test_a_slot_handed_over_as_the_wait_times_out_is_passed_on(self):
+        async def scenario():
+            ticket = await self.admission.acquire()
+
+            async def handedOverThenTimedOut(future, timeout):
+                ticket.release()
+                raise asyncio.TimeoutError
+
+            with mock.patch("admission.asyncio.wait_for", handedOverThenTimedOut):
+                with self.assertRaises(AdmissionRejected):
+                    await self.admission.acquire()
+
+        asyncio.run(scenario())
+        self.assertEqual(self.admission.available, 1)
+
+    def test_a_slot_handed_to_a_cancelled_waiter_is_passed_on(self):
+        async def scenario():
+            ticket = await self.admission.acquire()
+            cancelled = asyncio.create_task(self.admission.acquire())
+            waiting = asyncio.create_task(self.admission.acquire())
+            await asyncio.sleep(0)
+            # The slot reaches the first waiter, which is cancelled before it resumes
+            ticket.release()
+            cancelled.cancel()
+            # Depending on the Python version the cancelled wait returns the slot or raises; it is never lost
+            try:
+                (await cancelled).release()
+            except asyncio.CancelledError:
+                pass
+            (await asyncio.wait_for(waiting, 1)).release()
+
+        asyncio.run(scenario())
+        self.assertEqual((self.admission.available, self.admission.queued), (1, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
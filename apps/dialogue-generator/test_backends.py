@@ -0,0 +1,69 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from backends import BackendPool
+
+
+class FakeOllama:
+    """Stand-in for ollama.AsyncClient that reports a fixed set of models."""
+
+    hosts = {}
+
+    def __init__(self, host):
+        self.host = host
+
+    async def ps(self):
+        state = self.hosts[self.host]
+        if state.get("down"):
+            raise ConnectionError(f"{self.host} is down")
+        return SimpleNamespace(models=[SimpleNamespace(model=m) for m in state["loaded"]])
+
+    async def list(self):
+        state = self.hosts[self.host]
+        return SimpleNamespace(models=[SimpleNamespace(model=m) for m in state["available"]])
+
+
+class BackendPoolTest(unittest.TestCase):
+    def setUp(self):
+        FakeOllama.hosts = {
+            "http://a": {"loaded": [], "available": ["llama3:latest"]},
+            "http://b": {"loaded": ["llama3:latest"], "available": ["llama3:latest"]},
+            "http://c": {"loaded": ["mistral:latest"], "available": ["mistral:latest"]},
+        }
+        self.pool = BackendPool(list(FakeOllama.hosts), clientFactory=FakeOllama)
+        asyncio.run(self.pool.refresh())
+
+    def test_prefers_backend_with_model_loaded(self):
+        self.assertEqual(self.pool.choose("llama3").url, "http://b")
+
+    def test_routes_to_least_outstanding_requests(self):
+        self.pool.backends[1].inFlight = 1
+        self.pool.backends[0].loadedModels.add("llama3:latest")
+        self.assertEqual(self.pool.choose("llama3").url, "http://a")
+
+    def test_falls_back_to_backend_with_model_pulled(self):
+        FakeOllama.hosts["http://b"]["down"] = True
+        asyncio.run(self.pool.refresh())
+        self.assertEqual(self.pool.choose("llama3").url, "http://a")
+
+    def test_an_empty_backend_list_is_rejected_up_front(self):
+        with self.assertRaises(ValueError):
+            BackendPool([], clientFactory=FakeOllama)
+
+    def test_failed_generation_marks_backend_unhealthy(self):
+        async def failingGeneration():
+            async with self.pool.acquire("llama3") as backend:
+                self.assertEqual(backend.inFlight, 1)
+                raise ConnectionError("connection reset")
+
+        with self.assertRaises(ConnectionError):
+            asyncio.run(failingGeneration())
+        backend = self.pool.backends[1]
+        self.assertFalse(backend.healthy)
+        self.assertEqual(backend.inFlight, 0)
+        self.assertEqual(self.pool.choose("llama3").url, "http://a")
+
+
+if __name__ == "__main__":
+    unittest.main()
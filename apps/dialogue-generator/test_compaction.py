@@ -0,0 +1,67 @@
+import asyncio
+import json
+import unittest
+
+from compaction import ConversationCompactor
+from conversation_log import ConversationLog
+from inmemory_dapr import InMemoryDapr
+from metrics import Metrics
+
+
+class ConversationCompactorTest(unittest.TestCase):
+    def setUp(self):
+        self.hub = InMemoryDapr()
+        self.log = ConversationLog(self.hub.asyncClient, "state", "chat", segmentSize=4)
+        self.metrics = Metrics()
+        self.summarized = []
+        self.compactor = ConversationCompactor(self.summarize, self.metrics, retain=5, minBatch=4)
+
+    async def summarize(self, previous, messages):
+        self.summarized.append([m["n"] for m in messages])
+        return f"{previous}+{len(messages)}"
+
+    def append(self, start, end):
+        for n in range(start, end):
+            asyncio.run(self.log.append({"n": n}))
+
+    def summary(self):
+        data, _ = self.hub.getState("state", "chat:summary")
+        return json.loads(data)
+
+    def test_old_messages_are_folded_into_the_summary_and_pruned(self):
+        self.append(0, 8)
+        # Only 3 messages lie before the retention window
+        self.assertFalse(asyncio.run(self.compactor.compact(self.log)))
+
+        self.append(8, 14)
+        self.assertTrue(asyncio.run(self.compactor.compact(self.log)))
+        self.assertEqual(self.summarized, [list(range(9))])
+        self.assertEqual(self.summary(), {"summary": "+9", "through": 9})
+        # Whole segments below the summary mark are gone; the partly covered one stays
+        self.assertEqual([m["n"] for m in asyncio.run(self.log.tail(20))], list(range(8, 14)))
+        self.assertEqual(self.metrics.counters["compaction_folded_messages"], 9)
+        self.assertEqual(self.metrics.counters["compaction_pruned_messages"], 8)
+
+        # The next pass starts from the summary's mark
+        self.append(14, 18)
+        self.assertTrue(asyncio.run(self.compactor.compact(self.log)))
+        self.assertEqual(self.summarized[-1], [9, 10, 11, 12])
+        self.assertEqual(self.summary(), {"summary": "+9+4", "through": 13})
+
+    def test_a_concurrent_compaction_wins(self):
+        self.append(0, 10)
+        save = self.log.saveSummary
+
+        async def racingSave(summary, etag):
+            # Another replica saves its summary first
+            await save({"summary": "theirs", "through": 5}, etag)
+            await save(summary, etag)
+
+        self.log.saveSummary = racingSave
+        self.assertFalse(asyncio.run(self.compactor.compact(self.log)))
+        self.assertEqual(self.summary(), {"summary": "theirs", "through": 5})
+        self.assertEqual([m["n"] for m in asyncio.run(self.log.tail(20))], list(range(10)))
+
+
+if __name__ == "__main__":
+    unittest.main()
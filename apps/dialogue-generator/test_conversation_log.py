@@ -0,0 +1,85 @@
+import asyncio
+import json
+import unittest
+
+from conversation_log import ConversationLog
+from inmemory_dapr import InMemoryDapr
+
+
+class ConversationLogTest(unittest.TestCase):
+    def setUp(self):
+        self.hub = InMemoryDapr()
+        self.log = ConversationLog(self.hub.asyncClient, "state", "chat", segmentSize=3)
+
+    def append(self, count, start=0):
+        return [asyncio.run(self.log.append({"n": n})) for n in range(start, start + count)]
+
+    def stored(self, key):
+        data, _ = self.hub.getState("state", key)
+        return json.loads(data) if data else None
+
+    def test_messages_fill_fixed_size_segments(self):
+        self.assertEqual(self.append(7), list(range(7)))
+        self.assertEqual(self.stored("chat:head"), {"segmentSize": 3, "count": 7})
+        self.assertEqual([m["n"] for m in self.stored("chat:segment:1")], [3, 4, 5])
+        self.assertEqual([m["n"] for m in self.stored("chat:segment:2")], [6])
+
+        messages, count = asyncio.run(self.log.read(4))
+        self.assertEqual(([m["n"] for m in messages], count), ([3, 4, 5, 6], 7))
+        self.assertEqual([m["n"] for m in asyncio.run(self.log.readRange(2, 5))], [2, 3, 4])
+        self.assertEqual(asyncio.run(self.log.readRange(6, 20)), [{"n": 6}])
+
+    def test_reading_an_unknown_conversation_writes_nothing(self):
+        self.assertEqual(asyncio.run(self.log.read(5)), ([], 0))
+        self.assertIsNone(self.stored("chat:head"))
+
+    def test_a_conflicting_append_is_retried_on_the_new_head(self):
+        self.append(2)
+        transaction = self.hub.transaction
+
+        def racingTransaction(storeName, operations):
+            # Another replica appends between this append's read and its write
+            self.hub.transaction = transaction
+            self.hub.put(storeName, "chat:segment:0", json.dumps([{"n": 0}, {"n": 1}, {"n": "other"}]))
+            self.hub.put(storeName, "chat:head", json.dumps({"segmentSize": 3, "count": 3}))
+            transaction(storeName, operations)
+
+        self.hub.transaction = racingTransaction
+        self.assertEqual(asyncio.run(self.log.append({"n": 2})), 3)
+        self.assertEqual([m["n"] for m in asyncio.run(self.log.readRange(0, 4))], [0, 1, "other", 2])
+
+    def test_only_one_writer_creates_the_head(self):
+        save = self.hub.saveState
+
+        def racingSave(storeName, key, value, etag=None, options=None):
+            # Both writers find no head; the other one creates it first
+            self.hub.saveState = save
+            save(storeName, key, json.dumps({"segmentSize": 3, "count": 1}), etag, options)
+            self.hub.put(storeName, "chat:segment:0", json.dumps([{"n": "other"}]))
+            save(storeName, key, value, etag, options)
+
+        self.hub.saveState = racingSave
+        self.assertEqual(self.append(1), [1])
+        self.assertEqual([m["n"] for m in asyncio.run(self.log.readRange(0, 2))], ["other", 0])
+
+    def test_legacy_list_is_migrated_once(self):
+        self.hub.put("state", "chat", json.dumps([{"n": n} for n in range(4)]))
+        self.assertEqual(self.append(1, start=4), [4])
+        self.assertEqual(self.stored("chat:head"), {"segmentSize": 3, "count": 5})
+        self.assertEqual([m["n"] for m in asyncio.run(self.log.tail(10))], [0, 1, 2, 3, 4])
+
+    def test_pruning_drops_whole_segments_below_the_base(self):
+        self.append(8)
+        self.assertEqual(asyncio.run(self.log.prune(7)), 6)
+        self.assertIsNone(self.stored("chat:segment:0"))
+        self.assertIsNone(self.stored("chat:segment:1"))
+        self.assertEqual(self.stored("chat:head")["base"], 6)
+        # Reads start at the base, however far back they ask for
+        self.assertEqual([m["n"] for m in asyncio.run(self.log.tail(8))], [6, 7])
+        self.assertEqual([m["n"] for m in asyncio.run(self.log.readRange(0, 7))], [6])
+        self.assertEqual(asyncio.run(self.log.prune(7)), 0)
+        self.assertEqual(self.append(1, start=8), [8])
+
+
+if __name__ == "__main__":
+    unittest.main()
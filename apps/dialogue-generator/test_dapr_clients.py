@@ -0,0 +1,39 @@
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+from dapr.aio.clients import DaprClient
+from dapr.clients.health import DaprHealth
+
+from dapr_clients import DaprClientPool
+
+
+class DaprClientPoolTest(unittest.TestCase):
+    def test_starts_real_clients_on_the_event_loop(self):
+        waitedOn = []
+
+        def waitForSidecar():
+            waitedOn.append(threading.current_thread())
+
+        async def startAndClose():
+            pool = DaprClientPool(size=2, waitForSidecar=waitForSidecar)
+            await pool.start()
+            try:
+                self.assertEqual([type(client) for client in pool.clients], [DaprClient, DaprClient])
+                async with pool.client() as client:
+                    self.assertIs(client, pool.clients[0])
+                self.assertEqual(pool.metrics()["checkouts"], 1)
+            finally:
+                await pool.close()
+
+        # The constructor's own health check would need a sidecar
+        with mock.patch.object(DaprHealth, "wait_for_sidecar"):
+            asyncio.run(startAndClose())
+        # Only the blocking wait left the event loop's thread
+        self.assertEqual(len(waitedOn), 1)
+        self.assertIsNot(waitedOn[0], threading.main_thread())
+
+
+if __name__ == "__main__":
+    unittest.main()
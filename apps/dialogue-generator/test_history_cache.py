@@ -0,0 +1,51 @@
+import unittest
+from unittest import mock
+
+from history_cache import RecentHistory
+
+
+class RecentHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.history = RecentHistory(window=3, maxAge=30)
+
+    def test_appends_at_the_known_version_keep_the_window(self):
+        self.history.warm("c", ["a", "b"], 2)
+        self.history.append("c", "c", 2)
+        self.history.append("c", "d", 3)
+        self.assertEqual(self.history.get("c"), (["b", "c", "d"], 4))
+        self.assertEqual((self.history.hits, self.history.misses), (1, 0))
+
+    def test_an_append_out_of_order_drops_the_entry(self):
+        self.history.warm("c", ["a"], 1)
+        # Another replica wrote message 1, so ours lands at 2
+        self.history.append("c", "c", 2)
+        self.assertIsNone(self.history.get("c"))
+        # Nothing is buffered for the conversation until it is warmed again
+        self.history.append("c", "d", 3)
+        self.assertIsNone(self.history.get("c"))
+        self.assertEqual(self.history.misses, 2)
+
+    def test_a_buffer_behind_the_log_is_dropped(self):
+        self.history.warm("c", ["a"], 1)
+        self.assertEqual(self.history.get("c", 1), (["a"], 1))
+        # The log has two messages, the second appended by another replica
+        self.assertIsNone(self.history.get("c", 2))
+        self.assertIsNone(self.history.get("c"))
+
+    def test_old_entries_are_misses(self):
+        with mock.patch("history_cache.time.monotonic", return_value=100):
+            self.history.warm("c", ["a"], 1)
+        with mock.patch("history_cache.time.monotonic", return_value=125):
+            self.assertEqual(self.history.get("c"), (["a"], 1))
+        with mock.patch("history_cache.time.monotonic", return_value=131):
+            self.assertIsNone(self.history.get("c"))
+
+    def test_invalidate_forgets_the_conversation(self):
+        self.history.warm("c", ["a"], 1)
+        self.history.invalidate("c")
+        self.history.invalidate("unknown")
+        self.assertIsNone(self.history.get("c"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import asyncio
+import unittest
+
+from conversation_log import ConversationLog
+from inmemory_dapr import InMemoryDapr
+from metrics import Metrics
+from outbox import OutboxRelay
+
+
+class OutboxRelayTest(unittest.TestCase):
+    def setUp(self):
+        self.hub = InMemoryDapr()
+        self.log = ConversationLog(self.hub.asyncClient, "state", "chat", segmentSize=3)
+        self.metrics = Metrics()
+        self.published = []
+        self.failing = False
+        self.relay = OutboxRelay(self.publish, self.metrics, recoveryWindow=10, minAge=10)
+
+    async def publish(self, pubsub, topic, data, partitionKey):
+        if self.failing:
+            raise ConnectionError("sidecar down")
+        self.published.append((topic, data, partitionKey))
+
+    def entry(self, n, age=0):
+        entry = OutboxRelay.entry([{"pubsub": "pubsub", "topic": "conversations", "data": n, "partition_key": "c"}])
+        entry["created_at"] -= age
+        return entry
+
+    def appendWithOutbox(self, n, age=0):
+        entry = self.entry(n, age)
+        return asyncio.run(self.log.append({"n": n}, entry)), entry
+
+    def test_a_relayed_entry_is_published_and_cleared(self):
+        index, entry = self.appendWithOutbox(0)
+        self.assertEqual(asyncio.run(self.log.pendingOutbox(10)), [(0, entry)])
+        asyncio.run(self.relay.relay(self.log, index, entry))
+        self.assertEqual(self.published, [("conversations", 0, "c")])
+        self.assertEqual(asyncio.run(self.log.pendingOutbox(10)), [])
+        self.assertEqual(self.metrics.counters["outbox_relayed"], 1)
+
+    def test_a_failed_relay_leaves_the_entry_for_the_sweep(self):
+        index, entry = self.appendWithOutbox(0, age=60)
+        self.failing = True
+        asyncio.run(self.relay.relay(self.log, index, entry))
+        self.assertEqual(len(asyncio.run(self.log.pendingOutbox(10))), 1)
+        self.assertEqual(self.metrics.counters["outbox_relay_failures"], 1)
+
+        self.failing = False
+        asyncio.run(self.relay.sweep(self.log))
+        self.assertEqual(self.published, [("conversations", 0, "c")])
+        self.assertEqual(asyncio.run(self.log.pendingOutbox(10)), [])
+        self.assertEqual(self.metrics.counters["outbox_recovered"], 1)
+
+    def test_the_sweep_skips_young_entries_and_those_outside_its_window(self):
+        self.appendWithOutbox(0, age=60)
+        for n in range(1, 11):
+            asyncio.run(self.log.append({"n": n}))
+        self.appendWithOutbox(11, age=0)
+        # Entry 0 is beyond the last 10 messages; entry 11 is likely still being relayed by its writer
+        self.assertEqual([index for index, _ in asyncio.run(self.log.pendingOutbox(10))], [11])
+        asyncio.run(self.relay.sweep(self.log))
+        self.assertEqual(self.published, [])
+
+    def test_an_entry_is_relayed_once_at_a_time(self):
+        index, entry = self.appendWithOutbox(0)
+
+        async def relayTwice():
+            await asyncio.gather(self.relay.relay(self.log, index, entry), self.relay.relay(self.log, index, entry))
+
+        asyncio.run(relayTwice())
+        self.assertEqual(len(self.published), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
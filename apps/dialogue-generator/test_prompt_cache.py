@@ -0,0 +1,42 @@
+import unittest
+
+from prompt_cache import PromptContextCache
+
+
+class PromptContextCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = PromptContextCache(maxEntries=2, maxContextTokens=5)
+        self.cache.store("a", "llama3", "c", "Tea lover", 10, [1, 2, 3])
+
+    def test_the_agent_continues_with_the_messages_since_its_turn(self):
+        self.assertEqual(self.cache.lookup("a", "llama3", "c", "Tea lover", 13, window=12), ([1, 2, 3], 3))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 0))
+
+    def test_a_changed_conversation_description_or_model_misses(self):
+        for args in (
+            ("a", "llama3", "other", "Tea lover", 13),
+            ("a", "llama3", "c", "Coffee lover", 13),
+            ("a", "mistral", "c", "Tea lover", 13),
+            # More new messages than the prompt window holds, or a log that went back
+            ("a", "llama3", "c", "Tea lover", 23),
+            ("a", "llama3", "c", "Tea lover", 9),
+        ):
+            self.assertIsNone(self.cache.lookup(*args, window=12), args)
+        self.assertEqual(self.cache.misses, 5)
+
+    def test_empty_or_oversized_contexts_drop_the_entry(self):
+        self.cache.store("a", "llama3", "c", "Tea lover", 11, list(range(6)))
+        self.assertIsNone(self.cache.lookup("a", "llama3", "c", "Tea lover", 11, window=12))
+        self.cache.store("b", "llama3", "c", "Quiet", 11, [1])
+        self.cache.store("b", "llama3", "c", "Quiet", 12, [])
+        self.assertEqual(len(self.cache.entries), 0)
+
+    def test_the_least_recently_used_agent_is_evicted(self):
+        self.cache.store("b", "llama3", "c", "Quiet", 10, [1])
+        self.cache.lookup("a", "llama3", "c", "Tea lover", 10, window=12)
+        self.cache.store("c", "llama3", "c", "Loud", 10, [1])
+        self.assertEqual([agentId for agentId, _ in self.cache.entries], ["a", "c"])
+
+
+if __name__ == "__main__":
+    unittest.main()
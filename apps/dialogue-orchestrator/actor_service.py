@@ -0,0 +1,42 @@
+"""Hosts the agent actors.
+
+The orchestrator's gRPC app can't serve actor calls, so the actors run in
+this small FastAPI app from the same code, as their own Dapr app next to
+the orchestrator:
+
+    uvicorn actor_service:app --port 5301
+"""
+
+import os
+from contextlib import asynccontextmanager
+from datetime import timedelta
+
+from dapr.actor.runtime.config import ActorRuntimeConfig
+from dapr.actor.runtime.runtime import ActorRuntime
+from dapr.ext.fastapi import DaprActor
+from fastapi import FastAPI
+
+from agent_actor import AgentActor
+
+# Agents that haven't spoken for a while are deactivated; their state stays in the actor state store.
+# Reentrancy stays off, so each agent handles one call at a time.
+ActorRuntime.set_actor_config(
+    ActorRuntimeConfig(
+        actor_idle_timeout=timedelta(seconds=float(os.getenv("AGENT_ACTOR_IDLE_TIMEOUT_SECONDS", "600"))),
+        actor_scan_interval=timedelta(seconds=float(os.getenv("AGENT_ACTOR_SCAN_INTERVAL_SECONDS", "30"))),
+    )
+)
+
+# The ledger tail is folded into a snapshot after this many entries, keeping this many archived segments
+AgentActor.snapshotEvery = int(os.getenv("TEA_LEDGER_SNAPSHOT_ENTRIES", "64"))
+AgentActor.retainSegments = int(os.getenv("TEA_LEDGER_RETAIN_SEGMENTS", "16"))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await actor.register_actor(AgentActor)
+    yield
+
+
+app = FastAPI(title=f"{AgentActor.__name__}Service", lifespan=lifespan)
+actor = DaprActor(app)
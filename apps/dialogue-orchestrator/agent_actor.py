@@ -0,0 +1,157 @@
+import logging
+import time
+import uuid
+from abc import abstractmethod
+
+from dapr.actor import Actor, ActorInterface, actormethod
+
+from ledger import TeaLedger
+
+
+class AgentActorInterface(ActorInterface):
+    @abstractmethod
+    @actormethod(name="Register")
+    async def register(self, agent: dict) -> dict:
+        ...
+
+    @abstractmethod
+    @actormethod(name="GetProfile")
+    async def get_profile(self) -> dict:
+        ...
+
+    @abstractmethod
+    @actormethod(name="ReserveTea")
+    async def reserve_tea(self, request: dict) -> dict:
+        ...
+
+    @abstractmethod
+    @actormethod(name="CommitUsage")
+    async def commit_usage(self, request: dict) -> dict:
+        ...
+
+
+class AgentActor(Actor, AgentActorInterface):
+    """Owns one agent's profile and tea balance.
+
+    The actor is the only writer of the balance: a generation reserves tea
+    before it starts and commits what it used when it ends, and the unused
+    part goes back to the balance. Calls to one actor are turn-based
+    (reentrancy stays off), so these updates need no etags or retries.
+
+    The balance is kept as a ledger (see `ledger.py`): each call appends
+    entries to a short tail, which is folded into a snapshot every
+    `snapshotEvery` entries and archived as a read-only segment; the last
+    `retainSegments` segments are kept. Reservations expire after
+    `ttl_seconds`, so a generator that crashed mid-generation doesn't hold
+    tea forever.
+    """
+
+    snapshotEvery = 64
+    retainSegments = 16
+
+    async def register(self, agent: dict) -> dict:
+        """Creates or updates the agent; its balance is set to the given `tea_amount_ml`."""
+        await self._loadLedger()
+        profile = {"id": agent["id"], "name": agent["name"], "description": agent["description"]}
+        await self._state_manager.set_state("profile", profile)
+        await self._append("set", ml=max(int(agent["tea_amount_ml"]), 0))
+        await self._save()
+        return self._view(profile)
+
+    async def get_profile(self) -> dict:
+        _, profile = await self._state_manager.try_get_state("profile")
+        if profile is None:
+            return None
+        await self._loadLedger()
+        return self._view(profile)
+
+    async def reserve_tea(self, request: dict) -> dict:
+        """Holds up to `ml` of the available tea for one generation.
+
+        Returns the reservation id (None when nothing could be granted), the
+        granted amount and the profile.
+        """
+        _, profile = await self._state_manager.try_get_state("profile")
+        if profile is None:
+            return {"reservation_id": None, "granted_ml": 0, "profile": None}
+        ledger = await self._loadLedger()
+        await self._expire()
+        granted = max(min(int(request["ml"]), ledger.available()), 0)
+        reservationId = None
+        if granted > 0:
+            reservationId = str(uuid.uuid4())
+            await self._append(
+                "reserve",
+                reservation_id=reservationId,
+                ml=granted,
+                expires_at=time.time() + float(request.get("ttl_seconds", 300)),
+            )
+        await self._save()
+        return {"reservation_id": reservationId, "granted_ml": granted, "profile": self._view(profile)}
+
+    async def commit_usage(self, request: dict) -> dict:
+        """Charges `used_ml` (at most the reserved amount) and releases the rest of the reservation.
+
+        Returns the resulting `tea_delta` event.
+        """
+        ledger = await self._loadLedger()
+        await self._expire()
+        hold = ledger.holds.get(request["reservation_id"])
+        used = 0
+        if hold is None:
+            # Already committed, or expired: the tea went back to the balance
+            logging.info("Ignoring usage of unknown reservation %s", request["reservation_id"])
+        else:
+            used = min(max(int(request.get("used_ml", 0)), 0), hold["ml"])
+            await self._append("commit", reservation_id=request["reservation_id"], used_ml=used)
+        await self._save()
+        return {
+            "type": "tea_delta",
+            "id": self.id.id,
+            "delta_ml": -used,
+            "tea_amount_ml": ledger.balance,
+            "version": ledger.seq,
+        }
+
+    def _view(self, profile):
+        return dict(profile, tea_amount_ml=self.ledger.balance, version=self.ledger.seq)
+
+    async def _loadLedger(self):
+        """Returns the ledger, replaying the tail on top of the snapshot after (re)activation."""
+        if getattr(self, "ledger", None) is None:
+            _, snapshot = await self._state_manager.try_get_state("ledger_snapshot")
+            _, tail = await self._state_manager.try_get_state("ledger_tail")
+            self.ledger = TeaLedger(snapshot)
+            self.segment = (snapshot or {}).get("segment", 0)
+            self.tail = list(tail or [])
+            for entry in self.tail:
+                self.ledger.apply(entry)
+        return self.ledger
+
+    async def _append(self, op, **fields):
+        entry = self.ledger.entry(op, **fields)
+        self.ledger.apply(entry)
+        self.tail.append(entry)
+        if len(self.tail) >= self.snapshotEvery:
+            await self._state_manager.set_state(f"ledger:{self.segment}", self.tail)
+            if self.segment >= self.retainSegments:
+                await self._state_manager.try_remove_state(f"ledger:{self.segment - self.retainSegments}")
+            self.segment += 1
+            await self._state_manager.set_state(
+                "ledger_snapshot", dict(self.ledger.snapshot(), segment=self.segment)
+            )
+            self.tail = []
+        await self._state_manager.set_state("ledger_tail", list(self.tail))
+
+    async def _expire(self):
+        for reservationId in self.ledger.expired(time.time()):
+            await self._append("expire", reservation_id=reservationId)
+
+    async def _save(self):
+        try:
+            await self._state_manager.save_state()
+        except Exception:
+            # The entries weren't stored; reload the ledger from the state store on the next call
+            self.ledger = None
+            await self._state_manager.clear_cache()
+            raise
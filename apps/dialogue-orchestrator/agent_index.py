@@ -0,0 +1,177 @@
+import json
+import logging
+import zlib
+
+from dapr.clients.grpc._request import TransactionalStateOperation, TransactionOperationType
+from dapr.clients.grpc._state import Concurrency, StateItem, StateOptions
+
+
+class AgentIndex:
+    """Sharded, etag-guarded index of the agent keys in the state store.
+
+    Replaces the single `agent_keys` list, which every agent event rewrote
+    with an unguarded read-modify-write. Keys are spread over `shards` lists
+    by a stable hash, so concurrent updates rarely touch the same shard. A
+    shard is only written when an agent joins or leaves, in the same
+    transaction as the agent itself and guarded by the shard's etag; tea
+    changes only write the agent.
+    """
+
+    def __init__(self, storeName, shards=16, maxRetries=5, legacyKey="agent_keys"):
+        self.storeName = storeName
+        self.shards = shards
+        self.maxRetries = maxRetries
+        self.legacyKey = legacyKey
+
+    def shardKey(self, shard):
+        return f"agent_index:{shard}"
+
+    def shardFor(self, key):
+        return zlib.crc32(key.encode()) % self.shards
+
+    def save(self, client, key, value):
+        """Saves an agent, or deletes it when `value` is None, keeping its shard in step."""
+        shardKey = self.shardKey(self.shardFor(key))
+        for attempt in range(self.maxRetries):
+            response = client.get_state(self.storeName, shardKey)
+            members = set(json.loads(response.data)) if response.data else set()
+            if (key in members) == (value is not None):
+                # Membership is unchanged, so the shard isn't written
+                if value is None:
+                    client.delete_state(self.storeName, key)
+                else:
+                    client.save_state(self.storeName, key, value)
+                return
+
+            if value is None:
+                members.discard(key)
+                agentOperation = TransactionalStateOperation(
+                    key=key, operation_type=TransactionOperationType.delete
+                )
+            else:
+                members.add(key)
+                agentOperation = TransactionalStateOperation(key=key, data=value)
+            shardOperation = TransactionalStateOperation(
+                key=shardKey, data=json.dumps(sorted(members)), etag=response.etag or None
+            )
+            try:
+                client.execute_state_transaction(self.storeName, [agentOperation, shardOperation])
+                return
+            except Exception as e:
+                # Another replica changed the shard first; re-read it and try again
+                logging.info("Agent index shard %s changed concurrently (attempt %d): %s", shardKey, attempt + 1, e)
+        raise RuntimeError(f"Could not update {shardKey} after {self.maxRetries} attempts")
+
+    def saveMany(self, client, values):
+        """Saves or deletes many agents (`key -> value or None`); returns the keys that couldn't be written.
+
+        Agents whose membership is unchanged, the common case of a tea or
+        profile update, are written with one bulk save. Each shard that gains
+        or loses agents is updated in one transaction with its agents,
+        falling back to `save` per agent when the shard changed concurrently.
+        """
+        byShard = {}
+        for key, value in values.items():
+            byShard.setdefault(self.shardKey(self.shardFor(key)), {})[key] = value
+        shards = {item.key: item for item in client.get_bulk_state(self.storeName, sorted(byShard)).items}
+
+        saves, deletes, failed = [], [], set()
+        for shardKey, shardValues in byShard.items():
+            shard = shards[shardKey]
+            members = set(json.loads(shard.data)) if shard.data else set()
+            joined = {key for key, value in shardValues.items() if value is not None} - members
+            left = {key for key, value in shardValues.items() if value is None} & members
+            if not joined and not left:
+                for key, value in shardValues.items():
+                    if value is None:
+                        deletes.append(key)
+                    else:
+                        saves.append(StateItem(key=key, value=value))
+                continue
+            operations = [
+                TransactionalStateOperation(key=key, operation_type=TransactionOperationType.delete)
+                if value is None
+                else TransactionalStateOperation(key=key, data=value)
+                for key, value in shardValues.items()
+            ]
+            operations.append(
+                TransactionalStateOperation(
+                    key=shardKey, data=json.dumps(sorted((members | joined) - left)), etag=shard.etag or None
+                )
+            )
+            try:
+                client.execute_state_transaction(self.storeName, operations)
+            except Exception as e:
+                logging.info("Agent index shard %s changed concurrently, saving its agents one by one: %s", shardKey, e)
+                for key, value in shardValues.items():
+                    try:
+                        self.save(client, key, value)
+                    except Exception as e:
+                        logging.error("Failed to save agent %s: %s", key, e)
+                        failed.add(key)
+
+        if saves:
+            try:
+                client.save_bulk_state(self.storeName, saves)
+            except Exception as e:
+                logging.error("Failed to save %d agents: %s", len(saves), e)
+                failed.update(item.key for item in saves)
+        for key in deletes:
+            # Not indexed, so only a stray record is left to remove
+            try:
+                client.delete_state(self.storeName, key)
+            except Exception as e:
+                logging.error("Failed to delete agent %s: %s", key, e)
+                failed.add(key)
+        return failed
+
+    def keys(self, client):
+        """Returns every indexed agent key with one bulk read, migrating the legacy list if needed."""
+        shardKeys = [self.shardKey(shard) for shard in range(self.shards)]
+        items = client.get_bulk_state(self.storeName, shardKeys).items
+        keys = set()
+        for item in items:
+            if item.data:
+                keys.update(json.loads(item.data))
+        if not any(item.data for item in items):
+            keys = self.migrateLegacy(client)
+        return sorted(keys)
+
+    def ensureShards(self, client):
+        """Creates missing shards, so every later update can be guarded by an etag."""
+        for shard in range(self.shards):
+            shardKey = self.shardKey(shard)
+            if client.get_state(self.storeName, shardKey).data:
+                continue
+            try:
+                client.save_state(
+                    self.storeName,
+                    shardKey,
+                    json.dumps([]),
+                    options=StateOptions(concurrency=Concurrency.first_write),
+                )
+            except Exception as e:
+                logging.info("Agent index shard %s was created concurrently: %s", shardKey, e)
+
+    def migrateLegacy(self, client):
+        """Copies the keys of the old `agent_keys` list into empty shards."""
+        legacyData = client.get_state(self.storeName, self.legacyKey).data
+        if not legacyData:
+            return set()
+        keys = set(json.loads(legacyData))
+        byShard = {}
+        for key in keys:
+            byShard.setdefault(self.shardFor(key), set()).add(key)
+        for shard, members in byShard.items():
+            try:
+                # First write wins, so concurrent migrations don't clobber each other
+                client.save_state(
+                    self.storeName,
+                    self.shardKey(shard),
+                    json.dumps(sorted(members)),
+                    options=StateOptions(concurrency=Concurrency.first_write),
+                )
+            except Exception as e:
+                logging.info("Agent index shard %d was already migrated: %s", shard, e)
+        logging.info("Migrated %d agent keys from %s into the agent index.", len(keys), self.legacyKey)
+        return keys
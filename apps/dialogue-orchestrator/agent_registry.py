@@ -0,0 +1,156 @@
+import threading
+
+from scheduler import RandomPolicy
+
+
+class AgentRegistry:
+    """In-memory view of the agents that still have tea, indexed by id and name.
+
+    The state store stays the durable copy; the registry is rebuilt from it on
+    startup and kept current by the `agents` subscription, so choosing who
+    speaks next needs no state store reads. Who is chosen is up to the
+    scheduling policy (see `scheduler.py`), which only ever sees the agents
+    that are available: an agent with `maxInFlight` generations running is
+    withdrawn from it until one of them is released.
+    """
+
+    def __init__(self, policy=None, maxInFlight=1):
+        self.policy = policy or RandomPolicy()
+        self.maxInFlight = maxInFlight
+        self.lock = threading.Condition()
+        self.agents = {}
+        self.idsByName = {}
+        self.inFlight = {}
+        # Bumped by every upsert; `touched` remembers the version of each agent's last upsert
+        # so a bulk load that raced with the subscription doesn't roll agents back
+        self.version = 0
+        self.touched = {}
+
+    def __len__(self):
+        return len(self.agents)
+
+    def busy(self):
+        """Number of agents at their in-flight limit."""
+        with self.lock:
+            return sum(1 for count in self.inFlight.values() if count >= self.maxInFlight)
+
+    def get(self, agentId):
+        with self.lock:
+            return self.agents.get(agentId)
+
+    def byName(self, name):
+        with self.lock:
+            return [self.agents[agentId] for agentId in self.idsByName.get(name, ())]
+
+    def upsert(self, agent):
+        """Adds or updates an agent, or drops it once it has run out of tea."""
+        with self.lock:
+            self.version += 1
+            self.touched[agent["id"]] = self.version
+            if agent["tea_amount_ml"] > 0:
+                self._put(agent)
+            else:
+                self._remove(agent["id"])
+
+    def load(self, agents, version=None):
+        """Replaces the registry with a bulk read of the state store.
+
+        `version` is the registry version taken before the read started;
+        agents upserted since then keep their newer in-memory state.
+        """
+        with self.lock:
+            fresh = {agent["id"]: agent for agent in agents if agent.get("tea_amount_ml", 0) > 0}
+            if version is not None:
+                for agentId, touchedAt in self.touched.items():
+                    if touchedAt > version:
+                        if agentId in self.agents:
+                            fresh[agentId] = self.agents[agentId]
+                        else:
+                            fresh.pop(agentId, None)
+            self.touched = {
+                agentId: touchedAt
+                for agentId, touchedAt in self.touched.items()
+                if version is not None and touchedAt > version
+            }
+            # Applied as a diff, so the policy keeps its history (e.g. who spoke last)
+            for agentId in [agentId for agentId in self.agents if agentId not in fresh]:
+                self._remove(agentId)
+            for agent in fresh.values():
+                self._put(agent)
+
+    def choose(self, excludeName=None, timeout=0, excludeIds=()):
+        """Reserves an agent not named `excludeName` nor in `excludeIds`, or returns None if there is none.
+
+        If every such agent is at its in-flight limit, waits up to `timeout`
+        seconds for one to be released. The caller must `release` the agent
+        once its generation is over.
+        """
+        with self.lock:
+            agentId = self._pick(excludeName, excludeIds)
+            if agentId is None and timeout and self._hasCandidates(excludeName, excludeIds):
+                self.lock.wait_for(
+                    lambda: self._pick(excludeName, excludeIds) is not None
+                    or not self._hasCandidates(excludeName, excludeIds),
+                    timeout,
+                )
+                agentId = self._pick(excludeName, excludeIds)
+            if agentId is None:
+                return None
+            self.policy.spoke(agentId)
+            self.inFlight[agentId] = self.inFlight.get(agentId, 0) + 1
+            if self.inFlight[agentId] >= self.maxInFlight:
+                self.policy.deactivate(agentId)
+            return self.agents[agentId]
+
+    def release(self, agentId):
+        with self.lock:
+            count = self.inFlight.pop(agentId, 0) - 1
+            if count > 0:
+                self.inFlight[agentId] = count
+            if agentId in self.agents and count < self.maxInFlight:
+                self.policy.activate(self.agents[agentId])
+            self.lock.notify_all()
+
+    def _available(self, agentId):
+        return agentId in self.agents and self.inFlight.get(agentId, 0) < self.maxInFlight
+
+    def _excluded(self, excludeName, excludeIds):
+        return self.idsByName.get(excludeName, set()) | (self.agents.keys() & set(excludeIds))
+
+    def _hasCandidates(self, excludeName, excludeIds=()):
+        return len(self.agents) > len(self._excluded(excludeName, excludeIds))
+
+    def _pick(self, excludeName, excludeIds=()):
+        # The previous speaker sits out this pick; usually that's a single agent
+        excluded = [agentId for agentId in self._excluded(excludeName, excludeIds) if self._available(agentId)]
+        for agentId in excluded:
+            self.policy.deactivate(agentId)
+        try:
+            return self.policy.pick()
+        finally:
+            for agentId in excluded:
+                self.policy.activate(self.agents[agentId])
+
+    def _put(self, agent):
+        agentId = agent["id"]
+        previous = self.agents.get(agentId)
+        if previous is not None:
+            self._unindexName(previous)
+        self.agents[agentId] = agent
+        self.idsByName.setdefault(agent["name"], set()).add(agentId)
+        if self._available(agentId):
+            self.policy.activate(agent)
+
+    def _remove(self, agentId):
+        agent = self.agents.pop(agentId, None)
+        if agent is None:
+            return
+        self._unindexName(agent)
+        self.policy.forget(agentId)
+
+    def _unindexName(self, agent):
+        ids = self.idsByName.get(agent["name"])
+        if ids is not None:
+            ids.discard(agent["id"])
+            if not ids:
+                del self.idsByName[agent["name"]]
@@ -1,12 +1,33 @@
+import asyncio
+import functools
 import json
 import logging
 import os
-import random
+import socket
+import threading
+import time
+from concurrent import futures
+from datetime import timedelta
 
+import dapr.ext.workflow as wf
 from cloudevents.sdk.event import v1
-from dapr.clients import DaprClient
+from dapr.actor import ActorId, ActorProxyFactory
+from dapr.clients.exceptions import DaprHttpError
+from dapr.clients.grpc._response import TopicEventResponse
 from dapr.ext.grpc import App
 
+from agent_index import AgentIndex
+from agent_registry import AgentRegistry
+from batching import MicroBatcher
+from dapr_clients import DaprClientPool
+from dispatcher import TurnDispatcher
+from metrics import Metrics
+from pacing import ConversationPacer, TurnCoalescer, TurnTimer
+from partitions import PartitionLeases, SerialQueues, TurnInbox
+from scheduler import policies
+from tea_balances import TeaBalances
+from turn_workflow import TurnWorkflow
+
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 
@@ -15,93 +36,277 @@ stateStore = os.getenv("DAPR_STATE_STORE", "statestore")
 pubsubName = os.getenv("DAPR_PUBSUB_NAME", "pubsub")
 agentsTopic = os.getenv("DAPR_AGENTS_TOPIC", "agents")
 conversationsTopic = os.getenv("DAPR_CONVERSATIONS_TOPIC", "conversations")
+# Conversation events that can't be handled even after redelivery end up here
+conversationsDeadLetterTopic = os.getenv("DAPR_CONVERSATIONS_DEAD_LETTER_TOPIC", "conversations-deadletter")
 
-app = App()
+# Conversation used when an event doesn't name one
+defaultConversationId = "shared_events_chat"
 
+# The gRPC server delivers events on this many threads; the subscribers handle concurrent events
+# in batches of up to SUBSCRIBER_BATCH_SIZE, waiting this long for a batch to fill
+subscriberThreads = int(os.getenv("SUBSCRIBER_THREADS", "32"))
+subscriberBatchSize = int(os.getenv("SUBSCRIBER_BATCH_SIZE", "32"))
+subscriberBatchWaitSeconds = float(os.getenv("SUBSCRIBER_BATCH_WAIT_SECONDS", "0.005"))
 
-def initialize_key_tracking(client):
-    """Initializes the key tracking list in the state store."""
-    # Check if the key tracking list already exists
-    tracking_key = "agent_keys"
-    existing_keys = client.get_state(stateStore, tracking_key).data
-    if not existing_keys:
-        client.save_state(stateStore, tracking_key, json.dumps([]))
-        logging.info("Initialized key tracking list in state store.")
+app = App(thread_pool=futures.ThreadPoolExecutor(max_workers=subscriberThreads))
 
+# Long-lived Dapr channels shared by every subscriber thread
+daprPool = DaprClientPool(size=int(os.getenv("DAPR_CLIENT_POOL_SIZE", "4")))
 
-def update_key_tracking(client, key, add=True):
-    """Updates the key tracking list in the state store."""
-    tracking_key = "agent_keys"
-    keys_data = client.get_state(stateStore, tracking_key).data
-    if keys_data:
-        keys_list = json.loads(keys_data)
-    else:
-        keys_list = []
-
-    if add and key not in keys_list:
-        keys_list.append(key)
-        client.save_state(stateStore, tracking_key, json.dumps(keys_list))
-        logging.info("Added key %s to tracking list.", key)
-    elif not add and key in keys_list:
-        keys_list.remove(key)
-        client.save_state(stateStore, tracking_key, json.dumps(keys_list))
-        logging.info("Removed key %s from tracking list.", key)
-
-
-def saveAgentToState(agent):
-    """Saves or removes an agent in the state store based on their tea amount."""
-    with DaprClient() as client:
-        key = f"dialogue-orchestrator:agent_{agent['id']}"  # Changed '||' to ':'
-        if agent["tea_amount_ml"] > 0:
-            client.save_state(stateStore, key, json.dumps(agent))
-            update_key_tracking(client, key, add=True)
-            logging.info("Agent %s saved to state with key %s", agent["name"], key)
-        else:
-            client.delete_state(stateStore, key)
-            update_key_tracking(client, key, add=False)
-            logging.info(
-                "Agent %s removed from state due to zero tea amount", agent["name"]
-            )
+# Agent keys, sharded so concurrent agent events rarely contend for the same key
+agentIndex = AgentIndex(stateStore, shards=int(os.getenv("AGENT_INDEX_SHARDS", "16")))
 
+# Tea balances arrive as deltas and are only written as periodic, aggregated snapshots
+teaBalances = TeaBalances(stateStore, shards=int(os.getenv("TEA_BALANCE_SHARDS", "16")))
+teaSnapshotSeconds = float(os.getenv("TEA_SNAPSHOT_SECONDS", "30"))
 
-def chooseAgentExcluding(conversationName):
-    """Selects a random agent, ensuring it is not the author of the conversation."""
-    with DaprClient() as client:
-        tracking_key = "agent_keys"
-        keys_data = client.get_state(stateStore, tracking_key).data
-        if keys_data:
-            agent_keys = json.loads(keys_data)
-        else:
-            logging.info("No agent keys available.")
-            return None
-
-        agents = []
-        for key in agent_keys:
-            agent_data_response = client.get_state(stateStore, key)
-            if agent_data_response.data:
-                try:
-                    agent_data = json.loads(agent_data_response.data)
-                    if (
-                        agent_data
-                        and "name" in agent_data
-                        and agent_data["name"] != conversationName
-                    ):
-                        agents.append(agent_data)
-                except json.JSONDecodeError as e:
-                    logging.error("Failed to decode agent data for key %s: %s", key, e)
-                    continue
+# Agents with tea, kept in memory so choosing a speaker needs no state store reads.
+# The policy decides who speaks next: random by default, or tea_weighted, round_robin or least_recently_spoken
+agentSchedulerPolicy = os.getenv("AGENT_SCHEDULER_POLICY", "random")
+agentRegistry = AgentRegistry(
+    policies[agentSchedulerPolicy](),
+    maxInFlight=int(os.getenv("AGENT_MAX_INFLIGHT", "1")),
+)
+# How long a turn waits for an agent when all the candidates are busy
+agentWaitSeconds = float(os.getenv("AGENT_WAIT_SECONDS", "30"))
+# How many speakers a turn tries when the generator turns them away for lack of tea (402)
+turnAgentAttempts = int(os.getenv("TURN_AGENT_ATTEMPTS", "3"))
+# With agent actors, each agent's actor (see actor_service.py) owns its tea balance
+agentActorsEnabled = os.getenv("AGENT_ACTORS_ENABLED", "false").lower() == "true"
+agentActorType = os.getenv("AGENT_ACTOR_TYPE", "AgentActor")
 
-        if not agents:
-            logging.info("No valid agents available.")
-            return None
+# Other replicas consume part of the agents topic, so the registry is also reloaded periodically
+agentRegistryRefreshSeconds = float(os.getenv("AGENT_REGISTRY_REFRESH_SECONDS", "60"))
 
-        chosen_agent = random.choice(agents)
-        logging.info("Selected agent %s for response.", chosen_agent["name"])
-        return chosen_agent
+metrics = Metrics()
+metrics.gauge("dapr_client_pool", daprPool.metrics)
+metrics.gauge("agent_registry_size", lambda: len(agentRegistry))
+metrics.gauge("agents_busy", agentRegistry.busy)
 
+# Generations run on their own workers, so subscribers acknowledge events right away
+dispatcher = TurnDispatcher(
+    metrics,
+    workers=int(os.getenv("TURN_DISPATCH_WORKERS", "8")),
+    maxQueue=int(os.getenv("TURN_DISPATCH_QUEUE_SIZE", "64")),
+)
+metrics.gauge("turns_in_flight", lambda: dispatcher.inFlight)
+metrics.gauge("turns_queued", dispatcher.queued)
+# Turns of one conversation run one at a time and in order
+conversationQueues = SerialQueues(dispatcher.submit)
+metrics.gauge("turns_waiting", lambda: len(conversationQueues))
 
-def invokeLlmService(agent, message):
-    """Invokes the LLM service using Dapr to generate a response using the selected agent's details."""
+# With several replicas, each only takes turns of the conversation partitions it holds a lease on
+partitionLeasesEnabled = os.getenv("CONVERSATION_PARTITION_LEASES_ENABLED", "false").lower() == "true"
+partitionLeases = PartitionLeases(
+    stateStore,
+    owner=os.getenv("REPLICA_ID", socket.gethostname()),
+    partitions=int(os.getenv("CONVERSATION_PARTITIONS", "64")),
+    leaseSeconds=float(os.getenv("CONVERSATION_PARTITION_LEASE_SECONDS", "30")),
+    # takeForwardedTurns is defined further down, resolve it lazily
+    onAcquired=lambda *args: takeForwardedTurns(*args),
+)
+# Turns of partitions held by another replica are left in the partition's inbox,
+# and the holder is told on its own topic to take them
+turnInbox = TurnInbox(stateStore, TurnCoalescer.supersedes)
+replicaTopic = f"{conversationsTopic}.{partitionLeases.owner}"
+# A turn that keeps missing its partition's holder (e.g. while leases move) goes to the dead-letter topic
+maxTurnForwards = int(os.getenv("CONVERSATION_MAX_FORWARDS", "3"))
+# A turn whose partition holder isn't known yet is offered again after this long
+forwardRetrySeconds = float(os.getenv("CONVERSATION_FORWARD_RETRY_SECONDS", "5"))
+metrics.gauge("partitions_owned", lambda: len(partitionLeases))
+
+# Each message starts the next turn, so conversations are paced to keep them from running flat out
+pacer = ConversationPacer(
+    turnsPerMinute=float(os.getenv("CONVERSATION_TURNS_PER_MINUTE", "12")),
+    burst=int(os.getenv("CONVERSATION_TURN_BURST", "3")),
+    minInterval=float(os.getenv("CONVERSATION_MIN_TURN_SECONDS", "2")),
+)
+# Turns per bootstrap message; the generator echoes the `turn` it was asked for in its message
+maxTurnsPerConversation = int(os.getenv("CONVERSATION_MAX_TURNS", "100"))
+# Turns that are paced hold their place on a timer instead of being dropped
+turnTimer = TurnTimer(lambda *args: submitTurn(*args), maxPending=int(os.getenv("TURN_DEFER_MAX_PENDING", "1024")))
+metrics.gauge("turns_deferred_pending", lambda: len(turnTimer))
+# Events that arrive while their conversation's turn is still pending only update its message
+turnCoalescer = TurnCoalescer(metrics)
+# Every turn waits at least this long, so bursts of events for a conversation collapse into one generation
+debounceSeconds = float(os.getenv("CONVERSATION_DEBOUNCE_SECONDS", "0.5"))
+metrics.gauge("turns_pending", lambda: len(turnCoalescer))
+# Turns the generator pushes back (429/503) wait this long if it doesn't say how long
+generatorRetryAfterSeconds = float(os.getenv("GENERATOR_RETRY_AFTER_SECONDS", "5"))
+
+# Turns can run as a durable workflow per conversation instead of being chained through pub/sub
+turnWorkflowEnabled = os.getenv("TURN_WORKFLOW_ENABLED", "false").lower() == "true"
+workflowRuntime = wf.WorkflowRuntime()
+turnWorkflow = TurnWorkflow(
+    pacer,
+    maxTurns=maxTurnsPerConversation,
+    debounceSeconds=debounceSeconds,
+    retryPolicy=wf.RetryPolicy(
+        first_retry_interval=timedelta(seconds=float(os.getenv("TURN_WORKFLOW_RETRY_SECONDS", "5"))),
+        max_number_of_attempts=int(os.getenv("TURN_WORKFLOW_GENERATE_ATTEMPTS", "3")),
+        backoff_coefficient=2,
+        max_retry_interval=timedelta(minutes=1),
+    ),
+    # More than one candidate fans each turn out to that many agents; the first acceptable reply wins
+    candidates=int(os.getenv("TURN_FANOUT_CANDIDATES", "1")),
+    concurrency=int(os.getenv("TURN_FANOUT_CONCURRENCY", "0")),
+    minReplyChars=int(os.getenv("TURN_FANOUT_MIN_REPLY_CHARS", "20")),
+    maxReplyChars=int(os.getenv("TURN_FANOUT_MAX_REPLY_CHARS", "0")),
+    agentAttempts=turnAgentAttempts,
+)
+# (workflow id, agent id) of the speakers reserved by select_agent(s), until their generation ends
+workflowSpeakers = set()
+
+
+def agentKey(agentId):
+    return f"dialogue-orchestrator:agent_{agentId}"  # Changed '||' to ':'
+
+
+def saveAgentsToState(agents):
+    """Saves a batch of agents with one bulk write, removing those out of tea; returns the ids that failed."""
+    values = {
+        agentKey(agentId): json.dumps(agent) if agent["tea_amount_ml"] > 0 else None
+        for agentId, agent in agents.items()
+    }
+    with daprPool.client() as client:
+        failed = agentIndex.saveMany(client, values)
+    for agentId, agent in agents.items():
+        if agent["tea_amount_ml"] <= 0 and agentKey(agentId) not in failed:
+            logging.info("Agent %s removed from state due to zero tea amount", agent.get("name", agentId))
+    return {agentId for agentId in agents if agentKey(agentId) in failed}
+
+
+def loadAgentRegistry():
+    """Rebuilds the agent registry from the state store with one bulk read."""
+    version = agentRegistry.version
+    with daprPool.client() as client:
+        agent_keys = agentIndex.keys(client)
+        items = client.get_bulk_state(stateStore, agent_keys).items if agent_keys else []
+        teaBalances.load(client)
+
+    agents = []
+    for item in items:
+        if not item.data:
+            continue
+        try:
+            agents.append(teaBalances.overlay(json.loads(item.data)))
+        except json.JSONDecodeError as e:
+            logging.error("Failed to decode agent data for key %s: %s", item.key, e)
+    agentRegistry.load(agents, version)
+    metrics.inc("agent_registry_loads")
+    logging.info("Loaded %d agents into the registry.", len(agentRegistry))
+
+
+def initializeAgents():
+    """Loads the registry, migrating the legacy key list, and creates missing index shards."""
+    loadAgentRegistry()
+    with daprPool.client() as client:
+        agentIndex.ensureShards(client)
+
+
+def refreshAgentRegistry():
+    while True:
+        time.sleep(agentRegistryRefreshSeconds)
+        try:
+            loadAgentRegistry()
+        except Exception as e:
+            logging.error("Failed to refresh the agent registry: %s", e)
+
+
+@functools.cache
+def actorProxyFactory():
+    # Created on first use, as it waits for the sidecar to be healthy
+    return ActorProxyFactory()
+
+
+def snapshotTeaBalances():
+    while True:
+        time.sleep(teaSnapshotSeconds)
+        flushTeaBalances()
+
+
+def flushTeaBalances():
+    try:
+        with daprPool.client() as client:
+            metrics.inc("tea_snapshot_writes", teaBalances.flush(client))
+    except Exception as e:
+        logging.error("Failed to snapshot tea balances: %s", e)
+
+
+def callAgentActor(agentId, method, data):
+    proxy = actorProxyFactory().create(agentActorType, ActorId(agentId))
+    # Subscribers run on plain threads, so each call gets its own short-lived event loop
+    return json.loads(asyncio.run(proxy.invoke_method(method, json.dumps(data).encode())))
+
+
+def chooseAgentExcluding(conversationName, excludeIds=()):
+    """Reserves the next speaker, ensuring it is not the author of the conversation; release it after the turn."""
+    chosen_agent = agentRegistry.choose(excludeName=conversationName, timeout=agentWaitSeconds, excludeIds=excludeIds)
+    if chosen_agent is None:
+        logging.info("No valid agents available.")
+        return None
+    logging.info("Selected agent %s for response.", chosen_agent["name"])
+    return chosen_agent
+
+
+class GeneratorBusy(Exception):
+    """The generator's admission control turned the request away (429/503); try again after `retryAfter` seconds."""
+
+    def __init__(self, statusCode, retryAfter):
+        super().__init__(f"Generator returned {statusCode}, retry after {retryAfter}s")
+        self.retryAfter = retryAfter
+
+
+class AgentExhausted(Exception):
+    """The generator turned the agent away as it has no tea left (402); another agent has to speak."""
+
+
+def exhaustAgent(agent):
+    """Withdraws an agent without tea from the registry, until a tea update brings it back."""
+    logging.info("Agent %s has no tea left, choosing another speaker.", agent["name"])
+    metrics.inc("agents_exhausted")
+    agentRegistry.upsert(dict(agent, tea_amount_ml=0))
+
+
+def generatorError(statusCode, body, headers=None):
+    if statusCode == 402:
+        return AgentExhausted(f"Generator returned {statusCode}: {body}")
+    if statusCode not in (429, 503):
+        return RuntimeError(f"Generator returned {statusCode}: {body}")
+    # The HTTP invoker raises without the response headers, so the generator repeats Retry-After in the body
+    retryAfter = dict(headers or {}).get("Retry-After")
+    if retryAfter is None:
+        try:
+            retryAfter = json.loads(body).get("retry_after")
+        except (TypeError, ValueError, AttributeError):
+            pass
+    try:
+        retryAfter = float(retryAfter)
+    except (TypeError, ValueError):
+        retryAfter = generatorRetryAfterSeconds
+    return GeneratorBusy(statusCode, retryAfter)
+
+
+def callGenerator(method, data):
+    """Invokes a generator method and returns its JSON response; raises if the call fails."""
+    try:
+        with daprPool.client() as d:
+            resp = d.invoke_method(
+                app_id="dialogue-generator",  # This must match the dapr app-id of the service you're invoking
+                method_name=method,
+                http_verb="POST",
+                data=json.dumps(data),
+                content_type="application/json",  # Set the content type here
+            )
+    except DaprHttpError as e:
+        raise generatorError(e.status_code, e.as_dict()["raw_response_bytes"]) from e
+    if resp.status_code and resp.status_code >= 400:
+        raise generatorError(resp.status_code, resp.text(), resp.headers)
+    return json.loads(resp.text())
+
+
+def requestGeneration(agent, message, conversationId=defaultConversationId, turn=1, publish=True, **fields):
+    """Has the generator answer as `agent` and returns its response; raises if the call fails."""
     requestData = {
         "agent": {
             "id": agent["id"],
@@ -110,43 +315,546 @@ def invokeLlmService(agent, message):
             "tea_amount_ml": agent["tea_amount_ml"],
         },
         "message": message,
+        "conversation_id": conversationId,
+        "turn": turn,
+        "publish": publish,
+        **fields,
     }
-    with DaprClient() as d:
+    response = callGenerator("generate", requestData)
+    logging.info("Response from LLM service: %s", response)
+    return response
+
+
+def invokeLlmService(agent, message, conversationId=defaultConversationId, turn=1):
+    """Invokes the LLM service using Dapr to generate a response using the selected agent's details."""
+    try:
+        requestGeneration(agent, message, conversationId, turn)
+    except (GeneratorBusy, AgentExhausted):
+        raise
+    except Exception as e:
+        metrics.inc("turns_failed")
+        logging.error(f"Failed to invoke LLM service: {str(e)}")
+
+
+def applyTeaDelta(delta):
+    """Updates an agent's tea in memory; returns False if a newer balance already arrived."""
+    metrics.inc("tea_deltas")
+    if not teaBalances.apply(delta["id"], delta["tea_amount_ml"], delta.get("version")):
+        return False
+    agent = agentRegistry.get(delta["id"])
+    if agent is not None:
+        agentRegistry.upsert(dict(agent, tea_amount_ml=delta["tea_amount_ml"]))
+    return True
+
+
+def applyAgentEvents(events):
+    """Applies a batch of agent events with one state write; returns a status per event.
+
+    Tea deltas only touch the state store when the agent runs dry. Of
+    several events for one agent, the last one is written.
+    """
+    statuses = [TopicEventResponse("success") for _ in events]
+    writes, entries = {}, {}
+    for i, event in enumerate(events):
         try:
-            resp = d.invoke_method(
-                app_id="dialogue-generator",  # This must match the dapr app-id of the service you're invoking
-                method_name="generate",
-                http_verb="POST",
-                data=json.dumps(requestData),
-                content_type="application/json",  # Set the content type here
-            )
-            logging.info("Response from LLM service: %s", resp.text())
+            agentData = json.loads(event.Data())
+        except json.JSONDecodeError as e:
+            logging.error("Dropping undecodable agent event: %s", e)
+            statuses[i] = TopicEventResponse("drop")
+            continue
+        try:
+            if agentData.get("type") == "tea_delta":
+                if not applyTeaDelta(agentData) or agentData["tea_amount_ml"] > 0:
+                    continue
+                agentData = {"id": agentData["id"], "tea_amount_ml": 0}
+            else:
+                if agentActorsEnabled and "version" not in agentData:
+                    # Agents created or topped up by the user interface are registered with their actor;
+                    # events carrying a version already come from it
+                    agentData = callAgentActor(agentData["id"], "Register", agentData)
+                teaBalances.apply(agentData["id"], agentData["tea_amount_ml"], agentData.get("version"))
+                agentRegistry.upsert(agentData)
         except Exception as e:
-            logging.error(f"Failed to invoke LLM service: {str(e)}")
+            logging.error("Failed to apply agent event: %s", e)
+            statuses[i] = TopicEventResponse("retry")
+            continue
+        writes[agentData["id"]] = agentData
+        entries.setdefault(agentData["id"], []).append(i)
+    if writes:
+        for agentId in saveAgentsToState(writes):
+            for i in entries[agentId]:
+                statuses[i] = TopicEventResponse("retry")
+    metrics.observe("agent_batch_size", len(events))
+    return statuses
+
+
+agentEventBatcher = MicroBatcher(applyAgentEvents, maxBatch=subscriberBatchSize, maxWait=subscriberBatchWaitSeconds)
 
 
 @app.subscribe(pubsub_name=pubsubName, topic=agentsTopic)
 def agentsSubscriber(event: v1.Event):
     """Subscriber for agent events. Updates the state store based on agent's tea amount."""
-    agentData = json.loads(event.Data())
-    saveAgentToState(agentData)
+    return agentEventBatcher.submit(event)
 
 
-@app.subscribe(pubsub_name=pubsubName, topic=conversationsTopic)
-def conversationsSubscriber(event: v1.Event):
-    logging.info("Received conversation event.")
-    conversationData = json.loads(event.Data())
-    logging.info("Conversation data: %s", conversationData)
-    if "name" in conversationData:
-        agent = chooseAgentExcluding(conversationData["name"])
-        if agent is not None:
-            invokeLlmService(agent, conversationData["message"])
-        else:
+def takeTurn(conversationData):
+    """Chooses the next speaker and has the generator answer; runs on a dispatcher worker."""
+    startedAt = time.monotonic()
+    exhausted = []
+    while len(exhausted) < turnAgentAttempts:
+        agent = chooseAgentExcluding(conversationData["name"], exhausted)
+        if agent is None:
             logging.info("No agent selected.")
+            return
+        try:
+            invokeLlmService(
+                agent,
+                conversationData["message"],
+                conversationData.get("conversation_id", defaultConversationId),
+                conversationData.get("turn", 0) + 1,
+            )
+        except AgentExhausted:
+            exhaustAgent(agent)
+            exhausted.append(agent["id"])
+            continue
+        except GeneratorBusy as e:
+            retryTurnLater(conversationData, e.retryAfter, "backpressured")
+        finally:
+            agentRegistry.release(agent["id"])
+        break
     else:
+        logging.warning("Giving up a turn after %d agents without tea.", len(exhausted))
+        metrics.inc("turns_failed")
+    metrics.observe("turn_seconds", time.monotonic() - startedAt)
+
+
+def retryTurnLater(conversationData, delay, reason):
+    """Books a turn that couldn't be taken now again, on the turn timer after `delay` seconds.
+
+    `reason` names the counter, e.g. "backpressured" for a turn the generator pushed back.
+    """
+    conversationId = conversationData.get("conversation_id", defaultConversationId)
+    metrics.inc(f"turns_{reason}")
+    logging.info("Retrying the turn of %s in %.1fs (%s).", conversationId, delay, reason)
+    # A newer event that arrived meanwhile is pending already and wins over this one
+    if not turnCoalescer.offer(
+        conversationId, conversationData, lambda: turnTimer.schedule(delay, takePendingTurn, conversationId)
+    ):
+        logging.warning("Too many deferred turns, dropping a turn of %s.", conversationId)
+        metrics.inc("turns_failed")
+
+
+def takePendingTurn(conversationId):
+    conversationData = turnCoalescer.take(conversationId)
+    if conversationData is None:
+        return
+    # The partition may have moved while the turn waited on the pacer or in the queue
+    holder = conversationHolder(conversationId)
+    if holder == partitionLeases.owner:
+        takeTurn(conversationData)
+    elif not forwardTurn(holder, conversationData):
+        retryTurnLater(conversationData, forwardRetrySeconds, "forward_retried")
+
+
+@functools.cache
+def workflowClient():
+    # Created on first use, like the actor proxy factory
+    return wf.DaprWorkflowClient()
+
+
+@workflowRuntime.workflow(name=TurnWorkflow.name)
+def conversationWorkflow(ctx: wf.DaprWorkflowContext, state):
+    return turnWorkflow.run(ctx, state)
+
+
+def releaseWorkflowSpeaker(workflowId, agentId):
+    # Released once per reservation; retries run without it rather than release it twice
+    try:
+        workflowSpeakers.remove((workflowId, agentId))
+    except KeyError:
+        return
+    agentRegistry.release(agentId)
+
+
+@workflowRuntime.activity(name="select_agent")
+def selectAgentActivity(ctx: wf.WorkflowActivityContext, data):
+    agent = chooseAgentExcluding(data["exclude"], data.get("exclude_ids", ()))
+    if agent is not None:
+        workflowSpeakers.add((ctx.workflow_id, agent["id"]))
+    return agent
+
+
+@workflowRuntime.activity(name="select_agents")
+def selectAgentsActivity(ctx: wf.WorkflowActivityContext, data):
+    """Reserves up to `count` different speakers, only waiting for the first."""
+    agents = []
+    while len(agents) < data["count"]:
+        agent = agentRegistry.choose(excludeName=data["exclude"], timeout=0 if agents else agentWaitSeconds)
+        if agent is None:
+            break
+        if any(chosen["id"] == agent["id"] for chosen in agents):
+            # Agents allowed several generations at once come around again; there are no others left
+            agentRegistry.release(agent["id"])
+            break
+        workflowSpeakers.add((ctx.workflow_id, agent["id"]))
+        agents.append(agent)
+    logging.info("Selected %d candidate agents for response.", len(agents))
+    return agents
+
+
+@workflowRuntime.activity(name="generate")
+def generateActivity(ctx: wf.WorkflowActivityContext, data):
+    """Has the generator answer without publishing; a failure raises, so the workflow's retry policy applies.
+
+    An agent without tea isn't retried: the result says it is exhausted, and the workflow chooses another.
+    """
+    startedAt = time.monotonic()
+    try:
+        return requestGeneration(
+            data["agent"],
+            data["message"],
+            data["conversation_id"],
+            data["turn"],
+            publish=False,
+            generation_id=data.get("generation_id"),
+        )
+    except AgentExhausted:
+        exhaustAgent(data["agent"])
+        return {"exhausted": True}
+    except Exception:
+        metrics.inc("turns_failed")
+        raise
+    finally:
+        releaseWorkflowSpeaker(ctx.workflow_id, data["agent"]["id"])
+        metrics.observe("turn_seconds", time.monotonic() - startedAt)
+
+
+@workflowRuntime.activity(name="generate_candidate")
+def generateCandidateActivity(ctx: wf.WorkflowActivityContext, data):
+    """Has the generator answer without charging or persisting; the workflow accepts or releases the reply."""
+    try:
+        return requestGeneration(
+            data["agent"],
+            data["message"],
+            data["conversation_id"],
+            data["turn"],
+            publish=False,
+            candidate=True,
+            generation_id=data["generation_id"],
+        )
+    except AgentExhausted:
+        exhaustAgent(data["agent"])
+        metrics.inc("candidates_failed")
+        raise
+    except Exception:
+        metrics.inc("candidates_failed")
+        raise
+    finally:
+        releaseWorkflowSpeaker(ctx.workflow_id, data["agent"]["id"])
+
+
+@workflowRuntime.activity(name="accept_candidate")
+def acceptCandidateActivity(ctx: wf.WorkflowActivityContext, data):
+    """Charges the winning candidate's tea and persists its reply."""
+    metrics.inc("candidates_accepted")
+    return callGenerator("generate/accept", dict(data, publish=False))
+
+
+@workflowRuntime.activity(name="release_candidates")
+def releaseCandidatesActivity(ctx: wf.WorkflowActivityContext, reservations):
+    """Gives back the tea reserved by candidates that lost; one that can't be released expires."""
+    for reservation in reservations:
+        try:
+            callGenerator("generate/release", reservation)
+        except Exception as e:
+            logging.error("Failed to release candidate reservation %s: %s", reservation["reservation_id"], e)
+    metrics.inc("candidates_released", len(reservations))
+
+
+@workflowRuntime.activity(name="cancel_candidates")
+def cancelCandidatesActivity(ctx: wf.WorkflowActivityContext, generationIds):
+    """Asks the generator to stop candidates still generating; any it doesn't reach end at their deadline."""
+    try:
+        callGenerator("generate/cancel", {"generation_ids": generationIds})
+    except Exception as e:
+        logging.error("Failed to cancel candidate generations: %s", e)
+    metrics.inc("candidates_cancelled", len(generationIds))
+
+
+@workflowRuntime.activity(name="publish_message")
+def publishMessageActivity(ctx: wf.WorkflowActivityContext, messageData):
+    with daprPool.client() as client:
+        client.publish_event(
+            pubsubName,
+            conversationsTopic,
+            json.dumps(messageData),
+            publish_metadata={"partitionKey": messageData["conversation_id"]},
+        )
+
+
+def startConversationWorkflow(conversationId, conversationData):
+    """Starts the conversation's turn workflow, or hands the message to the one already running."""
+    client = workflowClient()
+    instanceId = TurnWorkflow.instanceId(conversationId)
+    try:
+        state = client.get_workflow_state(instanceId, fetch_payloads=False)
+        if state is not None and state.runtime_status in (
+            wf.WorkflowStatus.RUNNING,
+            wf.WorkflowStatus.PENDING,
+            wf.WorkflowStatus.SUSPENDED,
+        ):
+            client.raise_workflow_event(instanceId, "message", data=conversationData)
+            return True
+        if state is not None:
+            # A finished conversation starts over under the same instance id
+            client.purge_workflow(instanceId)
+        client.schedule_new_workflow(
+            workflow=conversationWorkflow,
+            input=TurnWorkflow.input(conversationId, conversationData),
+            instance_id=instanceId,
+        )
+        metrics.inc("turn_workflows_started")
+        return True
+    except Exception as e:
+        logging.error("Failed to start the turn workflow of conversation %s: %s", conversationId, e)
+        return False
+
+
+def submitTurn(job, conversationId):
+    return conversationQueues.run(conversationId, job, conversationId)
+
+
+def conversationHolder(conversationId):
+    """The replica that takes the conversation's turns: this one, unless partition leases are enabled; None if unknown."""
+    if not partitionLeasesEnabled:
+        return partitionLeases.owner
+    try:
+        with daprPool.client() as client:
+            return partitionLeases.holder(client, partitionLeases.partitionFor(conversationId))
+    except Exception as e:
+        logging.error("Failed to check the partition lease of conversation %s: %s", conversationId, e)
+        return None
+
+
+def offerTurn(conversationId, conversationData):
+    """Books the turn if this replica holds the conversation's partition, or forwards it to the holder."""
+    holder = conversationHolder(conversationId)
+    if holder == partitionLeases.owner:
+        return turnCoalescer.offer(conversationId, conversationData, lambda: scheduleTurn(conversationId))
+    # Redelivery would bring the event back to this replica; the holder gets it on its own topic instead
+    return forwardTurn(holder, conversationData)
+
+
+def forwardTurn(holder, conversationData):
+    """Leaves a turn in its partition's inbox and tells the holder; False if that failed or the holder isn't known.
+
+    A turn that was forwarded `maxTurnForwards` times already goes to the dead-letter topic instead.
+    """
+    if holder is None:
+        return False
+    conversationId = conversationData.get("conversation_id", defaultConversationId)
+    forwards = conversationData.get("forwards", 0)
+    if forwards >= maxTurnForwards:
+        return deadLetterTurn(conversationData)
+    partition = partitionLeases.partitionFor(conversationId)
+    topic = f"{conversationsTopic}.{holder}"
+    try:
+        with daprPool.client() as client:
+            turnInbox.put(client, partition, conversationId, dict(conversationData, forwards=forwards + 1))
+            client.publish_event(pubsubName, topic, json.dumps({"partition": partition}))
+    except Exception as e:
+        logging.error("Failed to forward a turn to %s: %s", topic, e)
+        return False
+    metrics.inc("turns_redirected")
+    return True
+
+
+def deadLetterTurn(conversationData):
+    """Moves a turn that keeps missing its partition's holder to the dead-letter topic; False if that failed."""
+    conversationId = conversationData.get("conversation_id", defaultConversationId)
+    logging.warning(
+        "Turn of conversation %s missed its partition's holder %d times, moving it to %s.",
+        conversationId,
+        conversationData.get("forwards", 0),
+        conversationsDeadLetterTopic,
+    )
+    try:
+        with daprPool.client() as client:
+            client.publish_event(
+                pubsubName,
+                conversationsDeadLetterTopic,
+                json.dumps(conversationData),
+                publish_metadata={"partitionKey": conversationId},
+            )
+    except Exception as e:
+        logging.error("Failed to dead-letter a turn of conversation %s: %s", conversationId, e)
+        return False
+    metrics.inc("turns_dead_lettered")
+    return True
+
+
+def takeForwardedTurns(client, partition):
+    """Offers the turns other replicas left in the partition's inbox; False if some have to wait there."""
+    waiting = False
+    for conversationId, conversationData in turnInbox.take(client, partition).items():
+        if not offerTurn(conversationId, conversationData):
+            # Back into the inbox, for the next notice or the next holder
+            turnInbox.put(client, partition, conversationId, conversationData)
+            waiting = True
+    return not waiting
+
+
+def scheduleTurn(conversationId):
+    """Books the conversation's next turn with the pacer and queues it; False if there is no room."""
+    delay = max(pacer.reserve(conversationId), debounceSeconds)
+    if delay > 0:
+        if not turnTimer.schedule(delay, takePendingTurn, conversationId):
+            logging.warning("Too many deferred turns, asking for redelivery.")
+            return False
+        logging.info("Deferring the next turn by %.1fs.", delay)
+        metrics.inc("turns_deferred")
+        return True
+    if not submitTurn(takePendingTurn, conversationId):
+        # Every worker is busy and the queue is full: let the sidecar redeliver later
+        logging.warning("Turn queue is full, asking for redelivery.")
+        return False
+    return True
+
+
+def parseConversationEvent(event):
+    """Returns the event's status and, if it should start a turn, its data."""
+    try:
+        conversationData = json.loads(event.Data())
+    except json.JSONDecodeError as e:
+        logging.error("Dropping undecodable conversation event: %s", e)
+        return TopicEventResponse("drop"), None
+    logging.info("Conversation data: %s", conversationData)
+    if conversationData.get("type") == "partial":
+        # Only completed messages start a new turn
+        logging.info("Ignoring partial conversation event.")
+        return TopicEventResponse("success"), None
+    if "name" not in conversationData:
         logging.error("Name key not found in conversation data.")
+        return TopicEventResponse("drop"), None
+    turn = conversationData.get("turn", 0)
+    if maxTurnsPerConversation > 0 and turn >= maxTurnsPerConversation:
+        logging.info("Conversation reached %d turns, not answering.", turn)
+        metrics.inc("turns_capped")
+        return TopicEventResponse("success"), None
+    return TopicEventResponse("success"), conversationData
+
+
+def startTurns(events):
+    """Offers one turn per conversation of a batch, with its newest event; returns a status per event."""
+    statuses = []
+    conversations = {}
+    for i, event in enumerate(events):
+        status, conversationData = parseConversationEvent(event)
+        statuses.append(status)
+        if conversationData is None:
+            continue
+        if turnWorkflowEnabled and "workflow_instance_id" in conversationData:
+            # Published by a turn workflow, which takes the next turn itself
+            continue
+        conversationId = conversationData.get("conversation_id", defaultConversationId)
+        entries, newest = conversations.get(conversationId, ([], None))
+        if newest is not None:
+            metrics.inc("generations_saved")
+            if not TurnCoalescer.supersedes(conversationData, newest):
+                conversationData = newest
+        conversations[conversationId] = (entries + [i], conversationData)
+    for conversationId, (entries, conversationData) in conversations.items():
+        if turnWorkflowEnabled:
+            # The workflow runtime runs each instance on one replica, whichever raises its events
+            accepted = startConversationWorkflow(conversationId, conversationData)
+        else:
+            accepted = offerTurn(conversationId, conversationData)
+        if not accepted:
+            for i in entries:
+                statuses[i] = TopicEventResponse("retry")
+    metrics.observe("conversation_batch_size", len(events))
+    return statuses
+
+
+conversationEventBatcher = MicroBatcher(startTurns, maxBatch=subscriberBatchSize, maxWait=subscriberBatchWaitSeconds)
+
+
+@app.subscribe(
+    pubsub_name=pubsubName,
+    topic=conversationsTopic,
+    dead_letter_topic=conversationsDeadLetterTopic,
+)
+def conversationsSubscriber(event: v1.Event):
+    logging.info("Received conversation event.")
+    return conversationEventBatcher.submit(event)
+
+
+if partitionLeasesEnabled:
+
+    @app.subscribe(pubsub_name=pubsubName, topic=replicaTopic, dead_letter_topic=conversationsDeadLetterTopic)
+    def replicaSubscriber(event: v1.Event):
+        """Notices from other replicas that they left turns in the inbox of a partition this one held."""
+        try:
+            partition = json.loads(event.Data())["partition"]
+        except (json.JSONDecodeError, KeyError, TypeError) as e:
+            logging.error("Dropping undecodable inbox notice: %s", e)
+            return TopicEventResponse("drop")
+        try:
+            with daprPool.client() as client:
+                # Turns of a partition that moved on are forwarded again from here
+                taken = takeForwardedTurns(client, partition)
+        except Exception as e:
+            logging.error("Failed to take the turns of conversation partition %d: %s", partition, e)
+            taken = False
+        return TopicEventResponse("success" if taken else "retry")
+
+
+def republishDeferredTurns(pending):
+    """Hands turns that were still waiting on the timer back to the topic, for the next replica to pace."""
+    with daprPool.client() as client:
+        for _, (conversationId,) in pending:
+            conversationData = turnCoalescer.take(conversationId)
+            if conversationData is None:
+                continue
+            try:
+                client.publish_event(
+                    pubsubName,
+                    conversationsTopic,
+                    json.dumps(conversationData),
+                    publish_metadata={"partitionKey": conversationId},
+                )
+            except Exception as e:
+                logging.error("Failed to republish a deferred turn: %s", e)
+
+
+@app.method("metrics")
+def getMetrics(request):
+    """Returns the orchestrator metrics, e.g. `dapr invoke --app-id dialogue-orchestrator --method metrics`."""
+    daprPool.checkHealth()
+    return json.dumps(metrics.snapshot())
 
 
 if __name__ == "__main__":
-    app.run(5300)
+    daprPool.start()
+    initializeAgents()
+    dispatcher.start()
+    turnTimer.start()
+    if agentRegistryRefreshSeconds > 0:
+        threading.Thread(target=refreshAgentRegistry, daemon=True).start()
+    if teaSnapshotSeconds > 0:
+        threading.Thread(target=snapshotTeaBalances, daemon=True).start()
+    if turnWorkflowEnabled:
+        workflowRuntime.start()
+    try:
+        app.run(5300)
+    finally:
+        if turnWorkflowEnabled:
+            workflowRuntime.shutdown()
+        republishDeferredTurns(turnTimer.stop(timeout=5))
+        dispatcher.stop(timeout=30)
+        if partitionLeasesEnabled:
+            with daprPool.client() as client:
+                partitionLeases.release(client)
+        flushTeaBalances()
+        daprPool.close()
 
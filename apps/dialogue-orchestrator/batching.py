@@ -0,0 +1,66 @@
+import threading
+
+
+class Batch:
+    def __init__(self):
+        self.items = []
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """Handles events delivered on concurrent subscriber threads in batches.
+
+    `submit` adds the event to the open batch, and the thread that opened it
+    calls `handle` with all of its events while the other threads wait for
+    it. A batch is handled right away when no other batch is being handled,
+    so a lone event isn't delayed; while one is, events gather in the next
+    batch for up to `maxWait` seconds or until `maxBatch` arrived, which is
+    what turns a backlog into large batches. `handle` returns one result per
+    event, so every event gets its own status.
+    """
+
+    def __init__(self, handle, maxBatch=32, maxWait=0.005):
+        self.handle = handle
+        self.maxBatch = maxBatch
+        self.maxWait = maxWait
+        self.condition = threading.Condition()
+        self.open = None
+        self.handling = 0
+
+    def submit(self, item):
+        if self.maxBatch <= 1 or self.maxWait <= 0:
+            return self.handle([item])[0]
+        with self.condition:
+            batch = self.open
+            leader = batch is None
+            if leader:
+                batch = self.open = Batch()
+            index = len(batch.items)
+            batch.items.append(item)
+            if len(batch.items) >= self.maxBatch:
+                # Full: the leader stops waiting, later events open a new batch
+                self.open = None
+                self.condition.notify_all()
+            elif leader:
+                self.condition.wait_for(lambda: self.open is not batch or not self.handling, self.maxWait)
+                if self.open is batch:
+                    self.open = None
+            if leader:
+                self.handling += 1
+        if leader:
+            try:
+                batch.results = self.handle(batch.items)
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+                with self.condition:
+                    self.handling -= 1
+                    self.condition.notify_all()
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[index]
@@ -0,0 +1,76 @@
+import itertools
+import logging
+import threading
+from contextlib import contextmanager
+
+from dapr.clients import DaprClient
+
+
+class DaprClientPool:
+    """Fixed set of long-lived Dapr clients shared by the subscriber threads.
+
+    Clients are created once when the app starts and lent out round-robin.
+    gRPC channels are thread-safe, so several threads may use the same client;
+    the pool only exists to spread load over a few channels and to make sure
+    they are opened once and closed on shutdown.
+    """
+
+    def __init__(self, size=4, clientFactory=DaprClient):
+        self.size = size
+        self.clientFactory = clientFactory
+        self.clients = []
+        self.cycle = None
+        self.lock = threading.Lock()
+        self.inUse = 0
+        self.checkouts = 0
+        self.healthy = False
+
+    def start(self):
+        with self.lock:
+            if self.clients:
+                return
+            self.clients = [self.clientFactory() for _ in range(self.size)]
+            self.cycle = itertools.cycle(self.clients)
+            self.healthy = True
+        logging.info("Started Dapr client pool with %d channels", self.size)
+
+    def close(self):
+        with self.lock:
+            for client in self.clients:
+                client.close()
+            self.clients = []
+            self.healthy = False
+        logging.info("Closed Dapr client pool")
+
+    @contextmanager
+    def client(self):
+        """Lends a pooled client; it is returned to the pool, not closed, on exit."""
+        with self.lock:
+            if not self.clients:
+                raise RuntimeError("Dapr client pool is not started")
+            client = next(self.cycle)
+            self.inUse += 1
+            self.checkouts += 1
+        try:
+            yield client
+        finally:
+            with self.lock:
+                self.inUse -= 1
+
+    def checkHealth(self):
+        try:
+            with self.client() as client:
+                client.get_metadata()
+            self.healthy = True
+        except Exception as e:
+            logging.warning("Dapr sidecar health check failed: %s", e)
+            self.healthy = False
+        return self.healthy
+
+    def metrics(self):
+        return {
+            "size": len(self.clients),
+            "in_use": self.inUse,
+            "checkouts": self.checkouts,
+            "healthy": self.healthy,
+        }
@@ -0,0 +1,66 @@
+import logging
+import queue
+import threading
+
+
+class TurnDispatcher:
+    """Bounded worker pool that runs generation jobs off the subscriber threads.
+
+    The gRPC app serves subscriptions from a small thread pool, so calling
+    the generator from the subscriber capped throughput at that pool size
+    times the LLM latency. Subscribers now only enqueue a job and
+    acknowledge the event; `workers` threads run the jobs. The queue holds
+    at most `maxQueue` jobs, and `submit` returns False when it is full so
+    the subscriber can ask the sidecar to redeliver the event later.
+    """
+
+    def __init__(self, metrics, workers=8, maxQueue=64):
+        self.metrics = metrics
+        self.workers = workers
+        self.jobs = queue.Queue(maxsize=maxQueue)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.inFlight = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.run, name=f"turn-dispatcher-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logging.info("Started turn dispatcher with %d workers", self.workers)
+
+    def stop(self, timeout=None):
+        """Lets the workers finish the queued jobs, then stops them."""
+        for _ in self.threads:
+            self.jobs.put((None, ()))
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def submit(self, job, *args):
+        try:
+            self.jobs.put_nowait((job, args))
+        except queue.Full:
+            self.metrics.inc("dispatch_rejected")
+            return False
+        self.metrics.inc("dispatch_enqueued")
+        return True
+
+    def queued(self):
+        return self.jobs.qsize()
+
+    def run(self):
+        while True:
+            job, args = self.jobs.get()
+            if job is None:
+                return
+            with self.lock:
+                self.inFlight += 1
+            try:
+                job(*args)
+            except Exception as e:
+                self.metrics.inc("dispatch_failed")
+                logging.exception("Dispatched job failed: %s", e)
+            finally:
+                with self.lock:
+                    self.inFlight -= 1
@@ -0,0 +1,54 @@
+class TeaLedger:
+    """An agent's tea balance, folded from an append-only list of entries.
+
+    Entries are never changed once appended:
+
+    - `set`: the balance was set to `ml`, e.g. when the agent was registered
+    - `reserve`: `ml` is held for generation `reservation_id` until `expires_at`
+    - `commit`: the reservation ended and `used_ml` of it was spent
+    - `expire`: the reservation ended without being committed
+
+    A snapshot holds the balance and open reservations after a given entry,
+    so only the entries appended since then need replaying. Every entry
+    bumps `seq`, which doubles as the agent's version.
+    """
+
+    def __init__(self, snapshot=None):
+        snapshot = snapshot or {}
+        self.seq = snapshot.get("seq", 0)
+        self.balance = snapshot.get("balance_ml", 0)
+        self.holds = dict(snapshot.get("holds", {}))
+
+    def snapshot(self):
+        return {"seq": self.seq, "balance_ml": self.balance, "holds": dict(self.holds)}
+
+    def held(self):
+        return sum(hold["ml"] for hold in self.holds.values())
+
+    def available(self):
+        return max(self.balance - self.held(), 0)
+
+    def entry(self, op, **fields):
+        """Returns the next entry without applying it."""
+        return dict(fields, seq=self.seq + 1, op=op)
+
+    def apply(self, entry):
+        if entry["seq"] <= self.seq:
+            # Already folded into the snapshot
+            return
+        op = entry["op"]
+        if op == "set":
+            self.balance = entry["ml"]
+        elif op == "reserve":
+            self.holds[entry["reservation_id"]] = {"ml": entry["ml"], "expires_at": entry["expires_at"]}
+        elif op == "commit":
+            self.holds.pop(entry["reservation_id"], None)
+            self.balance -= entry["used_ml"]
+        elif op == "expire":
+            self.holds.pop(entry["reservation_id"], None)
+        else:
+            raise ValueError(f"Unknown ledger operation {op!r}")
+        self.seq = entry["seq"]
+
+    def expired(self, now):
+        return [reservationId for reservationId, hold in self.holds.items() if hold["expires_at"] <= now]
@@ -0,0 +1,173 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+class ConversationPacer:
+    """Spaces out the turns of each conversation.
+
+    Each conversation gets a token bucket of `turnsPerMinute` turns with
+    room for `burst` back-to-back turns, and consecutive turns start at
+    least `minInterval` seconds apart.
+
+    `reserve` books the next free slot and returns how many seconds to wait
+    for it, so a deferred turn keeps its place instead of competing again.
+    The bucket is kept as the time it becomes empty (GCRA), so a
+    reservation is O(1) and conversations that went quiet are forgotten.
+    """
+
+    def __init__(self, turnsPerMinute=0, burst=1, minInterval=0, clock=time.monotonic):
+        self.interval = 60 / turnsPerMinute if turnsPerMinute > 0 else 0
+        self.tolerance = self.interval * max(burst - 1, 0)
+        self.minInterval = minInterval
+        self.clock = clock
+        self.lock = threading.Lock()
+        # conversationId -> (time the bucket is empty, start of the last turn), least recently used first
+        self.conversations = OrderedDict()
+
+    def reserve(self, conversationId):
+        now = self.clock()
+        with self.lock:
+            emptyAt, lastStart = self.conversations.pop(conversationId, (now, None))
+            start, emptyAt = self.slot(now, emptyAt, lastStart)
+            self.conversations[conversationId] = (emptyAt, start)
+            self.forgetIdle(now)
+            return start - now
+
+    def slot(self, now, emptyAt=None, lastStart=None):
+        """Returns when a turn asked for at `now` starts, and when the bucket is empty after it.
+
+        Keeps nothing, for callers that store the bucket themselves, like the turn workflow.
+        """
+        emptyAt = now if emptyAt is None else emptyAt
+        start = max(now, emptyAt - self.tolerance)
+        if lastStart is not None:
+            start = max(start, lastStart + self.minInterval)
+        return start, max(emptyAt, start) + self.interval
+
+    def forgetIdle(self, now):
+        # A conversation whose bucket refilled and whose last turn is long past paces like a new one
+        while self.conversations:
+            conversationId, (emptyAt, lastStart) = next(iter(self.conversations.items()))
+            if emptyAt > now or lastStart + self.minInterval > now:
+                return
+            del self.conversations[conversationId]
+
+
+class TurnTimer:
+    """Runs deferred turns once they are due, on a single thread.
+
+    Due jobs are handed to `submit` (the turn dispatcher's); when it is
+    full they are tried again `retryDelay` seconds later. At most `maxPending`
+    jobs wait at a time, so `schedule` returns False rather than buffer an
+    unbounded backlog in memory.
+    """
+
+    def __init__(self, submit, maxPending=1024, retryDelay=1.0, clock=time.monotonic):
+        self.submit = submit
+        self.maxPending = maxPending
+        self.retryDelay = retryDelay
+        self.clock = clock
+        self.jobs = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="turn-timer", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """Stops the timer and returns the `(job, args)` pairs that never ran, earliest first."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread:
+            self.thread.join(timeout)
+        with self.condition:
+            pending = [(job, args) for _, _, job, args in sorted(self.jobs)]
+            self.jobs = []
+        return pending
+
+    def schedule(self, delay, job, *args):
+        with self.condition:
+            if len(self.jobs) >= self.maxPending:
+                return False
+            heapq.heappush(self.jobs, (self.clock() + delay, next(self.sequence), job, args))
+            self.condition.notify()
+            return True
+
+    def run(self):
+        with self.condition:
+            while not self.stopped:
+                if not self.jobs:
+                    self.condition.wait()
+                    continue
+                dueAt, sequence, job, args = self.jobs[0]
+                wait = dueAt - self.clock()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                heapq.heappop(self.jobs)
+                if not self.submit(job, *args):
+                    logging.info("Turn queue is full, deferring a due turn by %.1fs", self.retryDelay)
+                    heapq.heappush(self.jobs, (self.clock() + self.retryDelay, sequence, job, args))
+
+
+class TurnCoalescer:
+    """Keeps at most one pending turn per conversation.
+
+    Redeliveries, retries and a bootstrap racing agent replies can bring
+    several events for one conversation in quick succession, of which only
+    the newest message matters. The first event schedules a turn; events arriving before a worker
+    starts it only replace its message, keeping the one furthest into the
+    conversation, and count as saved generations. An event without a
+    `turn`, such as a user's bootstrap, restarts the conversation and
+    always replaces the pending message.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    @staticmethod
+    def supersedes(conversationData, pending):
+        """Whether `conversationData` replaces the `pending` message of the same conversation."""
+        if "turn" not in conversationData:
+            return True
+        return conversationData["turn"] >= pending.get("turn", 0)
+
+    def offer(self, conversationId, conversationData, schedule):
+        """Merges the event into the pending turn, or calls `schedule()` to start a new one.
+
+        Returns False if `schedule()` did, in which case nothing is pending.
+        """
+        with self.lock:
+            pending = self.pending.get(conversationId)
+            if pending is not None:
+                if self.supersedes(conversationData, pending):
+                    self.pending[conversationId] = conversationData
+                self.metrics.inc("generations_saved")
+                return True
+            self.pending[conversationId] = conversationData
+            # Scheduled under the lock, so no event can merge into a turn that is then rejected
+            if not schedule():
+                del self.pending[conversationId]
+                return False
+            return True
+
+    def take(self, conversationId):
+        """Returns the newest event of the conversation's pending turn; later events start a new one."""
+        with self.lock:
+            return self.pending.pop(conversationId, None)
@@ -0,0 +1,237 @@
+import json
+import logging
+import threading
+import time
+import zlib
+from collections import deque
+
+from dapr.clients.grpc._state import Concurrency, StateOptions
+
+
+class PartitionLeases:
+    """Which replica takes the turns of each conversation partition, leased through the state store.
+
+    Conversations are hashed into `partitions` partitions, and their events
+    are published with the conversation id as partition key, so brokers that
+    partition topics deliver a conversation to one replica. Others (e.g.
+    redis streams) ignore the key, and even partitioned brokers move
+    partitions, so a replica only takes turns of partitions whose lease it
+    holds and hands the others to their holder.
+
+    A lease is a `{"owner", "expires_at"}` record, written with the etag of
+    the one it replaces (or as a first write), so only one replica can take
+    or renew it. The holder renews it once half of `leaseSeconds` has
+    passed, well before it expires; others take it only once it has expired,
+    so a replica that stops renewing (or crashes) loses its partitions.
+    Expiry is compared across replicas, so their clocks must agree to well
+    within `leaseSeconds`. `onAcquired(client, partition)` is called when
+    this replica takes a partition it didn't hold.
+    """
+
+    def __init__(self, storeName, owner, partitions=64, leaseSeconds=30, clock=time.time, onAcquired=None):
+        self.storeName = storeName
+        self.owner = owner
+        self.partitions = partitions
+        self.leaseSeconds = leaseSeconds
+        self.clock = clock
+        self.onAcquired = onAcquired
+        # Only guards the two dicts below; the state store is never called under it
+        self.lock = threading.Lock()
+        # partition -> (holder, when its lease expires, when to read or renew it again)
+        self.leases = {}
+        # partitions whose lease a thread is reading or writing right now
+        self.checking = set()
+
+    def __len__(self):
+        now = self.clock()
+        with self.lock:
+            return sum(1 for holder, expiresAt, _ in self.leases.values() if holder == self.owner and expiresAt > now)
+
+    def partitionFor(self, conversationId):
+        return zlib.crc32(conversationId.encode()) % self.partitions
+
+    def key(self, partition):
+        return f"conversation_partition:{partition}"
+
+    def owns(self, client, partition):
+        return self.holder(client, partition) == self.owner
+
+    def holder(self, client, partition):
+        """Returns the replica holding the partition's lease, taking or renewing it for this one if it can.
+
+        Returns None if the holder isn't known, e.g. the state store is
+        unreachable or another replica won the race for a free lease.
+        """
+        now = self.clock()
+        with self.lock:
+            lease = self.leases.get(partition)
+            if lease is not None:
+                holder, expiresAt, checkAt = lease
+                if now < checkAt:
+                    return holder
+                if partition in self.checking:
+                    # Another thread is renewing it; the lease holds until it expires
+                    return holder if now < expiresAt else None
+            self.checking.add(partition)
+        try:
+            lease = self.acquire(client, partition, now)
+        finally:
+            with self.lock:
+                self.checking.discard(partition)
+        with self.lock:
+            previous = self.leases.pop(partition, None)
+            if lease is not None:
+                self.leases[partition] = lease
+        held = previous is not None and previous[0] == self.owner
+        if held and (lease is None or lease[0] != self.owner):
+            logging.info("Lost the lease of conversation partition %d", partition)
+        if not held and lease is not None and lease[0] == self.owner and self.onAcquired is not None:
+            try:
+                self.onAcquired(client, partition)
+            except Exception as e:
+                logging.error("Failed to take over conversation partition %d: %s", partition, e)
+        return None if lease is None else lease[0]
+
+    def acquire(self, client, partition, now):
+        key = self.key(partition)
+        try:
+            state = client.get_state(self.storeName, key)
+            lease = json.loads(state.data) if state.data else None
+            if lease is not None and lease["owner"] != self.owner and now < lease["expires_at"]:
+                # Another replica's lease is read again before long, in case it is released early
+                return lease["owner"], lease["expires_at"], min(lease["expires_at"], now + self.leaseSeconds / 4)
+            expiresAt = now + self.leaseSeconds
+            client.save_state(
+                self.storeName,
+                key,
+                json.dumps({"owner": self.owner, "expires_at": expiresAt}),
+                etag=state.etag or None,
+                options=StateOptions(concurrency=Concurrency.first_write),
+            )
+        except Exception as e:
+            # Typically another replica taking the free lease first
+            logging.info("Could not take the lease of conversation partition %d: %s", partition, e)
+            return None
+        return self.owner, expiresAt, now + self.leaseSeconds / 2
+
+    def release(self, client):
+        """Hands every held partition back, so other replicas don't wait for the leases to expire."""
+        with self.lock:
+            partitions = [partition for partition, lease in self.leases.items() if lease[0] == self.owner]
+            self.leases = {}
+        for partition in partitions:
+            key = self.key(partition)
+            try:
+                state = client.get_state(self.storeName, key)
+                if state.data and json.loads(state.data)["owner"] == self.owner:
+                    client.delete_state(self.storeName, key, etag=state.etag)
+            except Exception as e:
+                logging.error("Failed to release conversation partition %d: %s", partition, e)
+
+
+class TurnInbox:
+    """Turns waiting for the holder of their partition, kept in the state store.
+
+    A replica that gets a turn of a partition it doesn't hold leaves it in
+    the partition's inbox and tells the holder to take it. The inbox
+    outlives the replica it was meant for: whichever replica takes the
+    partition over next takes the inbox with it.
+
+    Each partition's inbox is one `{conversationId: event}` key, holding the
+    newest turn of each conversation as ordered by `supersedes`. Writes
+    are guarded by its etag, so concurrent forwards are retried rather
+    than lost.
+    """
+
+    def __init__(self, storeName, supersedes, maxRetries=5):
+        self.storeName = storeName
+        self.supersedes = supersedes
+        self.maxRetries = maxRetries
+
+    def key(self, partition):
+        return f"conversation_partition:{partition}:turns"
+
+    def put(self, client, partition, conversationId, conversationData):
+        key = self.key(partition)
+        for attempt in range(1, self.maxRetries + 1):
+            state = client.get_state(self.storeName, key)
+            turns = json.loads(state.data) if state.data else {}
+            pending = turns.get(conversationId)
+            if pending is not None and not self.supersedes(conversationData, pending):
+                return
+            turns[conversationId] = conversationData
+            try:
+                client.save_state(
+                    self.storeName,
+                    key,
+                    json.dumps(turns),
+                    etag=state.etag or None,
+                    options=StateOptions(concurrency=Concurrency.first_write),
+                )
+                return
+            except Exception as e:
+                # Most likely another replica forwarding a turn of the same partition; reload and retry
+                if attempt == self.maxRetries:
+                    raise
+                logging.info("Retrying a write of %s after: %s", key, e)
+
+    def take(self, client, partition):
+        """Empties the partition's inbox; returns its turns by conversation id."""
+        key = self.key(partition)
+        for attempt in range(1, self.maxRetries + 1):
+            state = client.get_state(self.storeName, key)
+            if not state.data:
+                return {}
+            try:
+                client.delete_state(self.storeName, key, etag=state.etag)
+                return json.loads(state.data)
+            except Exception as e:
+                if attempt == self.maxRetries:
+                    raise
+                logging.info("Retrying a take of %s after: %s", key, e)
+
+
+class SerialQueues:
+    """Runs the jobs of each key one at a time and in order, through `submit`.
+
+    The coalescer keeps one turn pending per conversation, but a new turn
+    could still start while the previous one was being generated. A job
+    whose key already has one running now waits behind it, and the worker
+    that ran it goes on with the next one.
+    """
+
+    def __init__(self, submit):
+        self.submit = submit
+        self.lock = threading.Lock()
+        # key -> jobs waiting behind the running one
+        self.queues = {}
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def run(self, key, job, *args):
+        """Queues the job; returns False if `submit` has no room for the key's first job."""
+        with self.lock:
+            queue = self.queues.get(key)
+            if queue is not None:
+                queue.append((job, args))
+                return True
+            # Submitted under the lock, so no job can queue behind one that is then rejected
+            if not self.submit(self.drain, key, job, args):
+                return False
+            self.queues[key] = deque()
+            return True
+
+    def drain(self, key, job, args):
+        while True:
+            try:
+                job(*args)
+            except Exception as e:
+                logging.exception("Serial job of %s failed: %s", key, e)
+            with self.lock:
+                queue = self.queues[key]
+                if not queue:
+                    del self.queues[key]
+                    return
+                job, args = queue.popleft()
@@ -0,0 +1,213 @@
+import heapq
+import itertools
+import random
+from collections import OrderedDict
+
+
+class RandomPolicy:
+    """Uniform random choice, the orchestrator's original behaviour."""
+
+    def __init__(self):
+        self.ids = []
+        self.positions = {}
+
+    def activate(self, agent):
+        agentId = agent["id"]
+        if agentId not in self.positions:
+            self.positions[agentId] = len(self.ids)
+            self.ids.append(agentId)
+
+    def deactivate(self, agentId):
+        position = self.positions.pop(agentId, None)
+        if position is None:
+            return
+        # Swap with the last id so removal stays O(1)
+        last = self.ids.pop()
+        if position < len(self.ids):
+            self.ids[position] = last
+            self.positions[last] = position
+
+    forget = deactivate
+
+    def pick(self):
+        return random.choice(self.ids) if self.ids else None
+
+    def spoke(self, agentId):
+        pass
+
+
+class TeaWeightedPolicy:
+    """Picks agents with probability proportional to their remaining tea.
+
+    Weights live in a Fenwick tree, so updating a weight and drawing an
+    agent are both O(log n). Slots of removed agents are reused.
+    """
+
+    def __init__(self, capacity=1024):
+        self.tree = [0.0] * (capacity + 1)
+        self.weights = [0.0] * (capacity + 1)
+        self.slots = {}
+        self.ids = [None] * (capacity + 1)
+        self.free = []
+        self.size = 0
+
+    def capacity(self):
+        return len(self.tree) - 1
+
+    def grow(self):
+        weights = self.weights[1:]
+        capacity = self.capacity() * 2
+        self.tree = [0.0] * (capacity + 1)
+        self.weights = [0.0] * (capacity + 1)
+        self.ids.extend([None] * (capacity - len(self.ids) + 1))
+        for slot, weight in enumerate(weights, start=1):
+            if weight:
+                self.setWeight(slot, weight)
+
+    def setWeight(self, slot, weight):
+        delta = weight - self.weights[slot]
+        self.weights[slot] = weight
+        while slot <= self.capacity():
+            self.tree[slot] += delta
+            slot += slot & -slot
+
+    def slotFor(self, agentId):
+        slot = self.slots.get(agentId)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+            else:
+                if self.size == self.capacity():
+                    self.grow()
+                self.size += 1
+                slot = self.size
+            self.slots[agentId] = slot
+            self.ids[slot] = agentId
+        return slot
+
+    def activate(self, agent):
+        self.setWeight(self.slotFor(agent["id"]), float(max(agent["tea_amount_ml"], 0)))
+
+    def deactivate(self, agentId):
+        slot = self.slots.get(agentId)
+        if slot is not None:
+            self.setWeight(slot, 0.0)
+
+    def forget(self, agentId):
+        slot = self.slots.pop(agentId, None)
+        if slot is not None:
+            self.setWeight(slot, 0.0)
+            self.ids[slot] = None
+            self.free.append(slot)
+
+    def total(self):
+        slot, total = self.capacity(), 0.0
+        while slot > 0:
+            total += self.tree[slot]
+            slot -= slot & -slot
+        return total
+
+    def pick(self):
+        total = self.total()
+        if total <= 0:
+            return None
+        # Walk down the tree to the first slot whose prefix sum exceeds the target
+        target = random.random() * total
+        slot = 0
+        step = 1 << (self.capacity().bit_length() - 1)
+        while step:
+            nextSlot = slot + step
+            if nextSlot <= self.capacity() and self.tree[nextSlot] <= target:
+                slot = nextSlot
+                target -= self.tree[nextSlot]
+            step >>= 1
+        slot += 1
+        # Float rounding can land on an empty slot at the very end; fall back to the last weighted one
+        while slot > 0 and (slot > self.capacity() or not self.weights[slot]):
+            slot -= 1
+        return self.ids[slot] if slot else None
+
+    def spoke(self, agentId):
+        pass
+
+
+class RoundRobinPolicy:
+    """Cycles through the agents in the order they became available."""
+
+    def __init__(self):
+        self.ring = OrderedDict()
+
+    def activate(self, agent):
+        self.ring.setdefault(agent["id"], None)
+
+    def deactivate(self, agentId):
+        self.ring.pop(agentId, None)
+
+    forget = deactivate
+
+    def pick(self):
+        return next(iter(self.ring), None)
+
+    def spoke(self, agentId):
+        if agentId in self.ring:
+            self.ring.move_to_end(agentId)
+
+
+class LeastRecentlySpokenPolicy:
+    """Picks the agent that has gone longest without speaking; new agents go first.
+
+    A heap ordered by the last turn each agent was picked for, with lazy
+    deletion: entries of agents that spoke again or became unavailable are
+    discarded when they reach the top. Unlike round-robin, an agent that
+    was busy or excluded for a while keeps its place in the order.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.lastSpoken = {}
+        self.active = set()
+        self.queued = set()
+        self.turns = itertools.count(1)
+
+    def push(self, agentId):
+        heapq.heappush(self.heap, (self.lastSpoken.get(agentId, 0), agentId))
+        self.queued.add(agentId)
+
+    def activate(self, agent):
+        agentId = agent["id"]
+        self.active.add(agentId)
+        if agentId not in self.queued:
+            self.push(agentId)
+
+    def deactivate(self, agentId):
+        self.active.discard(agentId)
+
+    def forget(self, agentId):
+        self.active.discard(agentId)
+        self.queued.discard(agentId)
+        self.lastSpoken.pop(agentId, None)
+
+    def pick(self):
+        while self.heap:
+            lastSpoken, agentId = self.heap[0]
+            current = agentId in self.active and lastSpoken == self.lastSpoken.get(agentId, 0)
+            if current:
+                return agentId
+            heapq.heappop(self.heap)
+            if lastSpoken == self.lastSpoken.get(agentId, 0):
+                # The agent's only live entry: it was deactivated, so drop it until it comes back
+                self.queued.discard(agentId)
+        return None
+
+    def spoke(self, agentId):
+        self.lastSpoken[agentId] = next(self.turns)
+        # The old entry is now stale and will be discarded lazily
+        self.push(agentId)
+
+
+policies = {
+    "random": RandomPolicy,
+    "tea_weighted": TeaWeightedPolicy,
+    "round_robin": RoundRobinPolicy,
+    "least_recently_spoken": LeastRecentlySpokenPolicy,
+}
@@ -0,0 +1,129 @@
+import json
+import logging
+import threading
+import zlib
+
+from dapr.clients.grpc._state import Concurrency, StateOptions
+
+
+class TeaBalances:
+    """Latest known tea balance of every agent, persisted as periodic snapshots.
+
+    Tea arrives as `tea_delta` events that only update this map in memory;
+    `flush` writes the changed balances in aggregated, sharded snapshots
+    (`tea_balances:{n}`), and the registry is loaded with them laid over the
+    stored agents.
+
+    Each balance carries the agent's ledger version when known. Only the
+    balances that changed since the last flush are written, merged into the
+    shards under their etag, so replicas that saw different events keep the
+    newest balance of each agent. Agents that ran dry are dropped from the
+    snapshots, as they are from the state store.
+    """
+
+    def __init__(self, storeName, shards=16, maxRetries=5):
+        self.storeName = storeName
+        self.shards = shards
+        self.maxRetries = maxRetries
+        self.lock = threading.Lock()
+        self.balances = {}
+        self.dirty = set()
+
+    def shardKey(self, shard):
+        return f"tea_balances:{shard}"
+
+    def shardFor(self, agentId):
+        return zlib.crc32(agentId.encode()) % self.shards
+
+    def get(self, agentId):
+        with self.lock:
+            return self.balances.get(agentId)
+
+    def overlay(self, agent):
+        """Returns the agent with its latest balance, unless the stored agent is at least as new."""
+        with self.lock:
+            balance = self.balances.get(agent["id"])
+        if balance is None or (
+            balance["version"] is not None
+            and agent.get("version") is not None
+            and agent["version"] >= balance["version"]
+        ):
+            return agent
+        return dict(agent, tea_amount_ml=balance["tea_amount_ml"])
+
+    def apply(self, agentId, teaAmountMl, version=None):
+        """Records a balance; returns False if a newer one is already known."""
+        with self.lock:
+            if not self.newer(version, self.balances.get(agentId)):
+                return False
+            self.balances[agentId] = {"tea_amount_ml": teaAmountMl, "version": version}
+            self.dirty.add(agentId)
+            return True
+
+    @staticmethod
+    def newer(version, current):
+        # Balances without a version come from generators that don't use agent actors; the last one wins
+        return current is None or version is None or current["version"] is None or version > current["version"]
+
+    def flush(self, client):
+        """Writes the shards with changed balances; returns how many were written."""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            byShard = {}
+            for agentId in dirty:
+                byShard.setdefault(self.shardFor(agentId), {})[agentId] = self.balances[agentId]
+        written = 0
+        for shard, changed in sorted(byShard.items()):
+            try:
+                self.flushShard(client, shard, changed)
+                written += 1
+            except Exception:
+                with self.lock:
+                    self.dirty.update(agentId for agentId in changed if agentId in self.balances)
+                raise
+        with self.lock:
+            for agentId in dirty:
+                if agentId not in self.dirty and self.balances[agentId]["tea_amount_ml"] <= 0:
+                    del self.balances[agentId]
+        return written
+
+    def flushShard(self, client, shard, changed):
+        shardKey = self.shardKey(shard)
+        for attempt in range(self.maxRetries):
+            response = client.get_state(self.storeName, shardKey)
+            stored = json.loads(response.data) if response.data else {}
+            for agentId, balance in changed.items():
+                if not self.newer(balance["version"], stored.get(agentId)):
+                    continue
+                if balance["tea_amount_ml"] > 0:
+                    stored[agentId] = balance
+                else:
+                    stored.pop(agentId, None)
+            try:
+                # First write wins, so a shard created concurrently isn't overwritten either
+                client.save_state(
+                    self.storeName,
+                    shardKey,
+                    json.dumps(stored),
+                    etag=response.etag or None,
+                    options=StateOptions(concurrency=Concurrency.first_write),
+                )
+                return
+            except Exception as e:
+                logging.info("Tea balance shard %s changed concurrently (attempt %d): %s", shardKey, attempt + 1, e)
+        raise RuntimeError(f"Could not update {shardKey} after {self.maxRetries} attempts")
+
+    def load(self, client):
+        """Reads every snapshot shard with one bulk read, keeping balances newer than the in-memory ones."""
+        items = client.get_bulk_state(self.storeName, [self.shardKey(shard) for shard in range(self.shards)]).items
+        with self.lock:
+            for item in items:
+                for agentId, balance in (json.loads(item.data) if item.data else {}).items():
+                    current = self.balances.get(agentId)
+                    if current is None or (
+                        balance["version"] is not None
+                        and current["version"] is not None
+                        and balance["version"] > current["version"]
+                    ):
+                        self.balances[agentId] = balance
+            return dict(self.balances)
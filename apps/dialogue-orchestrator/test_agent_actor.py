@@ -0,0 +1,68 @@
+import unittest
+from unittest import mock
+
+from dapr.actor.runtime.mock_actor import create_mock_actor
+
+from agent_actor import AgentActor
+
+
+class AgentActorTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.actor = create_mock_actor(AgentActor, "a")
+        await self.actor.register({"id": "a", "name": "Alice", "description": "", "tea_amount_ml": 10})
+
+    async def test_concurrent_reservations_cannot_overspend(self):
+        first = await self.actor.reserve_tea({"ml": 6})
+        second = await self.actor.reserve_tea({"ml": 6})
+        self.assertEqual((first["granted_ml"], second["granted_ml"]), (6, 4))
+        self.assertEqual((await self.actor.reserve_tea({"ml": 6}))["reservation_id"], None)
+
+        await self.actor.commit_usage({"reservation_id": first["reservation_id"], "used_ml": 2})
+        delta = await self.actor.commit_usage({"reservation_id": second["reservation_id"], "used_ml": 3})
+        # Both charges land, and unused tea is available again
+        self.assertEqual((delta["delta_ml"], delta["tea_amount_ml"]), (-3, 5))
+        self.assertEqual((await self.actor.reserve_tea({"ml": 6}))["granted_ml"], 5)
+
+    async def test_usage_is_capped_and_committed_once(self):
+        reservation = await self.actor.reserve_tea({"ml": 3})
+        delta = await self.actor.commit_usage({"reservation_id": reservation["reservation_id"], "used_ml": 50})
+        self.assertEqual(delta["tea_amount_ml"], 7)
+        delta = await self.actor.commit_usage({"reservation_id": reservation["reservation_id"], "used_ml": 3})
+        self.assertEqual((delta["delta_ml"], delta["tea_amount_ml"]), (0, 7))
+        # set, reserve and commit
+        self.assertEqual(delta["version"], 3)
+
+    async def test_expired_reservations_release_their_tea(self):
+        with mock.patch("agent_actor.time.time", return_value=1000.0):
+            await self.actor.reserve_tea({"ml": 10, "ttl_seconds": 5})
+        with mock.patch("agent_actor.time.time", return_value=1010.0):
+            self.assertEqual((await self.actor.reserve_tea({"ml": 10}))["granted_ml"], 10)
+
+    async def test_ledger_survives_reactivation_across_snapshots(self):
+        self.actor.snapshotEvery = 4
+        self.actor.retainSegments = 1
+        for _ in range(4):
+            reservation = await self.actor.reserve_tea({"ml": 2})
+            await self.actor.commit_usage({"reservation_id": reservation["reservation_id"], "used_ml": 1})
+        held = await self.actor.reserve_tea({"ml": 2})
+        state = self.actor._state_manager._mock_state
+        # 10 entries: two folded segments, of which only the last is kept, and a tail of two
+        self.assertEqual(state["ledger_snapshot"]["seq"], 8)
+        self.assertEqual(sorted(key for key in state if key.startswith("ledger:")), ["ledger:1"])
+        self.assertEqual(len(state["ledger_tail"]), 2)
+
+        # A fresh activation replays the tail on top of the snapshot
+        reactivated = create_mock_actor(AgentActor, "a", initstate=state)
+        profile = await reactivated.get_profile()
+        self.assertEqual((profile["tea_amount_ml"], profile["version"]), (6, 10))
+        delta = await reactivated.commit_usage({"reservation_id": held["reservation_id"], "used_ml": 2})
+        self.assertEqual((delta["id"], delta["tea_amount_ml"]), ("a", 4))
+
+    async def test_unknown_agents_get_nothing(self):
+        actor = create_mock_actor(AgentActor, "b")
+        self.assertIsNone(await actor.get_profile())
+        self.assertEqual((await actor.reserve_tea({"ml": 1}))["granted_ml"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
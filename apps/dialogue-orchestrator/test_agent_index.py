@@ -0,0 +1,122 @@
+import json
+import unittest
+from types import SimpleNamespace
+
+from dapr.clients.grpc._request import TransactionOperationType
+from dapr.clients.grpc._state import Concurrency
+
+from agent_index import AgentIndex
+
+
+class FakeStateClient:
+    """Dict-backed stand-in for the state calls AgentIndex makes, with etags."""
+
+    def __init__(self):
+        self.data = {}
+        self.version = 0
+        self.writes = []
+        self.bulkWrites = 0
+        self.beforeTransaction = None
+
+    def put(self, key, value):
+        self.version += 1
+        self.data[key] = (value.encode() if isinstance(value, str) else value, str(self.version))
+        self.writes.append(key)
+
+    def get_state(self, store, key):
+        data, etag = self.data.get(key, (b"", ""))
+        return SimpleNamespace(data=data, etag=etag)
+
+    def get_bulk_state(self, store, keys):
+        items = []
+        for key in keys:
+            data, etag = self.data.get(key, (b"", ""))
+            items.append(SimpleNamespace(key=key, data=data, etag=etag))
+        return SimpleNamespace(items=items)
+
+    def save_bulk_state(self, store, states):
+        self.bulkWrites += 1
+        for state in states:
+            self.put(state.key, state.value)
+
+    def save_state(self, store, key, value, etag=None, options=None):
+        if etag:
+            if self.data.get(key, (None, None))[1] != etag:
+                raise RuntimeError("etag mismatch")
+        elif options is not None and options.concurrency == Concurrency.first_write and key in self.data:
+            raise RuntimeError("already exists")
+        self.put(key, value)
+
+    def delete_state(self, store, key, etag=None):
+        if etag and self.data.get(key, (None, None))[1] != etag:
+            raise RuntimeError("etag mismatch")
+        self.data.pop(key, None)
+
+    def execute_state_transaction(self, store, operations):
+        if self.beforeTransaction:
+            hook, self.beforeTransaction = self.beforeTransaction, None
+            hook()
+        for operation in operations:
+            if operation.etag and self.data.get(operation.key, (None, None))[1] != operation.etag:
+                raise RuntimeError("etag mismatch")
+        for operation in operations:
+            if operation.operation_type == TransactionOperationType.delete:
+                self.data.pop(operation.key, None)
+            else:
+                self.put(operation.key, operation.data)
+
+
+class AgentIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeStateClient()
+        self.index = AgentIndex("store", shards=4)
+        self.index.ensureShards(self.client)
+
+    def test_tea_changes_do_not_rewrite_the_shard(self):
+        self.index.save(self.client, "agent_a", json.dumps({"tea_amount_ml": 10}))
+        self.client.writes.clear()
+        self.index.save(self.client, "agent_a", json.dumps({"tea_amount_ml": 9}))
+        self.assertEqual(self.client.writes, ["agent_a"])
+
+    def test_concurrent_join_is_not_lost(self):
+        # Two keys in the same shard, the second joining while the first is being written
+        shard = self.index.shardFor("agent_a")
+        other = next(f"agent_{i}" for i in range(100) if self.index.shardFor(f"agent_{i}") == shard and i)
+        self.client.beforeTransaction = lambda: self.index.save(self.client, other, "{}")
+        self.index.save(self.client, "agent_a", "{}")
+        self.assertEqual(self.index.keys(self.client), sorted(["agent_a", other]))
+
+    def test_leaving_removes_agent_and_key(self):
+        self.index.save(self.client, "agent_a", "{}")
+        self.index.save(self.client, "agent_a", None)
+        self.assertEqual(self.index.keys(self.client), [])
+        self.assertNotIn("agent_a", self.client.data)
+
+    def test_batch_updates_share_one_bulk_write(self):
+        keys = [f"agent_{i}" for i in range(6)]
+        self.assertEqual(self.index.saveMany(self.client, {key: "{}" for key in keys}), set())
+        self.assertEqual(self.index.keys(self.client), sorted(keys))
+        self.client.writes.clear()
+        self.index.saveMany(self.client, {key: '{"tea_amount_ml": 1}' for key in keys})
+        self.assertEqual((sorted(self.client.writes), self.client.bulkWrites), (sorted(keys), 1))
+
+    def test_batch_joins_and_leaves_keep_the_shards_in_step(self):
+        self.index.saveMany(self.client, {"agent_a": "{}", "agent_b": "{}"})
+        # A replica adds another agent to agent_a's shard between the read and the transaction
+        shard = self.index.shardFor("agent_a")
+        other = next(f"agent_{i}" for i in range(100) if self.index.shardFor(f"agent_{i}") == shard and i)
+        self.client.beforeTransaction = lambda: self.index.save(self.client, other, "{}")
+        self.assertEqual(self.index.saveMany(self.client, {"agent_a": None, "agent_c": "{}"}), set())
+        self.assertEqual(self.index.keys(self.client), sorted(["agent_b", "agent_c", other]))
+        self.assertNotIn("agent_a", self.client.data)
+
+    def test_migrates_the_legacy_list(self):
+        client = FakeStateClient()
+        client.put("agent_keys", json.dumps(["agent_a", "agent_b"]))
+        self.assertEqual(self.index.keys(client), ["agent_a", "agent_b"])
+        self.index.ensureShards(client)
+        self.assertEqual(self.index.keys(client), ["agent_a", "agent_b"])
+
+
+if __name__ == "__main__":
+    unittest.main()
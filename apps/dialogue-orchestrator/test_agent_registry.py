@@ -0,0 +1,69 @@
+import threading
+import unittest
+
+from agent_registry import AgentRegistry
+
+
+def agent(agentId, name=None, tea=100):
+    return {"id": agentId, "name": name or f"Agent {agentId}", "description": "", "tea_amount_ml": tea}
+
+
+class AgentRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = AgentRegistry()
+        self.registry.load([agent("a"), agent("b"), agent("c", name="Agent a")])
+
+    def test_choose_never_picks_the_excluded_name(self):
+        for _ in range(50):
+            self.assertEqual(self.registry.choose(excludeName="Agent a")["id"], "b")
+            self.registry.release("b")
+
+    def test_choose_returns_none_when_everyone_is_excluded(self):
+        self.registry.upsert(agent("b", tea=0))
+        self.assertIsNone(self.registry.choose(excludeName="Agent a"))
+
+    def test_choose_skips_excluded_ids(self):
+        self.assertEqual(self.registry.choose(excludeName="Agent a", excludeIds=["a"])["id"], "b")
+        self.assertIsNone(self.registry.choose(excludeName="Agent b", excludeIds=["a", "c"], timeout=5))
+
+    def test_agents_without_tea_are_removed_from_every_index(self):
+        self.registry.upsert(agent("a", tea=0))
+        self.assertIsNone(self.registry.get("a"))
+        self.assertEqual([a["id"] for a in self.registry.byName("Agent a")], ["c"])
+        self.assertEqual(len(self.registry), 2)
+        self.assertEqual(self.registry.get("c")["id"], "c")
+
+    def test_rename_moves_the_name_index(self):
+        self.registry.upsert(agent("b", name="Bob"))
+        self.assertEqual(self.registry.byName("Agent b"), [])
+        self.assertEqual(self.registry.byName("Bob")[0]["id"], "b")
+
+    def test_busy_agents_are_not_chosen_until_released(self):
+        chosen = self.registry.choose(excludeName="Agent a")
+        self.assertEqual(self.registry.busy(), 1)
+        self.assertIsNone(self.registry.choose(excludeName="Agent a"))
+        self.registry.release(chosen["id"])
+        self.assertEqual(self.registry.choose(excludeName="Agent a")["id"], "b")
+
+    def test_choose_waits_for_a_release(self):
+        self.registry.choose(excludeName="Agent a")
+        threading.Timer(0.05, self.registry.release, ["b"]).start()
+        self.assertEqual(self.registry.choose(excludeName="Agent a", timeout=5)["id"], "b")
+
+    def test_choose_does_not_wait_when_there_is_no_candidate(self):
+        self.registry.upsert(agent("b", tea=0))
+        self.assertIsNone(self.registry.choose(excludeName="Agent a", timeout=5))
+
+    def test_load_keeps_updates_that_raced_with_the_read(self):
+        version = self.registry.version
+        self.registry.upsert(agent("a", tea=0))
+        self.registry.upsert(agent("d"))
+        # The bulk read happened before those events were applied
+        self.registry.load([agent("a"), agent("b"), agent("c", name="Agent a")], version)
+        self.assertIsNone(self.registry.get("a"))
+        self.assertIsNotNone(self.registry.get("d"))
+        self.assertEqual(len(self.registry), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
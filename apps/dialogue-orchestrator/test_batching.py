@@ -0,0 +1,67 @@
+import threading
+import unittest
+
+from batching import MicroBatcher
+
+
+class MicroBatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+
+    def handle(self, items):
+        self.batches.append(list(items))
+        return [item * 10 for item in items]
+
+    def submitConcurrently(self, batcher, items):
+        results = {}
+
+        def submit(item):
+            try:
+                results[item] = batcher.submit(item)
+            except Exception as e:
+                results[item] = e
+
+        threads = [threading.Thread(target=submit, args=(item,)) for item in items]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_events_gather_while_a_batch_is_handled(self):
+        started, release = threading.Event(), threading.Event()
+
+        def handle(items):
+            if not self.batches:
+                started.set()
+                release.wait(5)
+            return self.handle(items)
+
+        batcher = MicroBatcher(handle, maxBatch=4, maxWait=5)
+        first = threading.Thread(target=batcher.submit, args=(0,))
+        first.start()
+        started.wait(5)
+        # The first batch is busy, so these fill the next ones up to maxBatch
+        threading.Timer(0.2, release.set).start()
+        results = self.submitConcurrently(batcher, range(1, 9))
+        first.join(5)
+        self.assertEqual(results, {item: item * 10 for item in range(1, 9)})
+        self.assertEqual(sorted(len(batch) for batch in self.batches), [1, 4, 4])
+
+    def test_a_lone_event_is_not_delayed(self):
+        batcher = MicroBatcher(self.handle, maxBatch=4, maxWait=60)
+        self.assertEqual(batcher.submit(3), 30)
+        self.assertEqual(batcher.submit(4), 40)
+        self.assertEqual(self.batches, [[3], [4]])
+
+    def test_a_failed_batch_fails_each_event(self):
+        def fail(items):
+            raise RuntimeError("state store unavailable")
+
+        batcher = MicroBatcher(fail, maxBatch=2, maxWait=1)
+        results = self.submitConcurrently(batcher, [1, 2])
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results.values()))
+
+
+if __name__ == "__main__":
+    unittest.main()
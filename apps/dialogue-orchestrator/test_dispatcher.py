@@ -0,0 +1,45 @@
+import threading
+import unittest
+
+from dispatcher import TurnDispatcher
+from metrics import Metrics
+
+
+class TurnDispatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.dispatcher = TurnDispatcher(self.metrics, workers=1, maxQueue=2)
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.dispatcher.stop(timeout=5)
+
+    def blockingJob(self):
+        self.started.set()
+        self.release.wait(5)
+
+    def test_rejects_once_workers_and_queue_are_full(self):
+        self.dispatcher.start()
+        self.assertTrue(self.dispatcher.submit(self.blockingJob))
+        self.started.wait(5)
+        self.assertTrue(self.dispatcher.submit(self.blockingJob))
+        self.assertTrue(self.dispatcher.submit(self.blockingJob))
+        self.assertFalse(self.dispatcher.submit(self.blockingJob))
+        self.assertEqual(self.dispatcher.inFlight, 1)
+        self.assertEqual(self.dispatcher.queued(), 2)
+        self.assertEqual(self.metrics.snapshot()["counters"]["dispatch_rejected"], 1)
+
+    def test_failing_job_does_not_stop_the_worker(self):
+        done = []
+        self.dispatcher.start()
+        self.dispatcher.submit(lambda: 1 / 0)
+        self.dispatcher.submit(done.append, "ok")
+        self.dispatcher.stop(timeout=5)
+        self.assertEqual(done, ["ok"])
+        self.assertEqual(self.metrics.snapshot()["counters"]["dispatch_failed"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import threading
+import unittest
+
+from metrics import Metrics
+from pacing import ConversationPacer, TurnCoalescer, TurnTimer
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class ConversationPacerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.pacer = ConversationPacer(turnsPerMinute=6, burst=2, minInterval=1, clock=self.clock)
+
+    def test_burst_then_one_turn_per_interval(self):
+        delays = [self.pacer.reserve("c") for _ in range(4)]
+        # Two turns fit the bucket, one second apart, then one every ten seconds
+        self.assertEqual(delays, [0, 1, 10, 20])
+
+    def test_conversations_are_paced_independently(self):
+        self.pacer.reserve("a")
+        self.pacer.reserve("a")
+        self.assertEqual(self.pacer.reserve("b"), 0)
+
+    def test_bucket_refills_and_idle_conversations_are_forgotten(self):
+        self.pacer.reserve("a")
+        self.pacer.reserve("a")
+        self.clock.now += 60
+        self.assertEqual(self.pacer.reserve("b"), 0)
+        self.assertNotIn("a", self.pacer.conversations)
+        self.assertEqual(self.pacer.reserve("a"), 0)
+
+    def test_unlimited_pacer_never_defers(self):
+        pacer = ConversationPacer(clock=self.clock)
+        self.assertEqual([pacer.reserve("c") for _ in range(3)], [0, 0, 0])
+        self.assertEqual(len(pacer.conversations), 0)
+
+
+class TurnTimerTest(unittest.TestCase):
+    def test_runs_due_jobs_in_order_and_retries_when_full(self):
+        ran = []
+        done = threading.Event()
+        accepting = iter([False, True, True])
+
+        def submit(job, *args):
+            if not next(accepting):
+                return False
+            ran.append(args[0])
+            if len(ran) == 2:
+                done.set()
+            return True
+
+        timer = TurnTimer(submit, retryDelay=0.01)
+        timer.start()
+        timer.schedule(0.05, None, "second")
+        timer.schedule(0, None, "first")
+        self.assertTrue(done.wait(5))
+        self.assertEqual(ran, ["first", "second"])
+        self.assertEqual(timer.stop(timeout=5), [])
+
+    def test_bounded_and_returns_pending_jobs_on_stop(self):
+        timer = TurnTimer(lambda job, *args: True, maxPending=1)
+        timer.start()
+        self.assertTrue(timer.schedule(60, None, "later"))
+        self.assertFalse(timer.schedule(60, None, "rejected"))
+        self.assertEqual(timer.stop(timeout=5), [(None, ("later",))])
+
+
+class TurnCoalescerTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.coalescer = TurnCoalescer(self.metrics)
+        self.scheduled = []
+
+    def schedule(self):
+        self.scheduled.append(True)
+        return True
+
+    def test_events_for_a_pending_turn_are_merged(self):
+        self.coalescer.offer("c", {"turn": 3, "message": "three"}, self.schedule)
+        self.coalescer.offer("c", {"turn": 4, "message": "four"}, self.schedule)
+        # A late redelivery doesn't replace the newer message
+        self.coalescer.offer("c", {"turn": 2, "message": "two"}, self.schedule)
+        self.assertEqual(len(self.scheduled), 1)
+        self.assertEqual(self.coalescer.take("c")["message"], "four")
+        self.assertEqual(self.metrics.snapshot()["counters"]["generations_saved"], 2)
+
+    def test_a_bootstrap_replaces_a_pending_turn(self):
+        self.coalescer.offer("c", {"turn": 7, "message": "seven"}, self.schedule)
+        self.coalescer.offer("c", {"message": "hello again"}, self.schedule)
+        self.assertEqual(len(self.scheduled), 1)
+        self.assertEqual(self.coalescer.take("c")["message"], "hello again")
+
+    def test_a_started_turn_no_longer_absorbs_events(self):
+        self.coalescer.offer("c", {"turn": 1}, self.schedule)
+        self.coalescer.take("c")
+        self.coalescer.offer("c", {"turn": 2}, self.schedule)
+        self.assertEqual(len(self.scheduled), 2)
+        self.assertIsNone(self.coalescer.take("other"))
+
+    def test_rejected_turns_are_not_kept(self):
+        self.assertFalse(self.coalescer.offer("c", {"turn": 1}, lambda: False))
+        self.assertEqual(len(self.coalescer), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
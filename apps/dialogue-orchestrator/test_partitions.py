@@ -0,0 +1,132 @@
+import threading
+import unittest
+
+from pacing import TurnCoalescer
+from partitions import PartitionLeases, SerialQueues, TurnInbox
+from test_agent_index import FakeStateClient
+
+
+class PartitionLeasesTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.client = FakeStateClient()
+        clock = lambda: self.now
+        self.first = PartitionLeases("state", "first", partitions=4, leaseSeconds=30, clock=clock)
+        self.second = PartitionLeases("state", "second", partitions=4, leaseSeconds=30, clock=clock)
+
+    def test_a_partition_has_one_holder_at_a_time(self):
+        self.assertTrue(self.first.owns(self.client, 1))
+        self.assertEqual(self.second.holder(self.client, 1), "first")
+        self.assertTrue(self.second.owns(self.client, 2))
+        self.assertEqual((len(self.first), len(self.second)), (1, 1))
+
+    def test_leases_are_renewed_in_place_before_they_expire(self):
+        self.first.owns(self.client, 1)
+        self.now = 10
+        writes = len(self.client.writes)
+        self.assertTrue(self.first.owns(self.client, 1))
+        self.assertEqual(len(self.client.writes), writes)
+        # Past half the lease it is written again over its own etag, never released in between
+        self.now = 20
+        self.assertTrue(self.first.owns(self.client, 1))
+        self.assertEqual(len(self.client.writes), writes + 1)
+        self.now = 40
+        self.assertEqual(self.second.holder(self.client, 1), "first")
+
+    def test_partitions_move_when_leases_expire_or_are_released(self):
+        self.first.owns(self.client, 1)
+        self.first.owns(self.client, 2)
+        self.now = 31
+        self.assertTrue(self.second.owns(self.client, 1))
+        self.assertEqual(self.first.holder(self.client, 1), "second")
+        self.first.release(self.client)
+        self.assertTrue(self.second.owns(self.client, 2))
+
+    def test_only_one_replica_wins_a_free_lease(self):
+        save = self.client.save_state
+
+        def racingSave(store, key, value, etag=None, options=None):
+            # The second replica writes between the first one's read and write
+            self.client.save_state = save
+            self.second.owns(self.client, 1)
+            save(store, key, value, etag, options)
+
+        self.client.save_state = racingSave
+        self.assertIsNone(self.first.holder(self.client, 1))
+        self.assertEqual(self.first.holder(self.client, 1), "second")
+
+    def test_the_state_store_is_called_outside_the_lock(self):
+        lockHeld = []
+        get = self.client.get_state
+        self.client.get_state = lambda store, key: lockHeld.append(self.first.lock.locked()) or get(store, key)
+        self.first.owns(self.client, 1)
+        self.assertEqual(lockHeld, [False])
+
+    def test_taking_a_partition_over_is_announced_once(self):
+        acquired = []
+        self.second.onAcquired = lambda client, partition: acquired.append(partition)
+        self.first.owns(self.client, 1)
+        self.assertFalse(self.second.owns(self.client, 1))
+        self.now = 31
+        self.assertTrue(self.second.owns(self.client, 1))
+        self.now = 50
+        self.assertTrue(self.second.owns(self.client, 1))
+        self.assertEqual(acquired, [1])
+
+
+class TurnInboxTest(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeStateClient()
+        self.inbox = TurnInbox("state", TurnCoalescer.supersedes)
+
+    def test_the_newest_turn_of_each_conversation_waits_until_taken(self):
+        self.inbox.put(self.client, 1, "a", {"turn": 4})
+        self.inbox.put(self.client, 1, "a", {"turn": 3})
+        self.inbox.put(self.client, 1, "b", {"message": "hello"})
+        self.assertEqual(self.inbox.take(self.client, 1), {"a": {"turn": 4}, "b": {"message": "hello"}})
+        self.assertEqual(self.inbox.take(self.client, 1), {})
+
+    def test_a_concurrent_forward_is_retried_not_lost(self):
+        save = self.client.save_state
+
+        def racingSave(store, key, value, etag=None, options=None):
+            # Another replica forwards a turn between this one's read and write
+            self.client.save_state = save
+            self.inbox.put(self.client, 1, "b", {"turn": 1})
+            save(store, key, value, etag, options)
+
+        self.client.save_state = racingSave
+        self.inbox.put(self.client, 1, "a", {"turn": 2})
+        self.assertEqual(self.inbox.take(self.client, 1), {"a": {"turn": 2}, "b": {"turn": 1}})
+
+
+class SerialQueuesTest(unittest.TestCase):
+    def test_jobs_of_a_key_run_in_order_one_at_a_time(self):
+        submitted = []
+        queues = SerialQueues(lambda job, *args: submitted.append((job, args)) or True)
+        ran = []
+        for i in range(3):
+            self.assertTrue(queues.run("a", ran.append, i))
+        queues.run("b", ran.append, "b")
+        # One job per key reaches the dispatcher; the rest wait behind it
+        self.assertEqual((len(submitted), len(queues)), (2, 2))
+        for job, args in submitted:
+            job(*args)
+        self.assertEqual(ran, [0, 1, 2, "b"])
+        self.assertEqual(len(queues), 0)
+
+    def test_a_rejected_first_job_leaves_nothing_behind(self):
+        queues = SerialQueues(lambda job, *args: False)
+        self.assertFalse(queues.run("a", print, 1))
+        self.assertFalse(queues.run("a", print, 2))
+
+    def test_a_failed_job_does_not_stall_its_key(self):
+        queues = SerialQueues(lambda job, *args: threading.Thread(target=job, args=args).start() or True)
+        done = threading.Event()
+        queues.run("a", lambda: 1 / 0)
+        queues.run("a", done.set)
+        self.assertTrue(done.wait(5))
+
+
+if __name__ == "__main__":
+    unittest.main()
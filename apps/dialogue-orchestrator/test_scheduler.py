@@ -0,0 +1,72 @@
+import random
+import unittest
+from collections import Counter
+
+from agent_registry import AgentRegistry
+from scheduler import LeastRecentlySpokenPolicy, RoundRobinPolicy, TeaWeightedPolicy, policies
+
+
+def agent(agentId, tea=100):
+    return {"id": agentId, "name": f"Agent {agentId}", "description": "", "tea_amount_ml": tea}
+
+
+def speakers(registry, turns, excludeName=None):
+    spoken = []
+    for _ in range(turns):
+        chosen = registry.choose(excludeName=excludeName)
+        spoken.append(chosen["id"])
+        registry.release(chosen["id"])
+    return spoken
+
+
+class PolicyTest(unittest.TestCase):
+    def test_every_policy_skips_unavailable_agents(self):
+        for name, policy in policies.items():
+            with self.subTest(policy=name):
+                registry = AgentRegistry(policy(), maxInFlight=1)
+                registry.load([agent(str(i)) for i in range(5)])
+                held = [registry.choose() for _ in range(4)]
+                self.assertEqual(len({a["id"] for a in held}), 4)
+                free = registry.choose()
+                self.assertNotIn(free["id"], {a["id"] for a in held})
+                self.assertIsNone(registry.choose())
+
+    def test_round_robin_cycles(self):
+        registry = AgentRegistry(RoundRobinPolicy())
+        registry.load([agent("a"), agent("b"), agent("c")])
+        self.assertEqual(speakers(registry, 6), ["a", "b", "c", "a", "b", "c"])
+
+    def test_least_recently_spoken_keeps_the_place_of_excluded_agents(self):
+        registry = AgentRegistry(LeastRecentlySpokenPolicy())
+        registry.load([agent("a"), agent("b"), agent("c")])
+        self.assertEqual(speakers(registry, 3), ["a", "b", "c"])
+        # "a" sits out one turn, then is the one who waited longest
+        self.assertEqual(speakers(registry, 1, excludeName="Agent a"), ["b"])
+        self.assertEqual(speakers(registry, 1), ["a"])
+
+    def test_least_recently_spoken_puts_new_agents_first(self):
+        registry = AgentRegistry(LeastRecentlySpokenPolicy())
+        registry.load([agent("a"), agent("b")])
+        speakers(registry, 4)
+        registry.upsert(agent("c"))
+        self.assertEqual(speakers(registry, 1), ["c"])
+
+    def test_tea_weighted_follows_the_tea(self):
+        random.seed(7)
+        registry = AgentRegistry(TeaWeightedPolicy(capacity=2))
+        registry.load([agent("a", tea=900), agent("b", tea=100), agent("c", tea=1)])
+        registry.upsert(agent("c", tea=0))
+        counts = Counter(speakers(registry, 2000))
+        self.assertNotIn("c", counts)
+        self.assertGreater(counts["a"], 6 * counts["b"])
+
+    def test_policies_scale_to_many_agents(self):
+        for name, policy in policies.items():
+            with self.subTest(policy=name):
+                registry = AgentRegistry(policy())
+                registry.load([agent(str(i), tea=i + 1) for i in range(100000)])
+                self.assertGreater(len(set(speakers(registry, 1000))), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
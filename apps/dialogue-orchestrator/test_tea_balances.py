@@ -0,0 +1,62 @@
+import json
+import unittest
+
+from tea_balances import TeaBalances
+from test_agent_index import FakeStateClient
+
+
+class TeaBalancesTest(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeStateClient()
+        self.balances = TeaBalances("store", shards=2)
+
+    def stored(self):
+        merged = {}
+        for shard in range(2):
+            data = self.client.get_state("store", self.balances.shardKey(shard)).data
+            merged.update(json.loads(data) if data else {})
+        return merged
+
+    def test_deltas_are_written_once_per_flush(self):
+        for tea in (90, 80, 70):
+            self.balances.apply("a", tea, None)
+        self.balances.apply("b", 50, None)
+        self.assertLessEqual(self.balances.flush(self.client), 2)
+        self.assertEqual(self.balances.flush(self.client), 0)
+        self.assertEqual(self.stored()["a"]["tea_amount_ml"], 70)
+
+    def test_older_versions_are_ignored(self):
+        self.assertTrue(self.balances.apply("a", 70, 3))
+        self.assertFalse(self.balances.apply("a", 90, 2))
+        self.assertEqual(self.balances.get("a")["tea_amount_ml"], 70)
+
+    def test_replicas_merge_into_the_newest_balance(self):
+        other = TeaBalances("store", shards=2)
+        other.apply("a", 60, 5)
+        other.apply("b", 40, 1)
+        other.flush(self.client)
+        self.balances.apply("a", 70, 4)
+        self.balances.flush(self.client)
+        self.assertEqual(self.stored()["a"]["tea_amount_ml"], 60)
+        self.assertEqual(self.stored()["b"]["tea_amount_ml"], 40)
+
+    def test_dry_agents_are_dropped_from_the_snapshot(self):
+        self.balances.apply("a", 10, 1)
+        self.balances.flush(self.client)
+        self.balances.apply("a", 0, 2)
+        self.balances.flush(self.client)
+        self.assertNotIn("a", self.stored())
+        self.assertIsNone(self.balances.get("a"))
+
+    def test_overlay_keeps_newer_stored_agents(self):
+        self.balances.apply("a", 70, 4)
+        self.balances.flush(self.client)
+        loaded = TeaBalances("store", shards=2)
+        loaded.load(self.client)
+        self.assertEqual(loaded.overlay({"id": "a", "tea_amount_ml": 100, "version": 2})["tea_amount_ml"], 70)
+        self.assertEqual(loaded.overlay({"id": "a", "tea_amount_ml": 100, "version": 5})["tea_amount_ml"], 100)
+        self.assertEqual(loaded.overlay({"id": "b", "tea_amount_ml": 100})["tea_amount_ml"], 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,184 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from pacing import ConversationPacer
+from turn_workflow import TurnWorkflow
+
+
+class FakeTask:
+    def __init__(self, kind, name=None, input=None, result=None):
+        self.kind = kind
+        self.name = name
+        self.input = input
+        self.result = result
+
+    def get_result(self):
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+class FakeContext:
+    """Records what the workflow asks of the runtime; the test plays the runtime's answers."""
+
+    instance_id = "conversation:c"
+
+    def __init__(self):
+        self.current_utc_datetime = datetime(2026, 1, 1)
+        self.retryPolicies = []
+        self.continuedWith = None
+
+    def create_timer(self, fire_at):
+        return FakeTask("timer", input=fire_at)
+
+    def wait_for_external_event(self, name):
+        return FakeTask("event", name)
+
+    def call_activity(self, name, input=None, retry_policy=None):
+        self.retryPolicies.append(retry_policy)
+        return FakeTask("activity", name, input)
+
+    def continue_as_new(self, state, save_events=False):
+        self.continuedWith = (state, save_events)
+
+
+@mock.patch("turn_workflow.when_all", lambda tasks: tasks)
+@mock.patch("turn_workflow.when_any", lambda tasks: tasks)
+class TurnWorkflowTest(unittest.TestCase):
+    agent = {"id": "a", "name": "Alice", "description": "", "tea_amount_ml": 10}
+
+    def start(self, workflow, **fields):
+        self.ctx = FakeContext()
+        state = TurnWorkflow.input("c", dict({"name": "God", "message": "Hello"}, **fields))
+        self.run = workflow.run(self.ctx, state)
+        return next(self.run, None)
+
+    def takeTurn(self, step):
+        self.assertEqual((step.name, step.input), ("select_agent", {"exclude": "God"}))
+        step = self.run.send(self.agent)
+        self.assertEqual((step.name, step.input["turn"], step.input["message"]), ("generate", 1, "Hello"))
+        # Retries reach the generator under the same id, which it completes once
+        self.assertEqual(step.input["generation_id"], "conversation:c:1:20260101T000000000000")
+        step = self.run.send({"data": "Hi", "generation_id": "g"})
+        self.assertEqual((step.name, step.input["message"], step.input["turn"]), ("publish_message", "Hi", 1))
+        self.assertIsNone(next(self.run, None))
+        return self.ctx.continuedWith[0]
+
+    def test_a_turn_runs_as_activities_and_continues_as_new(self):
+        workflow = TurnWorkflow(ConversationPacer(), retryPolicy="retry")
+        state = self.takeTurn(self.start(workflow))
+        self.assertEqual((state["name"], state["message"], state["turn"]), ("Alice", "Hi", 1))
+        # Only the generator call is retried
+        self.assertEqual(self.ctx.retryPolicies, [None, "retry", None])
+
+    def test_turns_wait_for_their_paced_slot_on_a_durable_timer(self):
+        workflow = TurnWorkflow(ConversationPacer(turnsPerMinute=6), debounceSeconds=1)
+        timer, event = self.start(workflow)
+        self.assertEqual((timer.input, event.name), (timedelta(seconds=1), "message"))
+        state = self.takeTurn(self.run.send(timer))
+
+        # The next run finds the bucket in its input
+        self.ctx = FakeContext()
+        self.run = workflow.run(self.ctx, dict(state, name="God", message="Hello", turn=0))
+        timer, _ = next(self.run)
+        self.assertEqual(timer.input, timedelta(seconds=10))
+
+    def test_a_new_message_replaces_the_one_waiting(self):
+        workflow = TurnWorkflow(ConversationPacer(), debounceSeconds=1)
+        _, event = self.start(workflow)
+        event.result = {"name": "God", "message": "Start over"}
+        with self.assertRaises(StopIteration):
+            self.run.send(event)
+        state, saveEvents = self.ctx.continuedWith
+        self.assertEqual((state["message"], state["turn"], saveEvents), ("Start over", 0, True))
+
+    def test_an_agent_without_tea_makes_way_for_another(self):
+        workflow = TurnWorkflow(ConversationPacer(), retryPolicy="retry", agentAttempts=2)
+        step = self.start(workflow)
+        step = self.run.send(self.agent)
+        step = self.run.send({"exhausted": True})
+        self.assertEqual((step.name, step.input), ("select_agent", {"exclude": "God", "exclude_ids": ["a"]}))
+        step = self.run.send(dict(self.agent, id="b", name="Bob"))
+        self.assertEqual((step.name, step.input["agent"]["id"]), ("generate", "b"))
+        step = self.run.send({"data": "Hi", "generation_id": "g"})
+        self.assertEqual((step.name, step.input["name"]), ("publish_message", "Bob"))
+
+        # Without another agent with tea, the conversation ends
+        step = self.start(workflow)
+        self.run.send(self.agent)
+        self.run.send({"exhausted": True})
+        self.run.send(dict(self.agent, id="b", name="Bob"))
+        with self.assertRaises(StopIteration):
+            self.run.send({"exhausted": True})
+        self.assertIsNone(self.ctx.continuedWith)
+
+    def test_stops_at_the_turn_limit_or_without_speakers(self):
+        self.assertIsNone(self.start(TurnWorkflow(ConversationPacer(), maxTurns=3), turn=3))
+        self.start(TurnWorkflow(ConversationPacer()))
+        with self.assertRaises(StopIteration):
+            self.run.send(None)
+        self.assertIsNone(self.ctx.continuedWith)
+
+    def startCandidates(self, candidates, concurrency=0):
+        workflow = TurnWorkflow(ConversationPacer(), candidates=candidates, concurrency=concurrency, minReplyChars=5)
+        step = self.start(workflow)
+        self.assertEqual((step.name, step.input), ("select_agents", {"exclude": "God", "count": candidates}))
+        agents = [dict(self.agent, id=agentId, name=agentId) for agentId in "abc"[:candidates]]
+        return self.run.send(agents)
+
+    def candidate(self, data):
+        return {"data": data, "generation_id": "g", "token_count": 3, "reservation_id": f"r-{data}"}
+
+    def test_the_first_acceptable_candidate_wins_and_the_rest_are_dropped(self):
+        running = self.startCandidates(3)
+        self.assertEqual([task.input["agent"]["id"] for task in running], ["a", "b", "c"])
+        self.assertEqual(len({task.input["generation_id"] for task in running}), 3)
+
+        # Too short, then an echo of the message, then a good one
+        running[0].result = self.candidate("Hm")
+        self.assertEqual(self.run.send(running[0]), running[1:])
+        running[1].result = self.candidate("Hello")
+        self.assertEqual(self.run.send(running[1]), running[2:])
+        running[2].result = self.candidate("Hi there, God")
+        accept, release = self.run.send(running[2])
+        self.assertEqual((accept.name, accept.input["agent"]["id"]), ("accept_candidate", "c"))
+        self.assertEqual((accept.input["reply"], accept.input["reservation_id"]), ("Hi there, God", "r-Hi there, God"))
+        self.assertEqual(release.name, "release_candidates")
+        self.assertEqual([r["reservation_id"] for r in release.input], ["r-Hm", "r-Hello"])
+
+        step = self.run.send([{"data": "Hi there, God", "generation_id": "c-gen"}, None])
+        self.assertEqual((step.name, step.input["name"], step.input["generation_id"]), ("publish_message", "c", "c-gen"))
+
+    def test_candidates_still_running_are_cancelled_and_concurrency_is_bounded(self):
+        running = self.startCandidates(3, concurrency=2)
+        self.assertEqual(len(running), 2)
+        running[0].result = RuntimeError("generator down")
+        running = self.run.send(running[0])
+        self.assertEqual([task.input["agent"]["id"] for task in running], ["b", "c"])
+        running[1].result = self.candidate("A fine reply")
+        accept, cancel = self.run.send(running[1])
+        self.assertEqual((accept.input["agent"]["id"], cancel.name), ("c", "cancel_candidates"))
+        self.assertEqual(cancel.input, [running[0].input["generation_id"]])
+
+    def test_without_an_acceptable_candidate_the_longest_reply_is_taken(self):
+        running = self.startCandidates(2)
+        running[0].result = self.candidate("Hm")
+        running[1].result = self.candidate("Yes")
+        self.run.send(running[0])
+        accept, release = self.run.send(running[1])
+        self.assertEqual((accept.input["reply"], release.input[0]["reservation_id"]), ("Yes", "r-Hm"))
+
+        running = self.startCandidates(2)
+        running[0].result = RuntimeError("generator down")
+        running[1].result = self.candidate(" ")
+        self.run.send(running[0])
+        (release,) = self.run.send(running[1])
+        self.assertEqual(release.name, "release_candidates")
+        with self.assertRaises(StopIteration):
+            self.run.send([None])
+        self.assertIsNone(self.ctx.continuedWith)
+
+
+if __name__ == "__main__":
+    unittest.main()
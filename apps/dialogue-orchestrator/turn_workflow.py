@@ -0,0 +1,218 @@
+from datetime import timedelta, timezone
+
+from dapr.ext.workflow import when_all, when_any
+
+
+class TurnWorkflow:
+    """One conversation's turn loop as a Dapr Workflow.
+
+    Each run of the workflow takes one turn as activities, whose results
+    are kept in the workflow's history and not executed again when it is
+    replayed after a restart:
+
+    - `select_agent` reserves the next speaker; if the generator finds it
+      has no tea, up to `agentAttempts` speakers are tried in turn
+    - `generate` has the generator answer, retried by `retryPolicy` under
+      the same generation id, so the generator charges and persists it once
+    - `publish_message` publishes the answer to the conversations topic
+
+    Turns are paced with the `ConversationPacer`'s bucket, kept in the
+    workflow's input and waited for with a durable timer. Every run ends
+    with `continue_as_new`, so the history never grows beyond one turn. A
+    message raised as the `message` event while the timer runs (e.g. a new
+    bootstrap) replaces the one being answered.
+
+    With `candidates` above one, a turn fans out instead (see
+    `generateCandidates`): several agents answer at once and the first
+    acceptable reply wins, so one slow backend or empty reply doesn't
+    stall the conversation.
+    """
+
+    name = "conversation_turns"
+
+    def __init__(
+        self,
+        pacer,
+        maxTurns=0,
+        debounceSeconds=0,
+        retryPolicy=None,
+        candidates=1,
+        concurrency=0,
+        minReplyChars=1,
+        maxReplyChars=0,
+        agentAttempts=3,
+    ):
+        self.pacer = pacer
+        self.maxTurns = maxTurns
+        self.debounceSeconds = debounceSeconds
+        self.retryPolicy = retryPolicy
+        self.candidates = candidates
+        self.concurrency = concurrency or candidates
+        self.minReplyChars = minReplyChars
+        self.maxReplyChars = maxReplyChars
+        self.agentAttempts = agentAttempts
+
+    @staticmethod
+    def instanceId(conversationId):
+        return f"conversation:{conversationId}"
+
+    @staticmethod
+    def input(conversationId, conversationData, state=None):
+        """Returns the workflow input answering `conversationData`, keeping the pacing of `state`."""
+        state = state or {}
+        return {
+            "conversation_id": conversationId,
+            "name": conversationData["name"],
+            "message": conversationData["message"],
+            "turn": conversationData.get("turn", 0),
+            "empty_at": state.get("empty_at"),
+            "last_start": state.get("last_start"),
+        }
+
+    def run(self, ctx, state):
+        if self.maxTurns > 0 and state["turn"] >= self.maxTurns:
+            return state["turn"]
+
+        now = ctx.current_utc_datetime.replace(tzinfo=timezone.utc).timestamp()
+        start, emptyAt = self.pacer.slot(now, state["empty_at"], state["last_start"])
+        start = max(start, now + self.debounceSeconds)
+        if start > now:
+            timer = ctx.create_timer(fire_at=timedelta(seconds=start - now))
+            message = ctx.wait_for_external_event("message")
+            if (yield when_any([timer, message])) is message:
+                nextState = self.input(state["conversation_id"], message.get_result(), state)
+                ctx.continue_as_new(nextState, save_events=True)
+                return
+
+        turn = state["turn"] + 1
+        if self.candidates > 1:
+            answer = yield from self.generateCandidates(ctx, state, turn)
+        else:
+            answer = yield from self.generate(ctx, state, turn)
+        if answer is None:
+            return state["turn"]
+        agent, reply = answer
+        messageData = {
+            "type": "complete",
+            "generation_id": reply["generation_id"],
+            "message": reply["data"],
+            "name": agent["name"],
+            "conversation_id": state["conversation_id"],
+            "turn": turn,
+            "workflow_instance_id": ctx.instance_id,
+        }
+        yield ctx.call_activity("publish_message", input=messageData)
+
+        # Messages raised during the turn are kept for the next run
+        ctx.continue_as_new(
+            dict(self.input(state["conversation_id"], messageData), empty_at=emptyAt, last_start=start),
+            save_events=True,
+        )
+
+    def generate(self, ctx, state, turn):
+        exhausted = []
+        while len(exhausted) < self.agentAttempts:
+            selection = {"exclude": state["name"]}
+            if exhausted:
+                selection["exclude_ids"] = exhausted
+            agent = yield ctx.call_activity("select_agent", input=selection)
+            if agent is None:
+                return None
+            stamp = ctx.current_utc_datetime.strftime("%Y%m%dT%H%M%S%f")
+            reply = yield ctx.call_activity(
+                "generate",
+                input={
+                    "agent": agent,
+                    "message": state["message"],
+                    "conversation_id": state["conversation_id"],
+                    "turn": turn,
+                    "generation_id": f"{ctx.instance_id}:{turn}:{stamp}",
+                },
+                retry_policy=self.retryPolicy,
+            )
+            if not reply.get("exhausted"):
+                return agent, reply
+            exhausted.append(agent["id"])
+        return None
+
+    def generateCandidates(self, ctx, state, turn):
+        """Fans the turn out to several agents and keeps the first acceptable reply.
+
+        At most `concurrency` candidates generate at a time. Once one passes
+        `acceptable`, the generations still running are cancelled, the tea
+        of the other finished candidates is released, and only the winner's
+        reply is charged and persisted. If none passes, the longest
+        non-empty reply is taken.
+        """
+        agents = yield ctx.call_activity("select_agents", input={"exclude": state["name"], "count": self.candidates})
+        if not agents:
+            return None
+        stamp = ctx.current_utc_datetime.strftime("%Y%m%dT%H%M%S%f")
+        waiting = [
+            {
+                "agent": agent,
+                "message": state["message"],
+                "conversation_id": state["conversation_id"],
+                "turn": turn,
+                "generation_id": f"{ctx.instance_id}:{turn}:{stamp}:{i}",
+            }
+            for i, agent in enumerate(agents)
+        ]
+        running = {}
+        finished = []
+        winner = None
+        while winner is None and (waiting or running):
+            while waiting and len(running) < self.concurrency:
+                request = waiting.pop(0)
+                running[ctx.call_activity("generate_candidate", input=request)] = request
+            task = yield when_any(list(running))
+            request = running.pop(task)
+            try:
+                reply = task.get_result()
+            except Exception:
+                # The generator released the failed candidate's tea
+                continue
+            if self.acceptable(reply["data"], state["message"]):
+                winner = (request, reply)
+            else:
+                finished.append((request, reply))
+        if winner is None:
+            replies = [candidate for candidate in finished if candidate[1]["data"].strip()]
+            if replies:
+                winner = max(replies, key=lambda candidate: len(candidate[1]["data"]))
+                finished.remove(winner)
+
+        cleanup = []
+        if running:
+            generationIds = [request["generation_id"] for request in running.values()]
+            cleanup.append(ctx.call_activity("cancel_candidates", input=generationIds))
+        if finished:
+            reservations = [
+                {"agent_id": request["agent"]["id"], "reservation_id": reply["reservation_id"]}
+                for request, reply in finished
+            ]
+            cleanup.append(ctx.call_activity("release_candidates", input=reservations))
+        if winner is None:
+            if cleanup:
+                yield when_all(cleanup)
+            return None
+        request, reply = winner
+        accept = ctx.call_activity(
+            "accept_candidate",
+            input=dict(
+                request,
+                reply=reply["data"],
+                token_count=reply["token_count"],
+                reservation_id=reply["reservation_id"],
+            ),
+            retry_policy=self.retryPolicy,
+        )
+        accepted, *_ = yield when_all([accept] + cleanup)
+        return request["agent"], accepted
+
+    def acceptable(self, reply, message):
+        """Whether a candidate reply ends the fan-out: long enough, not too long, and not an echo."""
+        text = reply.strip()
+        if len(text) < self.minReplyChars or (self.maxReplyChars and len(text) > self.maxReplyChars):
+            return False
+        return text != message.strip()
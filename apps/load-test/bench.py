@@ -0,0 +1,247 @@
+"""Runs the user interface, orchestrator and generator code in one process.
+
+The real application modules are imported and wired to an `InMemoryDapr`
+hub and to the fake Ollama through ASGI transports, so a conversation runs
+without sidecars, Redis or a model, and the profilers see only application
+code. The user interface's role is played through its Streamlit-free
+`events_chat` module.
+
+    python bench.py --agents 4 --turns 200 --profile cprofile
+"""
+
+import argparse
+import asyncio
+import cProfile
+import importlib
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import dapr.ext.grpc
+import httpx
+from ollama import AsyncClient
+
+import fake_ollama
+from inmemory_dapr import InMemoryDapr
+
+appsDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loadAppModule(appDir, moduleName="app"):
+    """Imports an app's module, keeping its sibling modules out of the shared module namespace.
+
+    Every app has its own `app`, `metrics` and `dapr_clients` modules; they are
+    dropped from `sys.modules` once imported so the next app gets its own.
+    """
+    path = os.path.join(appsDir, appDir)
+    before = set(sys.modules)
+    sys.path.insert(0, path)
+    try:
+        module = importlib.import_module(moduleName)
+    finally:
+        sys.path.remove(path)
+        for name in set(sys.modules) - before:
+            if getattr(sys.modules[name], "__file__", "") and sys.modules[name].__file__.startswith(path):
+                del sys.modules[name]
+    return module
+
+
+@contextmanager
+def patched(owner, name, value):
+    original = getattr(owner, name)
+    setattr(owner, name, value)
+    try:
+        yield
+    finally:
+        setattr(owner, name, original)
+
+
+async def wire(hub):
+    """Imports the three apps and connects them to the hub and to the fake Ollama."""
+    # Conversations run unpaced unless the environment asks otherwise, so the bench measures the apps
+    for name in (
+        "CONVERSATION_TURNS_PER_MINUTE",
+        "CONVERSATION_MIN_TURN_SECONDS",
+        "CONVERSATION_MAX_TURNS",
+        "CONVERSATION_DEBOUNCE_SECONDS",
+    ):
+        os.environ.setdefault(name, "0")
+    with patched(dapr.ext.grpc, "App", lambda *args, **kwargs: hub.grpcApp("dialogue-orchestrator")):
+        orchestrator = loadAppModule("dialogue-orchestrator")
+    orchestrator.daprPool.clientFactory = hub.client
+    orchestrator.daprPool.start()
+    orchestrator.initializeAgents()
+    orchestrator.dispatcher.start()
+    orchestrator.turnTimer.start()
+
+    generator = loadAppModule("dialogue-generator")
+    generator.daprPool.clientFactory = hub.asyncClient
+    generator.daprPool.waitForSidecar = lambda: None
+    for backend in generator.backends.backends:
+        backend.client = AsyncClient(host=backend.url, transport=httpx.ASGITransport(app=fake_ollama.app))
+    await hub.mountHttpApp("dialogue-generator", generator.app)
+
+    ui = loadAppModule("user-interface", "events_chat")
+    return ui, orchestrator, generator
+
+
+def conversationLength(hub, ui):
+    data, _ = hub.getState(ui.stateStore, f"{ui.conversationKey}:head")
+    return json.loads(data)["count"] if data else 0
+
+
+def busy(hub, orchestrator):
+    dispatcher = orchestrator.dispatcher
+    return hub.pending or dispatcher.inFlight or dispatcher.queued() or len(orchestrator.turnTimer)
+
+
+async def converse(hub, ui, orchestrator, args):
+    """Registers agents, starts the chat and waits until `--turns` messages were generated."""
+    client = hub.client()
+    agents = [
+        await asyncio.to_thread(
+            ui.publishAgent, client, f"Bench Agent {i}", f"A benchmarking guest number {i}.", args.tea
+        )
+        for i in range(args.agents)
+    ]
+    await asyncio.to_thread(hub.drain)
+
+    startedAt = time.monotonic()
+    # With inline delivery the whole conversation runs inside this publish
+    bootstrap = asyncio.create_task(
+        asyncio.to_thread(ui.publishBootstrappingMessage, client, "Shall we put the kettle on?")
+    )
+    while conversationLength(hub, ui) < args.turns and time.monotonic() - startedAt < args.timeout:
+        if bootstrap.done() and not busy(hub, orchestrator):
+            break
+        await asyncio.sleep(0.05)
+    elapsed = time.monotonic() - startedAt
+    turns = conversationLength(hub, ui)
+
+    # Agents without tea are dropped by the orchestrator, which ends the conversation
+    for agent in agents:
+        agent["tea_amount_ml"] = 0
+        await asyncio.to_thread(
+            client.publish_event, ui.pubsubName, ui.topicName_agents, json.dumps(agent)
+        )
+    await bootstrap
+    await asyncio.to_thread(hub.drain, 30)
+    return turns, elapsed
+
+
+class ThreadProfiles:
+    """One cProfile per thread that handles deliveries, merged at the end."""
+
+    def __init__(self):
+        self.local = threading.local()
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def wrap(self, dispatch):
+        def profiledDispatch(*args):
+            profile = getattr(self.local, "profile", None)
+            if profile is None:
+                profile = self.local.profile = cProfile.Profile()
+                with self.lock:
+                    self.profiles.append(profile)
+            profile.enable()
+            try:
+                return dispatch(*args)
+            finally:
+                profile.disable()
+
+        return profiledDispatch
+
+
+async def run(args):
+    hub = InMemoryDapr(delivery=args.delivery)
+    ui, orchestrator, generator = await wire(hub)
+
+    mainProfile = threadProfiles = pyinstrumentProfiler = None
+    if args.profile == "cprofile":
+        threadProfiles = ThreadProfiles()
+        hub.dispatch = threadProfiles.wrap(hub.dispatch)
+        mainProfile = cProfile.Profile()
+        mainProfile.enable()
+    elif args.profile == "pyinstrument":
+        from pyinstrument import Profiler
+
+        pyinstrumentProfiler = Profiler(async_mode="enabled")
+        pyinstrumentProfiler.start()
+    elif args.profile == "tracemalloc":
+        tracemalloc.start(25)
+
+    try:
+        turns, elapsed = await converse(hub, ui, orchestrator, args)
+    finally:
+        if mainProfile:
+            mainProfile.disable()
+        if pyinstrumentProfiler:
+            pyinstrumentProfiler.stop()
+
+    print(f"{turns} messages in {elapsed:.2f}s ({turns / elapsed:.1f}/s), delivery={args.delivery}")
+    print(f"dapr: {hub.metrics()}")
+    print(f"generator: {generator.metrics.snapshot()['counters']}")
+    print(f"orchestrator: {orchestrator.metrics.snapshot()['counters']}")
+
+    if mainProfile:
+        stats = pstats.Stats(mainProfile, *threadProfiles.profiles, stream=io.StringIO())
+        stats.sort_stats(args.sort).print_stats(args.top)
+        print(stats.stream.getvalue())
+        if args.output:
+            stats.dump_stats(args.output)
+    if pyinstrumentProfiler:
+        print(pyinstrumentProfiler.output_text(unicode=True))
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(pyinstrumentProfiler.output_html())
+    if args.profile == "tracemalloc":
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+                tracemalloc.Filter(False, tracemalloc.__file__),
+            )
+        )
+        tracemalloc.stop()
+        for stat in snapshot.statistics("lineno")[: args.top]:
+            print(stat)
+        if args.output:
+            snapshot.dump(args.output)
+
+    orchestrator.turnTimer.stop(5)
+    await asyncio.to_thread(orchestrator.dispatcher.stop, 30)
+    orchestrator.daprPool.close()
+    await hub.close()
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--agents", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=100, help="stop once this many messages were generated")
+    parser.add_argument("--tea", type=int, default=100000, help="tea each agent starts with, in ml")
+    parser.add_argument("--delivery", choices=["thread", "inline"], default="thread")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--profile", choices=["none", "cprofile", "pyinstrument", "tracemalloc"], default="none")
+    parser.add_argument("--sort", default="cumulative", help="cProfile sort key")
+    parser.add_argument("--top", type=int, default=30, help="number of profile lines to print")
+    parser.add_argument("--output", help="file for the raw profile (pstats, pyinstrument HTML or tracemalloc dump)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    # The fake model answers immediately unless told otherwise, so the profile shows the apps
+    fake_ollama.firstTokenSeconds = float(os.getenv("FAKE_OLLAMA_TTFT_SECONDS", "0"))
+    fake_ollama.tokensPerSecond = float(os.getenv("FAKE_OLLAMA_TOKENS_PER_SECOND", "0"))
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
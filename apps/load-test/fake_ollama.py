@@ -0,0 +1,197 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+from datetime import datetime, timezone
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+
+# Generation speed: time to first token, then a steady token rate
+tokensPerSecond = float(os.getenv("FAKE_OLLAMA_TOKENS_PER_SECOND", "50"))
+firstTokenSeconds = float(os.getenv("FAKE_OLLAMA_TTFT_SECONDS", "0.2"))
+
+# Response length, in tokens, drawn per prompt and capped by num_predict
+minTokens = int(os.getenv("FAKE_OLLAMA_MIN_TOKENS", "20"))
+maxTokens = int(os.getenv("FAKE_OLLAMA_MAX_TOKENS", "80"))
+
+# Fraction of requests failing with a 500, before or halfway through the stream
+errorRate = float(os.getenv("FAKE_OLLAMA_ERROR_RATE", "0"))
+midStreamErrorRate = float(os.getenv("FAKE_OLLAMA_MID_STREAM_ERROR_RATE", "0"))
+
+# Same seed and prompt give the same response, timing and failures
+seed = os.getenv("FAKE_OLLAMA_SEED", "0")
+models = [m.strip() for m in os.getenv("FAKE_OLLAMA_MODELS", "llama3").split(",") if m.strip()]
+
+words = (
+    "tea biscuit kettle steep pour milk sugar cup saucer brew leaf chai earl grey "
+    "honestly indeed splendid quite marvellous rather curious perhaps darling old "
+    "chap fancy another lovely weather garden gossip scone jam cream crumpet"
+).split()
+
+app = FastAPI()
+
+# Models that served a request recently, as /api/ps reports them
+loadedModels = {}
+
+
+def modelName(name):
+    return name if ":" in name else f"{name}:latest"
+
+
+def rngFor(model, prompt):
+    digest = hashlib.sha256(f"{seed}|{model}|{prompt}".encode()).digest()
+    return random.Random(digest)
+
+
+def plan(model, prompt, options):
+    """Decides the response tokens and whether and where the request fails."""
+    rng = rngFor(model, prompt)
+    length = rng.randint(minTokens, maxTokens)
+    numPredict = (options or {}).get("num_predict")
+    if numPredict is not None and numPredict >= 0:
+        length = min(length, numPredict)
+    tokens = [rng.choice(words) + " " for _ in range(length)]
+    failAt = None
+    if rng.random() < errorRate:
+        failAt = 0
+    elif rng.random() < midStreamErrorRate:
+        failAt = max(length // 2, 1)
+    return tokens, failAt
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def errorResponse(status, message):
+    return JSONResponse(status_code=status, content={"error": message})
+
+
+async def generateParts(tokens, failAt):
+    """Yields the response tokens at the configured pace, or an error part at `failAt`."""
+    await asyncio.sleep(firstTokenSeconds)
+    for i, token in enumerate(tokens):
+        if failAt is not None and i == failAt:
+            yield {"error": "injected mid-stream failure"}
+            return
+        if i and tokensPerSecond > 0:
+            await asyncio.sleep(1 / tokensPerSecond)
+        yield token
+
+
+def ndjson(parts):
+    async def body():
+        async for part in parts:
+            yield json.dumps(part) + "\n"
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+
+async def respond(body, prompt, wrap, final):
+    """Streams or buffers a generation depending on the request's `stream` flag."""
+    model = modelName(body.get("model") or "")
+    if model not in {modelName(m) for m in models}:
+        return errorResponse(404, f"model '{model}' not found, try pulling it first")
+    options = body.get("options") or {}
+    tokens, failAt = plan(model, prompt, options)
+    if failAt == 0:
+        await asyncio.sleep(firstTokenSeconds)
+        return errorResponse(500, "injected failure")
+
+    async def parts():
+        startedAt = time.monotonic()
+        async for part in generateParts(tokens, failAt):
+            if isinstance(part, dict):
+                yield part
+                return
+            yield wrap(model, part, done=False)
+        loadedModels[model] = time.time()
+        yield dict(
+            wrap(model, "", done=True),
+            done_reason="length" if len(tokens) == options.get("num_predict") else "stop",
+            total_duration=int((time.monotonic() - startedAt) * 1e9),
+            eval_count=len(tokens),
+            **final,
+        )
+
+    if body.get("stream", True):
+        return ndjson(parts())
+
+    collected = []
+    async for part in parts():
+        if "error" in part:
+            return errorResponse(500, part["error"])
+        collected.append(part)
+    merged = collected[-1]
+    if "response" in merged:
+        merged["response"] = "".join(p["response"] for p in collected)
+    else:
+        merged["message"]["content"] = "".join(p["message"]["content"] for p in collected)
+    return merged
+
+
+@app.post("/api/generate")
+async def generate(request: Request):
+    body = await request.json()
+    prompt = body.get("prompt", "")
+    # The returned context stands in for the KV cache: the previous context plus the prompt
+    context = list(body.get("context") or []) + [len(prompt)]
+
+    def wrap(model, text, done):
+        return {"model": model, "created_at": now(), "response": text, "done": done}
+
+    return await respond(body, prompt, wrap, {"context": context})
+
+
+@app.post("/api/chat")
+async def chat(request: Request):
+    body = await request.json()
+    prompt = "\n".join(m.get("content", "") for m in body.get("messages", []))
+
+    def wrap(model, text, done):
+        return {
+            "model": model,
+            "created_at": now(),
+            "message": {"role": "assistant", "content": text},
+            "done": done,
+        }
+
+    return await respond(body, prompt, wrap, {})
+
+
+def modelInfo(name):
+    return {
+        "name": modelName(name),
+        "model": modelName(name),
+        "modified_at": now(),
+        "size": 0,
+        "digest": hashlib.sha256(name.encode()).hexdigest(),
+        "details": {"format": "gguf", "family": "fake", "parameter_size": "0B"},
+    }
+
+
+@app.get("/api/tags")
+async def tags():
+    return {"models": [modelInfo(m) for m in models]}
+
+
+@app.get("/api/ps")
+async def ps():
+    return {"models": [modelInfo(m) for m in loadedModels]}
+
+
+@app.get("/api/version")
+async def version():
+    return {"version": "0.0.0-fake"}
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("FAKE_OLLAMA_PORT", "11434")))
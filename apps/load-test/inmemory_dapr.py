@@ -0,0 +1,421 @@
+"""In-process stand-in for the Dapr sidecar, for profiling the apps in one process.
+
+`InMemoryDapr` keeps state in dicts (with etags and first-write concurrency),
+fans published events out to the subscribers registered through its
+`dapr.ext.grpc.App` replacement, and routes service invocation straight to
+gRPC-style method handlers or to FastAPI apps through an ASGI transport.
+`InMemoryDaprClient` and `InMemoryAsyncDaprClient` implement the parts of
+`DaprClient` the apps use, so they drop into the apps' client pools as the
+`clientFactory`.
+"""
+
+import asyncio
+import itertools
+import logging
+import threading
+import uuid
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack
+from types import SimpleNamespace
+
+import httpx
+from cloudevents.sdk.event import v1
+from dapr.clients.exceptions import DaprHttpError
+from dapr.clients.grpc._request import InvokeMethodRequest, TransactionOperationType
+from dapr.clients.grpc._response import (
+    BulkStateItem,
+    BulkStatesResponse,
+    DaprResponse,
+    InvokeMethodResponse,
+    StateResponse,
+    TopicEventResponse,
+    TopicEventResponseStatus,
+)
+from dapr.clients.grpc._state import Concurrency
+from dapr.serializers import DefaultJSONSerializer
+
+
+class EtagMismatch(Exception):
+    """Raised where the sidecar would reject a write for a stale or missing etag."""
+
+
+class InMemoryDapr:
+    """Shared state store, pub/sub broker and invocation router of one process.
+
+    With `delivery="thread"` events are handed to a thread pool, like the
+    gRPC app server does, and `publish_event` returns at once. With
+    `delivery="inline"` events go through one FIFO pump instead: the
+    outermost publish delivers them one at a time, including the events
+    its subscribers publish in turn, and returns once the queue is empty.
+    That makes a run deterministic and keeps a single delivery thread.
+    """
+
+    def __init__(self, delivery="thread", maxWorkers=10, maxRedeliveries=3):
+        self.delivery = delivery
+        self.maxRedeliveries = maxRedeliveries
+        self.lock = threading.Lock()
+        self.stores = defaultdict(dict)
+        self.etags = itertools.count(1)
+        self.subscriptions = defaultdict(list)
+        self.methods = {}
+        self.httpApps = {}
+        self.exitStack = AsyncExitStack()
+        self.loop = None
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="inmemory-dapr")
+        self.stats = Counter()
+        # Deliveries queued or running, so a benchmark can wait for the pipeline to go quiet
+        self.pending = 0
+        self.idle = threading.Condition()
+        self.inline = deque()
+        self.pumping = False
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    # State
+
+    def getState(self, storeName, key):
+        with self.lock:
+            self.stats["state_reads"] += 1
+            return self.stores[storeName].get(key, (b"", ""))
+
+    def checkEtag(self, storeName, key, etag, options=None):
+        current = self.stores[storeName].get(key)
+        firstWrite = options is not None and options.concurrency == Concurrency.first_write
+        if etag:
+            if current is None or current[1] != etag:
+                raise EtagMismatch(f"possible etag mismatch for key {key}")
+        elif firstWrite and current is not None:
+            raise EtagMismatch(f"key {key} already exists")
+
+    def saveState(self, storeName, key, value, etag=None, options=None):
+        with self.lock:
+            self.checkEtag(storeName, key, etag, options)
+            self.put(storeName, key, value)
+
+    def put(self, storeName, key, value):
+        self.stats["state_writes"] += 1
+        data = value.encode() if isinstance(value, str) else value
+        self.stores[storeName][key] = (data, str(next(self.etags)))
+
+    def deleteState(self, storeName, key, etag=None, options=None):
+        with self.lock:
+            if etag:
+                self.checkEtag(storeName, key, etag, options)
+            self.stats["state_deletes"] += 1
+            self.stores[storeName].pop(key, None)
+
+    def transaction(self, storeName, operations):
+        """Applies every operation, or none of them if any etag doesn't match."""
+        with self.lock:
+            for operation in operations:
+                if operation.etag:
+                    self.checkEtag(storeName, operation.key, operation.etag)
+            self.stats["state_transactions"] += 1
+            for operation in operations:
+                if operation.operation_type == TransactionOperationType.delete:
+                    self.stats["state_deletes"] += 1
+                    self.stores[storeName].pop(operation.key, None)
+                else:
+                    self.put(storeName, operation.key, operation.data)
+
+    # Pub/sub
+
+    def subscribe(self, pubsubName, topic, handler, deadLetterTopic=None):
+        self.subscriptions[(pubsubName, topic)].append((handler, deadLetterTopic))
+
+    def publish(self, pubsubName, topic, data, contentType=None, publishMetadata=None, pump=True):
+        self.count("published")
+        data = data.encode() if isinstance(data, str) else data
+        deliveries = [
+            (pubsubName, topic, handler, deadLetterTopic, data, contentType, publishMetadata or {})
+            for handler, deadLetterTopic in list(self.subscriptions[(pubsubName, topic)])
+        ]
+        with self.idle:
+            self.pending += len(deliveries)
+            if self.delivery == "inline":
+                self.inline.extend(deliveries)
+        if self.delivery != "inline":
+            for delivery in deliveries:
+                self.executor.submit(self.dispatch, *delivery)
+        elif pump:
+            self.pump()
+
+    def pump(self):
+        """Delivers queued inline events until none are left, unless another thread already is."""
+        with self.idle:
+            if self.pumping:
+                return
+            self.pumping = True
+        while True:
+            with self.idle:
+                if not self.inline:
+                    self.pumping = False
+                    return
+                delivery = self.inline.popleft()
+            self.dispatch(*delivery)
+
+    def dispatch(self, *args):
+        try:
+            self.deliver(*args)
+        finally:
+            with self.idle:
+                self.pending -= 1
+                self.idle.notify_all()
+
+    def deliver(self, pubsubName, topic, handler, deadLetterTopic, data, contentType, publishMetadata):
+        """Delivers one event, redelivering it on retry or error like the sidecar does."""
+        event = v1.Event()
+        event.SetEventType("com.dapr.event.sent")
+        event.SetEventID(str(uuid.uuid4()))
+        event.SetSource("inmemory-dapr")
+        event.SetData(data)
+        event.SetContentType(contentType or "application/json")
+        event.SetSubject(topic)
+        event.SetExtensions({f"_metadata_{k}": v for k, v in publishMetadata.items()})
+
+        for _ in range(self.maxRedeliveries + 1):
+            try:
+                response = handler(event)
+            except Exception as e:
+                logging.exception(f"Subscriber of {topic} failed: {e}")
+                response = TopicEventResponse(TopicEventResponseStatus.retry)
+            status = response.status if isinstance(response, TopicEventResponse) else TopicEventResponseStatus.success
+            if status != TopicEventResponseStatus.retry:
+                self.count(f"delivered_{status.name}")
+                return
+            self.count("redelivered")
+        if deadLetterTopic:
+            self.count("dead_lettered")
+            self.publish(pubsubName, deadLetterTopic, data, contentType, publishMetadata)
+        else:
+            self.count("delivered_dropped")
+
+    def drain(self, timeout=None):
+        """Blocks until no delivery is queued or running; returns False on timeout."""
+        with self.idle:
+            return self.idle.wait_for(lambda: self.pending == 0, timeout)
+
+    # Service invocation
+
+    def registerMethod(self, appId, name, handler):
+        self.methods[(appId, name)] = handler
+
+    async def mountHttpApp(self, appId, asgiApp):
+        """Serves `appId` from a FastAPI app, running its lifespan on the current loop."""
+        self.loop = asyncio.get_running_loop()
+        await self.exitStack.enter_async_context(asgiApp.router.lifespan_context(asgiApp))
+        self.httpApps[appId] = await self.exitStack.enter_async_context(
+            httpx.AsyncClient(transport=httpx.ASGITransport(app=asgiApp), base_url=f"http://{appId}", timeout=None)
+        )
+
+    async def close(self):
+        await self.exitStack.aclose()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def callMethod(self, appId, methodName, data, contentType):
+        response = self.methods[(appId, methodName)](InvokeMethodRequest(data, contentType))
+        if isinstance(response, InvokeMethodResponse):
+            return response
+        return InvokeMethodResponse(response, "application/json", status_code=200)
+
+    async def invokeHttp(self, appId, methodName, data, contentType, httpVerb):
+        response = await self.httpApps[appId].request(
+            httpVerb or "POST",
+            f"/{methodName}",
+            content=data.encode() if isinstance(data, str) else data,
+            headers={"content-type": contentType or "application/json"},
+        )
+        if response.status_code >= 400:
+            # Like the sidecar's HTTP invoker, which raises without the response headers
+            raise DaprHttpError(DefaultJSONSerializer(), response.content, response.status_code, response.reason_phrase)
+        return InvokeMethodResponse(
+            response.content, response.headers.get("content-type"), status_code=response.status_code
+        )
+
+    def invoke(self, appId, methodName, data, contentType=None, httpVerb=None):
+        self.count("invocations")
+        if (appId, methodName) in self.methods:
+            return self.callMethod(appId, methodName, data, contentType)
+        if appId in self.httpApps:
+            future = asyncio.run_coroutine_threadsafe(
+                self.invokeHttp(appId, methodName, data, contentType, httpVerb), self.loop
+            )
+            return future.result()
+        raise RuntimeError(f"No app {appId} with method {methodName}")
+
+    async def invokeAsync(self, appId, methodName, data, contentType=None, httpVerb=None):
+        self.count("invocations")
+        if (appId, methodName) in self.methods:
+            return await asyncio.to_thread(self.callMethod, appId, methodName, data, contentType)
+        if appId in self.httpApps:
+            return await self.invokeHttp(appId, methodName, data, contentType, httpVerb)
+        raise RuntimeError(f"No app {appId} with method {methodName}")
+
+    # Factories
+
+    def client(self):
+        return InMemoryDaprClient(self)
+
+    def asyncClient(self):
+        return InMemoryAsyncDaprClient(self)
+
+    def grpcApp(self, appId):
+        return InMemoryApp(self, appId)
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.stats, keys=sum(len(store) for store in self.stores.values()))
+
+
+class InMemoryApp:
+    """Replacement for `dapr.ext.grpc.App` registering handlers with the hub."""
+
+    def __init__(self, hub, appId):
+        self.hub = hub
+        self.appId = appId
+
+    def subscribe(self, pubsub_name, topic, metadata={}, dead_letter_topic=None, **kwargs):
+        def decorator(func):
+            self.hub.subscribe(pubsub_name, topic, func, dead_letter_topic)
+            return func
+
+        return decorator
+
+    def method(self, name):
+        def decorator(func):
+            self.hub.registerMethod(self.appId, name, func)
+            return func
+
+        return decorator
+
+    def run(self, app_port=None, listen_address=None):
+        raise RuntimeError("The in-memory app is driven by InMemoryDapr, it has no server to run")
+
+
+class InMemoryDaprClient:
+    """The subset of `dapr.clients.DaprClient` used by the apps."""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        pass
+
+    def get_state(self, store_name, key, state_metadata=None, metadata=None):
+        data, etag = self.hub.getState(store_name, key)
+        return StateResponse(data=data, etag=etag)
+
+    def get_bulk_state(self, store_name, keys, parallelism=1, states_metadata=None, metadata=None):
+        items = []
+        for key in keys:
+            data, etag = self.hub.getState(store_name, key)
+            items.append(BulkStateItem(key=key, data=data, etag=etag))
+        return BulkStatesResponse(items=items)
+
+    def save_state(self, store_name, key, value, etag=None, options=None, state_metadata=None, metadata=None):
+        self.hub.saveState(store_name, key, value, etag, options)
+        return DaprResponse(())
+
+    def save_bulk_state(self, store_name, states, metadata=None):
+        for state in states:
+            self.hub.saveState(store_name, state.key, state.value, state.etag, state.options)
+        return DaprResponse(())
+
+    def delete_state(self, store_name, key, etag=None, options=None, state_metadata=None, metadata=None):
+        self.hub.deleteState(store_name, key, etag, options)
+        return DaprResponse(())
+
+    def execute_state_transaction(self, store_name, operations, transactional_metadata=None, metadata=None):
+        self.hub.transaction(store_name, operations)
+        return DaprResponse(())
+
+    def publish_event(
+        self, pubsub_name, topic_name, data, publish_metadata={}, metadata=None, data_content_type=None
+    ):
+        self.hub.publish(pubsub_name, topic_name, data, data_content_type, publish_metadata)
+        return DaprResponse(())
+
+    def invoke_method(
+        self,
+        app_id,
+        method_name,
+        data="",
+        content_type=None,
+        metadata=None,
+        http_verb=None,
+        http_querystring=None,
+        timeout=None,
+    ):
+        return self.hub.invoke(app_id, method_name, data, content_type, http_verb)
+
+    def get_metadata(self):
+        return SimpleNamespace(application_id="inmemory-dapr", extended_metadata=self.hub.metrics())
+
+
+class InMemoryAsyncDaprClient:
+    """The subset of `dapr.aio.clients.DaprClient` used by the apps."""
+
+    def __init__(self, hub):
+        self.sync = InMemoryDaprClient(hub)
+        self.hub = hub
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        pass
+
+    async def get_state(self, *args, **kwargs):
+        return self.sync.get_state(*args, **kwargs)
+
+    async def get_bulk_state(self, *args, **kwargs):
+        return self.sync.get_bulk_state(*args, **kwargs)
+
+    async def save_state(self, *args, **kwargs):
+        return self.sync.save_state(*args, **kwargs)
+
+    async def save_bulk_state(self, *args, **kwargs):
+        return self.sync.save_bulk_state(*args, **kwargs)
+
+    async def delete_state(self, *args, **kwargs):
+        return self.sync.delete_state(*args, **kwargs)
+
+    async def execute_state_transaction(self, *args, **kwargs):
+        return self.sync.execute_state_transaction(*args, **kwargs)
+
+    async def publish_event(
+        self, pubsub_name, topic_name, data, publish_metadata={}, metadata=None, data_content_type=None
+    ):
+        self.hub.publish(pubsub_name, topic_name, data, data_content_type, publish_metadata, pump=False)
+        if self.hub.delivery == "inline" and not self.hub.pumping:
+            # Subscribers are blocking code, keep them off the event loop
+            await asyncio.to_thread(self.hub.pump)
+        return DaprResponse(())
+
+    async def invoke_method(
+        self,
+        app_id,
+        method_name,
+        data="",
+        content_type=None,
+        metadata=None,
+        http_verb=None,
+        http_querystring=None,
+        timeout=None,
+    ):
+        return await self.hub.invokeAsync(app_id, method_name, data, content_type, http_verb)
+
+    async def get_metadata(self):
+        return self.sync.get_metadata()
@@ -0,0 +1,310 @@
+"""Drives the dialogue pipeline with synthetic agents and conversations.
+
+`generator` calls the dialogue generator's /generate/stream directly and times
+every request. `pipeline` goes through Dapr like the user interface does: it
+publishes the agents, seeds the conversations and then watches the
+conversation logs grow while the orchestrator and the generator take turns.
+Both print throughput and p50/p95/p99 latencies per stage, plus the services'
+own /metrics timings.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from collections import Counter, defaultdict
+
+import httpx
+
+seedMessages = [
+    "Shall we put the kettle on?",
+    "I've been meaning to ask you about that garden of yours.",
+    "Is it just me, or is the tea stronger today?",
+    "Tell me something surprising about yourself.",
+]
+
+
+def makeAgents(count, teaAmountMl):
+    return [
+        {
+            "id": f"loadgen-agent-{i}",
+            "name": f"Loadgen Agent {i}",
+            "description": f"A chatty synthetic guest number {i} who loves tea and puns.",
+            "tea_amount_ml": teaAmountMl,
+        }
+        for i in range(count)
+    ]
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an unsorted list."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+class Recorder:
+    """Collects per-stage latencies and outcome counts for one run."""
+
+    def __init__(self):
+        self.stages = defaultdict(list)
+        self.outcomes = Counter()
+        self.startedAt = time.monotonic()
+        self.completed = 0
+
+    def observe(self, stage, seconds):
+        self.stages[stage].append(seconds)
+
+    def report(self):
+        elapsed = time.monotonic() - self.startedAt
+        return {
+            "elapsed_seconds": round(elapsed, 3),
+            "completed": self.completed,
+            "throughput_per_second": round(self.completed / elapsed, 3) if elapsed else 0.0,
+            "outcomes": dict(self.outcomes),
+            "stages": {
+                stage: {
+                    "count": len(values),
+                    "p50": round(percentile(values, 0.50), 4),
+                    "p95": round(percentile(values, 0.95), 4),
+                    "p99": round(percentile(values, 0.99), 4),
+                    "max": round(max(values), 4),
+                }
+                for stage, values in self.stages.items()
+                if values
+            },
+        }
+
+
+def printReport(report, serviceMetrics):
+    print(
+        f"\n{report['completed']} completed in {report['elapsed_seconds']}s "
+        f"({report['throughput_per_second']}/s)"
+    )
+    print("Outcomes: " + ", ".join(f"{k}={v}" for k, v in sorted(report["outcomes"].items())))
+    print(f"\n{'stage':<24}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for stage, s in report["stages"].items():
+        print(f"{stage:<24}{s['count']:>8}{s['p50']:>10.3f}{s['p95']:>10.3f}{s['p99']:>10.3f}{s['max']:>10.3f}")
+    for service, snapshot in serviceMetrics.items():
+        if not snapshot:
+            continue
+        print(f"\n{service} timings (avg / max seconds)")
+        for name, timing in snapshot.get("timings", {}).items():
+            print(f"  {name:<36}{timing['avg']:>10.3f}{timing['max']:>10.3f}  n={timing['count']}")
+        for name, value in sorted(snapshot.get("counters", {}).items()):
+            print(f"  {name:<36}{value:>10}")
+
+
+async def fetchMetrics(client, url):
+    try:
+        response = await client.get(url)
+        response.raise_for_status()
+        return response.json()
+    except (httpx.HTTPError, ValueError) as e:
+        print(f"Could not read metrics from {url}: {e}")
+        return None
+
+
+async def streamOne(client, recorder, url, agent, message, conversationId, deadline):
+    """Sends one /generate/stream request and returns the generated message, if any."""
+    payload = {"agent": agent, "message": message, "conversation_id": conversationId}
+    if deadline:
+        payload["deadline_seconds"] = deadline
+    sentAt = time.monotonic()
+    firstChunkAt = None
+    event = None
+    try:
+        async with client.stream("POST", f"{url}/generate/stream", json=payload) as response:
+            if response.status_code != 200:
+                await response.aread()
+                recorder.outcomes[f"http_{response.status_code}"] += 1
+                recorder.observe("rejected", time.monotonic() - sentAt)
+                return None
+            async for line in response.aiter_lines():
+                if line.startswith("event: "):
+                    event = line[len("event: ") :]
+                elif line.startswith("data: "):
+                    data = json.loads(line[len("data: ") :])
+                    if event == "chunk" and firstChunkAt is None:
+                        firstChunkAt = time.monotonic()
+                        recorder.observe("time_to_first_chunk", firstChunkAt - sentAt)
+                    elif event == "complete":
+                        doneAt = time.monotonic()
+                        recorder.observe("stream", doneAt - (firstChunkAt or sentAt))
+                        recorder.observe("total", doneAt - sentAt)
+                        recorder.outcomes["complete"] += 1
+                        recorder.completed += 1
+                        return data["message"]
+                    elif event == "aborted":
+                        recorder.outcomes[f"aborted_{data['reason']}"] += 1
+                        return None
+    except httpx.HTTPError as e:
+        recorder.outcomes[type(e).__name__] += 1
+        return None
+    recorder.outcomes["truncated_stream"] += 1
+    return None
+
+
+async def runGenerator(args):
+    """Sends `--requests` generations with `--concurrency` in flight, rotating agents and conversations."""
+    rng = random.Random(args.seed)
+    agents = makeAgents(args.agents, args.tea)
+    conversations = {
+        f"loadgen-{args.run_id}-{i}": seedMessages[i % len(seedMessages)]
+        for i in range(args.conversations)
+    }
+    conversationIds = list(conversations)
+    recorder = Recorder()
+    pending = iter(range(args.requests))
+
+    async with httpx.AsyncClient(timeout=args.timeout) as client:
+
+        async def worker():
+            for _ in pending:
+                conversationId = rng.choice(conversationIds)
+                agent = dict(rng.choice(agents))
+                reply = await streamOne(
+                    client,
+                    recorder,
+                    args.generator_url,
+                    agent,
+                    conversations[conversationId],
+                    conversationId,
+                    args.deadline,
+                )
+                if reply:
+                    conversations[conversationId] = reply
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        report = recorder.report()
+        serviceMetrics = {"dialogue-generator": await fetchMetrics(client, f"{args.generator_url}/metrics")}
+    return report, serviceMetrics
+
+
+async def publish(client, args, topic, data):
+    response = await client.post(f"{args.dapr_url}/v1.0/publish/{args.pubsub}/{topic}", json=data)
+    response.raise_for_status()
+
+
+async def readCount(client, args, conversationId):
+    response = await client.get(f"{args.dapr_url}/v1.0/state/{args.state_store}/{conversationId}:head")
+    if response.status_code == 204 or not response.content:
+        return 0
+    response.raise_for_status()
+    return response.json()["count"]
+
+
+async def runPipeline(args):
+    """Publishes agents and seeds conversations through Dapr, then times the turns they produce."""
+    agents = makeAgents(args.agents, args.tea)
+    conversationIds = [f"loadgen-{args.run_id}-{i}" for i in range(args.conversations)]
+    recorder = Recorder()
+
+    async with httpx.AsyncClient(timeout=args.timeout) as client:
+        await asyncio.gather(*(publish(client, args, args.agents_topic, agent) for agent in agents))
+        # Give the orchestrator a moment to register the agents before the first turn
+        await asyncio.sleep(args.settle)
+
+        counts = {cid: await readCount(client, args, cid) for cid in conversationIds}
+        seededAt = {}
+        lastTurnAt = {}
+        for i, conversationId in enumerate(conversationIds):
+            seededAt[conversationId] = time.monotonic()
+            await publish(
+                client,
+                args,
+                args.conversations_topic,
+                {
+                    "type": "complete",
+                    "name": "loadgen",
+                    "message": seedMessages[i % len(seedMessages)],
+                    "conversation_id": conversationId,
+                },
+            )
+
+        recorder.startedAt = time.monotonic()
+        endAt = recorder.startedAt + args.duration
+        while time.monotonic() < endAt:
+            await asyncio.sleep(args.poll_interval)
+            for conversationId in conversationIds:
+                try:
+                    count = await readCount(client, args, conversationId)
+                except httpx.HTTPError as e:
+                    recorder.outcomes[type(e).__name__] += 1
+                    continue
+                turns = count - counts[conversationId]
+                if turns <= 0:
+                    continue
+                polledAt = time.monotonic()
+                if conversationId not in lastTurnAt:
+                    recorder.observe("seed_to_first_turn", polledAt - seededAt[conversationId])
+                else:
+                    # Several turns within one poll are spread evenly over the interval
+                    for _ in range(turns):
+                        recorder.observe("turn_interval", (polledAt - lastTurnAt[conversationId]) / turns)
+                lastTurnAt[conversationId] = polledAt
+                counts[conversationId] = count
+                recorder.completed += turns
+                recorder.outcomes["turns"] += turns
+
+        stalled = [cid for cid in conversationIds if cid not in lastTurnAt]
+        recorder.outcomes["stalled_conversations"] = len(stalled)
+        report = recorder.report()
+        serviceMetrics = {
+            "dialogue-generator": await fetchMetrics(client, f"{args.generator_url}/metrics"),
+            "dialogue-orchestrator": await fetchMetrics(
+                client, f"{args.dapr_url}/v1.0/invoke/dialogue-orchestrator/method/metrics"
+            ),
+        }
+
+        if not args.keep_agents:
+            # Agents without tea are removed by the orchestrator, which ends the conversations
+            await asyncio.gather(
+                *(publish(client, args, args.agents_topic, dict(agent, tea_amount_ml=0)) for agent in agents)
+            )
+    return report, serviceMetrics
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--agents", type=int, default=8, help="number of synthetic agents")
+    parser.add_argument("--conversations", type=int, default=4, help="number of conversations to seed")
+    parser.add_argument("--tea", type=int, default=1000, help="tea each agent starts with, in ml")
+    parser.add_argument("--generator-url", default="http://localhost:5400")
+    parser.add_argument("--timeout", type=float, default=300.0, help="HTTP timeout in seconds")
+    parser.add_argument("--seed", type=int, default=0, help="seed for agent and conversation choices")
+    parser.add_argument("--run-id", default=str(int(time.time())), help="suffix keeping conversation ids unique per run")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    modes = parser.add_subparsers(dest="mode", required=True)
+
+    generator = modes.add_parser("generator", help="call the dialogue generator directly")
+    generator.add_argument("--requests", type=int, default=100)
+    generator.add_argument("--concurrency", type=int, default=8)
+    generator.add_argument("--deadline", type=float, default=None, help="deadline_seconds sent with each request")
+
+    pipeline = modes.add_parser("pipeline", help="drive the orchestrator and generator through Dapr")
+    pipeline.add_argument("--dapr-url", default="http://localhost:3500", help="HTTP endpoint of any Dapr sidecar")
+    pipeline.add_argument("--pubsub", default="pubsub")
+    pipeline.add_argument("--state-store", default="statestore")
+    pipeline.add_argument("--agents-topic", default="agents")
+    pipeline.add_argument("--conversations-topic", default="conversations")
+    pipeline.add_argument("--duration", type=float, default=60.0, help="seconds to watch the conversations")
+    pipeline.add_argument("--poll-interval", type=float, default=0.25)
+    pipeline.add_argument("--settle", type=float, default=2.0, help="seconds to wait after publishing agents")
+    pipeline.add_argument("--keep-agents", action="store_true", help="leave the agents registered afterwards")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    run = runGenerator if args.mode == "generator" else runPipeline
+    report, serviceMetrics = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps({"report": report, "metrics": serviceMetrics}, indent=2))
+    else:
+        printReport(report, serviceMetrics)
+
+
+if __name__ == "__main__":
+    main()
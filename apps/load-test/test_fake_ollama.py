@@ -0,0 +1,64 @@
+import asyncio
+import unittest
+
+import httpx
+from ollama import AsyncClient, ResponseError
+
+import fake_ollama
+import loadgen
+
+
+def fakeClient():
+    return AsyncClient(host="http://fake", transport=httpx.ASGITransport(app=fake_ollama.app))
+
+
+async def generate(**kwargs):
+    parts = []
+    async for part in await fakeClient().generate(model="llama3", stream=True, **kwargs):
+        parts.append(part)
+    return parts
+
+
+class FakeOllamaTest(unittest.TestCase):
+    def setUp(self):
+        fake_ollama.firstTokenSeconds = 0
+        fake_ollama.tokensPerSecond = 0
+        fake_ollama.errorRate = 0
+        fake_ollama.midStreamErrorRate = 0
+
+    def test_same_prompt_gives_same_response(self):
+        first = asyncio.run(generate(prompt="Shall we?"))
+        second = asyncio.run(generate(prompt="Shall we?"))
+        self.assertEqual(
+            "".join(p["response"] for p in first), "".join(p["response"] for p in second)
+        )
+        self.assertTrue(first[-1]["done"])
+
+    def test_num_predict_caps_the_response(self):
+        parts = asyncio.run(generate(prompt="Shall we?", options={"num_predict": 5}, context=[7]))
+        self.assertEqual(len(parts), 6)
+        self.assertEqual(parts[-1]["done_reason"], "length")
+        self.assertEqual(parts[-1]["context"][0], 7)
+
+    def test_injected_errors_surface_as_response_errors(self):
+        fake_ollama.errorRate = 1
+        with self.assertRaises(ResponseError) as raised:
+            asyncio.run(generate(prompt="Shall we?"))
+        self.assertEqual(raised.exception.status_code, 500)
+
+    def test_unknown_model_is_a_404(self):
+        with self.assertRaises(ResponseError) as raised:
+            asyncio.run(fakeClient().generate(model="mistral", prompt="Shall we?"))
+        self.assertEqual(raised.exception.status_code, 404)
+
+
+class PercentileTest(unittest.TestCase):
+    def test_nearest_rank(self):
+        values = list(range(1, 101))
+        self.assertEqual(loadgen.percentile(values, 0.50), 50)
+        self.assertEqual(loadgen.percentile(values, 0.99), 99)
+        self.assertEqual(loadgen.percentile([3.0], 0.95), 3.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
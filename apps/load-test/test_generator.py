@@ -0,0 +1,249 @@
+import asyncio
+import json
+import time
+import unittest
+from types import SimpleNamespace
+
+from bench import loadAppModule
+from inmemory_dapr import InMemoryDapr
+
+generator = loadAppModule("dialogue-generator")
+
+
+class StreamSupervisionTest(unittest.TestCase):
+    def setUp(self):
+        self.closed = False
+        self.disconnected = False
+        self.httpRequest = SimpleNamespace(is_disconnected=self.isDisconnected)
+        generator.disconnectPollSeconds = 0.01
+        generator.streamResponse = self.stalledStream
+
+    def tearDown(self):
+        generator.streamResponse = self.originalStream
+
+    originalStream = generator.streamResponse
+
+    async def isDisconnected(self):
+        return self.disconnected
+
+    async def stalledStream(self, generation):
+        try:
+            yield "Hello"
+            yield " there"
+            # The upstream stops sending without closing the stream
+            await asyncio.sleep(60)
+        finally:
+            self.closed = True
+
+    def generation(self, seconds):
+        deadline = time.monotonic() + seconds
+        return SimpleNamespace(cancelled=False, remaining=lambda: deadline - time.monotonic())
+
+    def stream(self, generation, received):
+        async def consume():
+            async for chunk in generator.superviseStream(generation, self.httpRequest):
+                received.append(chunk)
+
+        return asyncio.run(asyncio.wait_for(consume(), 5))
+
+    def test_a_stalled_stream_is_aborted_at_the_deadline(self):
+        received = []
+        startedAt = time.monotonic()
+        with self.assertRaises(generator.GenerationAborted) as aborted:
+            self.stream(self.generation(0.2), received)
+        self.assertEqual((aborted.exception.reason, received), ("deadline", ["Hello", " there"]))
+        self.assertLess(time.monotonic() - startedAt, 2)
+        # The upstream stream is closed, so the admission slot can go to the next request
+        self.assertTrue(self.closed)
+
+    def test_a_stalled_stream_is_aborted_when_cancelled_or_the_client_leaves(self):
+        generation = self.generation(30)
+        generation.cancelled = True
+        with self.assertRaises(generator.GenerationAborted) as aborted:
+            self.stream(generation, [])
+        self.assertEqual(aborted.exception.reason, "cancelled")
+
+        self.disconnected = True
+        with self.assertRaises(generator.GenerationAborted) as aborted:
+            self.stream(self.generation(30), [])
+        self.assertEqual(aborted.exception.reason, "disconnect")
+
+    def test_a_finished_stream_yields_every_chunk(self):
+        async def stream(generation):
+            for chunk in ("a", "b", "c"):
+                await asyncio.sleep(0)
+                yield chunk
+
+        generator.streamResponse = stream
+        received = []
+        self.stream(self.generation(30), received)
+        self.assertEqual(received, ["a", "b", "c"])
+
+
+class RecentHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.hub = InMemoryDapr()
+        generator.daprPool.clientFactory = self.hub.asyncClient
+        generator.daprPool.waitForSidecar = lambda: None
+        asyncio.run(generator.daprPool.start())
+        generator.conversationLogs.clear()
+        generator.recentHistory.entries.clear()
+
+    def tearDown(self):
+        asyncio.run(generator.daprPool.close())
+
+    def test_messages_appended_by_another_replica_reach_the_next_prompt(self):
+        otherReplica = generator.ConversationLog(self.hub.asyncClient, generator.stateStore, "c")
+
+        async def converse():
+            await generator.saveToState("c", {"name": "Alice", "message": "Hello"})
+            self.assertEqual(await generator.loadState("c"), ([{"name": "Alice", "message": "Hello"}], 1))
+            await otherReplica.append({"name": "Bob", "message": "Hi"})
+            return await generator.loadState("c")
+
+        messages, version = asyncio.run(converse())
+        self.assertEqual(([m["message"] for m in messages], version), (["Hello", "Hi"], 2))
+
+
+class CompletionTestCase(unittest.TestCase):
+    """Runs the generator against the in-memory hub, recording the tea deltas it publishes."""
+
+    def setUp(self):
+        self.hub = InMemoryDapr(delivery="inline")
+        generator.daprPool.clientFactory = self.hub.asyncClient
+        generator.daprPool.waitForSidecar = lambda: None
+        asyncio.run(generator.daprPool.start())
+        generator.conversationLogs.clear()
+        generator.recentHistory.entries.clear()
+        self.teaDeltas = []
+        self.hub.subscribe("pubsub", "agents", lambda event: self.teaDeltas.append(json.loads(event.Data())))
+
+    def tearDown(self):
+        asyncio.run(generator.daprPool.close())
+
+    def generation(self, reply, **fields):
+        agent = {"id": "a", "name": "Alice", "description": "", "tea_amount_ml": 100}
+        request = generator.DialogueRequest(agent=agent, message="Hello", conversation_id="c", publish=False, **fields)
+        generation = generator.Generation(request)
+        generation.responseChunks = [reply]
+        generation.tokenCount = 200
+        return generation
+
+
+class RetriedCompletionTest(CompletionTestCase):
+    def test_a_retried_generation_is_charged_and_persisted_once(self):
+        first = asyncio.run(generator.completeGeneration(self.generation("Hi", generation_id="turn-1")))
+        # The caller timed out and retried; the retry generated another reply
+        retried = asyncio.run(generator.completeGeneration(self.generation("Hi again", generation_id="turn-1")))
+        self.assertEqual((retried["message"], retried["generation_id"]), (first["message"], "turn-1"))
+        self.assertEqual(asyncio.run(generator.getConversationLog("c").count()), 1)
+        self.assertEqual([delta["delta_ml"] for delta in self.teaDeltas], [-2])
+
+    def test_a_retry_waits_while_the_first_attempt_is_completing(self):
+        generation = self.generation("Hi", generation_id="turn-1")
+        self.assertIsNone(asyncio.run(generator.claimCompletion(generation)))
+        with self.assertRaises(generator.HTTPException) as conflict:
+            asyncio.run(generator.completeGeneration(self.generation("Hi again", generation_id="turn-1")))
+        self.assertEqual(conflict.exception.status_code, 409)
+        self.assertEqual(asyncio.run(generator.getConversationLog("c").count()), 0)
+
+    def test_generations_without_a_caller_chosen_id_are_not_claimed(self):
+        asyncio.run(generator.completeGeneration(self.generation("Hi")))
+        asyncio.run(generator.completeGeneration(self.generation("Hi")))
+        self.assertEqual(asyncio.run(generator.getConversationLog("c").count()), 2)
+
+
+class StreamedCandidateTest(CompletionTestCase):
+    def test_a_streamed_candidate_is_handed_over_not_charged(self):
+        async def stream(generation):
+            for chunk in ("Hi", " there"):
+                generation.responseChunks.append(chunk)
+                generation.tokenCount += 1
+                yield chunk
+
+        async def isDisconnected():
+            return False
+
+        original, generator.streamResponse = generator.streamResponse, stream
+        try:
+            agent = {"id": "a", "name": "Alice", "description": "", "tea_amount_ml": 100}
+            request = generator.DialogueRequest(agent=agent, message="Hello", conversation_id="c", candidate=True)
+
+            async def consume():
+                response = await generator.streamDialogueGenerator(
+                    request, SimpleNamespace(is_disconnected=isDisconnected)
+                )
+                body = [part async for part in response.body_iterator]
+                await response.background()
+                return body
+
+            body = asyncio.run(consume())
+        finally:
+            generator.streamResponse = original
+        event, data = body[-1].strip().split("\n")
+        self.assertEqual((event, json.loads(data[len("data: ") :])["data"]), ("event: candidate", "Hi there"))
+        self.assertEqual(asyncio.run(generator.getConversationLog("c").count()), 0)
+        self.assertEqual((self.teaDeltas, generator.activeGenerations), ([], {}))
+
+
+class CandidateCancellationTest(unittest.TestCase):
+    def setUp(self):
+        self.hub = InMemoryDapr()
+        generator.daprPool.clientFactory = self.hub.asyncClient
+        generator.daprPool.waitForSidecar = lambda: None
+        asyncio.run(generator.daprPool.start())
+        generator.activeGenerations.clear()
+
+    def tearDown(self):
+        generator.activeGenerations.clear()
+        asyncio.run(generator.daprPool.close())
+
+    def candidate(self, generationId):
+        deadline = time.monotonic() + 30
+        return SimpleNamespace(
+            generationId=generationId,
+            candidate=True,
+            cancelled=False,
+            priority=0,
+            maxTokens=100,
+            reservationId=None,
+            remaining=lambda: deadline - time.monotonic(),
+        )
+
+    def test_a_cancel_served_by_another_replica_reaches_queued_candidates(self):
+        cancellation = generator.CandidateCancellation(generation_ids=["chat:3:1:0", "chat:3:1:1"])
+        # Neither candidate runs on the replica serving the cancel
+        self.assertEqual(asyncio.run(generator.cancelGenerations(cancellation)), {"cancelled": 0})
+
+        lost, other = self.candidate("chat:3:1:1"), self.candidate("chat:4:1:0")
+        generator.activeGenerations.update({lost.generationId: lost, other.generationId: other})
+        asyncio.run(generator.applyCancellations())
+        self.assertEqual((lost.cancelled, other.cancelled), (True, False))
+
+    def test_admission_turns_away_a_candidate_cancelled_while_queued(self):
+        generation = self.candidate("chat:3:1:0")
+        generation.cancelled = True
+        with self.assertRaises(generator.GenerationAborted) as aborted:
+            asyncio.run(generator.admit(generation))
+        self.assertEqual(aborted.exception.reason, "cancelled")
+        self.assertEqual(generator.admission.inFlight(), 0)
+
+    def test_tea_reservations_expire_shortly_after_the_deadline(self):
+        calls = []
+
+        async def callAgentActor(agentId, method, data):
+            calls.append(data)
+            return {"reservation_id": "r1", "profile": None, "granted_ml": 1}
+
+        original, generator.callAgentActor = generator.callAgentActor, callAgentActor
+        try:
+            generation = self.candidate("chat:3:1:0")
+            generation.agent = {"id": "agent-1"}
+            asyncio.run(generator.reserveTea(generation))
+        finally:
+            generator.callAgentActor = original
+        self.assertLessEqual(calls[0]["ttl_seconds"], 30 + generator.reservationGraceSeconds)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import asyncio
+import json
+import unittest
+
+from dapr.clients.grpc._request import TransactionalStateOperation, TransactionOperationType
+from dapr.clients.grpc._response import TopicEventResponse
+from dapr.clients.grpc._state import Concurrency, StateOptions
+
+from inmemory_dapr import EtagMismatch, InMemoryDapr
+
+
+class StateTest(unittest.TestCase):
+    def setUp(self):
+        self.client = InMemoryDapr().client()
+
+    def test_etag_guards_writes(self):
+        self.client.save_state("store", "key", "one")
+        etag = self.client.get_state("store", "key").etag
+        self.client.save_state("store", "key", "two", etag=etag)
+        with self.assertRaises(EtagMismatch):
+            self.client.save_state("store", "key", "three", etag=etag)
+        self.assertEqual(self.client.get_state("store", "key").data, b"two")
+
+    def test_first_write_without_etag_only_creates(self):
+        options = StateOptions(concurrency=Concurrency.first_write)
+        self.client.save_state("store", "key", "one", options=options)
+        with self.assertRaises(EtagMismatch):
+            self.client.save_state("store", "key", "two", options=options)
+
+    def test_transaction_is_all_or_nothing(self):
+        self.client.save_state("store", "a", "1")
+        operations = [
+            TransactionalStateOperation(key="b", data="2"),
+            TransactionalStateOperation(key="a", etag="stale", operation_type=TransactionOperationType.delete),
+        ]
+        with self.assertRaises(EtagMismatch):
+            self.client.execute_state_transaction("store", operations)
+        items = self.client.get_bulk_state("store", ["a", "b"]).items
+        self.assertEqual([item.data for item in items], [b"1", b""])
+
+
+class PubSubTest(unittest.TestCase):
+    def test_fan_out_to_every_subscriber(self):
+        hub = InMemoryDapr(delivery="inline")
+        received = []
+        app = hub.grpcApp("app")
+        app.subscribe("pubsub", "topic")(lambda event: received.append(("a", json.loads(event.Data()))))
+        app.subscribe("pubsub", "topic")(lambda event: received.append(("b", json.loads(event.Data()))))
+        hub.client().publish_event("pubsub", "topic", json.dumps({"n": 1}))
+        self.assertEqual(received, [("a", {"n": 1}), ("b", {"n": 1})])
+
+    def test_retries_then_dead_letters(self):
+        hub = InMemoryDapr(delivery="inline", maxRedeliveries=2)
+        attempts = []
+        deadLetters = []
+        app = hub.grpcApp("app")
+        app.subscribe("pubsub", "topic", dead_letter_topic="dead")(
+            lambda event: attempts.append(1) or TopicEventResponse("retry")
+        )
+        app.subscribe("pubsub", "dead")(lambda event: deadLetters.append(event.Data()))
+        hub.client().publish_event("pubsub", "topic", "x")
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(deadLetters, [b"x"])
+
+    def test_thread_delivery_drains(self):
+        hub = InMemoryDapr()
+        received = []
+        hub.grpcApp("app").subscribe("pubsub", "topic")(lambda event: received.append(event.Data()))
+        for i in range(20):
+            hub.client().publish_event("pubsub", "topic", str(i))
+        self.assertTrue(hub.drain(5))
+        self.assertEqual(len(received), 20)
+
+
+class InvokeTest(unittest.TestCase):
+    def test_async_client_reaches_grpc_methods(self):
+        hub = InMemoryDapr()
+        hub.grpcApp("app").method("echo")(lambda request: request.text().upper())
+        response = asyncio.run(hub.asyncClient().invoke_method("app", "echo", data="hi"))
+        self.assertEqual(response.text(), "HI")
+
+
+if __name__ == "__main__":
+    unittest.main()
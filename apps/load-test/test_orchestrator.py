@@ -0,0 +1,192 @@
+import json
+import os
+import unittest
+from unittest import mock
+
+import dapr.ext.grpc
+from dapr.clients.exceptions import DaprHttpError
+from dapr.serializers import DefaultJSONSerializer
+
+from bench import loadAppModule, patched
+from inmemory_dapr import InMemoryDapr
+
+
+def loadOrchestrator(hub, **env):
+    """Imports a fresh orchestrator wired to the hub, with `env` on top of an unpaced configuration."""
+    env = dict({"CONVERSATION_TURNS_PER_MINUTE": "0", "CONVERSATION_DEBOUNCE_SECONDS": "0"}, **env)
+    with mock.patch.dict(os.environ, env), patched(
+        dapr.ext.grpc, "App", lambda *args, **kwargs: hub.grpcApp("dialogue-orchestrator")
+    ):
+        orchestrator = loadAppModule("dialogue-orchestrator")
+    orchestrator.daprPool.clientFactory = hub.client
+    orchestrator.daprPool.start()
+    orchestrator.agentRegistry.load([{"id": "a", "name": "Alice", "description": "", "tea_amount_ml": 100}])
+    return orchestrator
+
+
+class PartitionedTurnsTest(unittest.TestCase):
+    def setUp(self):
+        self.hub = InMemoryDapr(delivery="inline")
+        # Debounced, so booked turns stay pending on the (stopped) turn timer
+        self.orchestrator = loadOrchestrator(
+            self.hub,
+            CONVERSATION_PARTITION_LEASES_ENABLED="true",
+            REPLICA_ID="here",
+            CONVERSATION_DEBOUNCE_SECONDS="60",
+        )
+        self.partition = self.orchestrator.partitionLeases.partitionFor("c")
+        self.notices = []
+        self.hub.subscribe("pubsub", "conversations.there", lambda event: self.notices.append(json.loads(event.Data())))
+        self.deadLettered = []
+        self.hub.subscribe(
+            "pubsub", "conversations-deadletter", lambda event: self.deadLettered.append(json.loads(event.Data()))
+        )
+        self.generated = []
+        self.hub.registerMethod("dialogue-generator", "generate", self.generate)
+
+    def generate(self, request):
+        self.generated.append(json.loads(request.data))
+        return json.dumps({"data": "Hi", "generation_id": "g"})
+
+    def leaseTo(self, owner, seconds=60):
+        leases = self.orchestrator.partitionLeases
+        key = leases.key(self.partition)
+        self.hub.put(leases.storeName, key, json.dumps({"owner": owner, "expires_at": leases.clock() + seconds}))
+        leases.leases.clear()
+
+    def inbox(self):
+        data, _ = self.hub.getState("statestore", self.orchestrator.turnInbox.key(self.partition))
+        return json.loads(data) if data else {}
+
+    def event(self, **fields):
+        return mock.Mock(Data=lambda: json.dumps(dict({"name": "God", "message": "Hello", "conversation_id": "c"}, **fields)))
+
+    def test_turns_of_another_replicas_partition_are_left_in_its_inbox(self):
+        self.leaseTo("there")
+        (status,) = self.orchestrator.startTurns([self.event()])
+        self.assertEqual(status.status.name, "success")
+        self.assertEqual(self.notices, [{"partition": self.partition}])
+        self.assertEqual(self.inbox()["c"]["forwards"], 1)
+
+    def test_a_turn_past_the_forward_limit_is_dead_lettered_not_dropped(self):
+        self.leaseTo("there")
+        (status,) = self.orchestrator.startTurns([self.event(forwards=3)])
+        self.assertEqual(status.status.name, "success")
+        self.assertEqual(([data["message"] for data in self.deadLettered], self.notices), (["Hello"], []))
+        self.assertEqual(self.orchestrator.metrics.counters["turns_dead_lettered"], 1)
+
+    def test_the_next_holder_takes_turns_left_for_a_replica_that_died(self):
+        self.leaseTo("there")
+        self.orchestrator.startTurns([self.event()])
+        # "there" never takes them and its lease runs out
+        self.leaseTo("there", seconds=-1)
+        self.assertEqual(self.orchestrator.conversationHolder("c"), "here")
+        self.assertEqual(self.orchestrator.turnCoalescer.take("c")["message"], "Hello")
+        self.assertEqual(self.inbox(), {})
+
+    def test_a_notice_books_the_turns_left_in_the_inbox(self):
+        self.leaseTo("here")
+        inbox = self.orchestrator.turnInbox
+        inbox.put(self.hub.client(), self.partition, "c", {"name": "God", "message": "Hello", "conversation_id": "c"})
+        status = self.orchestrator.replicaSubscriber(mock.Mock(Data=lambda: json.dumps({"partition": self.partition})))
+        self.assertEqual(status.status.name, "success")
+        self.assertEqual(self.orchestrator.turnCoalescer.take("c")["message"], "Hello")
+
+    def test_ownership_is_checked_again_when_a_queued_turn_runs(self):
+        coalescer = self.orchestrator.turnCoalescer
+        coalescer.offer("c", {"name": "God", "message": "Hello", "conversation_id": "c"}, lambda: True)
+        # The partition moves while the turn waits on the pacer
+        self.leaseTo("there")
+        self.orchestrator.takePendingTurn("c")
+        self.assertEqual((len(self.generated), len(self.notices)), (0, 1))
+
+        coalescer.offer("c", {"name": "God", "message": "Again", "conversation_id": "c"}, lambda: True)
+        self.leaseTo("here")
+        self.orchestrator.takePendingTurn("c")
+        self.assertEqual([data["message"] for data in self.generated], ["Again"])
+
+
+class CoalescedBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.hub = InMemoryDapr(delivery="inline")
+        # Debounced, so the merged turn stays pending on the (stopped) turn timer
+        self.orchestrator = loadOrchestrator(self.hub, CONVERSATION_DEBOUNCE_SECONDS="60")
+
+    def event(self, **fields):
+        return mock.Mock(Data=lambda: json.dumps(dict({"name": "God", "conversation_id": "c"}, **fields)))
+
+    def test_a_bootstrap_in_a_batch_replaces_a_numbered_turn(self):
+        self.orchestrator.startTurns([self.event(message="seven", turn=7), self.event(message="hello again")])
+        self.assertEqual(self.orchestrator.turnCoalescer.take("c")["message"], "hello again")
+
+    def test_a_late_redelivery_in_a_batch_keeps_the_newer_turn(self):
+        self.orchestrator.startTurns([self.event(message="seven", turn=7), self.event(message="two", turn=2)])
+        self.assertEqual(self.orchestrator.turnCoalescer.take("c")["message"], "seven")
+
+
+class BackpressureTest(unittest.TestCase):
+    def setUp(self):
+        self.hub = InMemoryDapr(delivery="inline")
+        self.orchestrator = loadOrchestrator(self.hub)
+        self.responses = []
+        self.hub.registerMethod("dialogue-generator", "generate", self.generate)
+
+    def generate(self, request):
+        status, body = self.responses.pop(0)
+        if status >= 400:
+            # What the sidecar's HTTP invoker raises for the generator's 429/503
+            raise DaprHttpError(DefaultJSONSerializer(), json.dumps(body).encode(), status)
+        return json.dumps(body)
+
+    def offerTurn(self, message="Hello"):
+        data = {"name": "God", "message": message, "conversation_id": "c"}
+        self.orchestrator.turnCoalescer.offer("c", data, lambda: True)
+        self.orchestrator.takePendingTurn("c")
+
+    def test_a_turn_turned_away_is_retried_after_retry_after(self):
+        orchestrator = self.orchestrator
+        self.responses = [(429, {"detail": "Generation queue is full", "retry_after": 7}), (200, {"data": "Hi"})]
+        self.offerTurn()
+        self.assertEqual(orchestrator.metrics.counters["turns_backpressured"], 1)
+        self.assertEqual(orchestrator.metrics.counters["turns_failed"], 0)
+        # Booked on the turn timer, with the conversation's turn pending again
+        (dueAt, _, job, args), = orchestrator.turnTimer.jobs
+        self.assertAlmostEqual(dueAt - orchestrator.turnTimer.clock(), 7, delta=1)
+        self.assertEqual((job, args), (orchestrator.takePendingTurn, ("c",)))
+
+        job(*args)
+        self.assertEqual((self.responses, orchestrator.metrics.counters["turns_failed"]), ([], 0))
+
+    def test_an_overloaded_generator_without_retry_after_gets_the_default_delay(self):
+        self.responses = [(503, {"detail": "Timed out waiting for a generation slot"})]
+        self.offerTurn()
+        ((dueAt, _, _, _),) = self.orchestrator.turnTimer.jobs
+        self.assertAlmostEqual(dueAt - self.orchestrator.turnTimer.clock(), 5, delta=1)
+
+    def test_an_agent_without_tea_makes_way_for_another(self):
+        orchestrator = self.orchestrator
+        orchestrator.agentRegistry.upsert({"id": "b", "name": "Bob", "description": "", "tea_amount_ml": 100})
+        speakers = []
+
+        def generate(request):
+            speakers.append(json.loads(request.data)["agent"]["id"])
+            return self.generate(request)
+
+        self.hub.registerMethod("dialogue-generator", "generate", generate)
+        self.responses = [(402, {"detail": "Agent has no tea left"}), (200, {"data": "Hi"})]
+        self.offerTurn()
+        self.assertEqual(len(set(speakers)), 2)
+        # The broke agent is no longer chosen, and the turn didn't fail
+        self.assertIsNone(orchestrator.agentRegistry.get(speakers[0]))
+        self.assertEqual(orchestrator.metrics.counters["turns_failed"], 0)
+        self.assertEqual(orchestrator.metrics.counters["agents_exhausted"], 1)
+
+    def test_other_errors_still_fail_the_turn(self):
+        self.responses = [(500, {"detail": "boom"})]
+        self.offerTurn()
+        self.assertEqual(self.orchestrator.metrics.counters["turns_failed"], 1)
+        self.assertEqual(len(self.orchestrator.turnTimer), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+import threading
+from contextlib import contextmanager
+
+import streamlit as st
+from dapr.clients import DaprClient
+
+
+class SharedDaprClient:
+    """A Dapr client kept alive for the lifetime of the Streamlit server.
+
+    Streamlit re-runs page scripts on every interaction; creating a client
+    there opens a new gRPC channel each time. This holder is cached with
+    `st.cache_resource`, so every session and rerun reuses one channel.
+    """
+
+    def __init__(self):
+        self.client = DaprClient()
+        self.lock = threading.Lock()
+        self.checkouts = 0
+
+    def metrics(self):
+        try:
+            self.client.get_metadata()
+            healthy = True
+        except Exception:
+            healthy = False
+        return {"size": 1, "checkouts": self.checkouts, "healthy": healthy}
+
+
+@st.cache_resource
+def getSharedDaprClient():
+    return SharedDaprClient()
+
+
+@contextmanager
+def sharedDaprClient():
+    """Lends the shared client; unlike `with DaprClient()` it is not closed on exit."""
+    shared = getSharedDaprClient()
+    with shared.lock:
+        shared.checkouts += 1
+    yield shared.client
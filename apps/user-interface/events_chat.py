@@ -0,0 +1,50 @@
+import json
+import os
+import uuid
+
+# Set the environment variables or use default values for publishing
+pubsubName = os.getenv('DAPR_PUBSUB_NAME', 'pubsub')
+topicName_agents = os.getenv('DAPR_AGENTS_TOPIC', 'agents')
+topicName_conversations = os.getenv('DAPR_CONV_TOPIC', 'conversations')
+stateStore = os.getenv('DAPR_STATE_STORE', 'statestore')
+conversationKey = "shared_events_chat"  # Use the agreed upon key for shared state
+
+# Dapr calls behind the events chat page, kept free of Streamlit so they can be driven without it
+
+def publishAgent(client, name, description, teaAmountMl):
+    """Publishes a new agent and returns it."""
+    agent = {
+        "id": str(uuid.uuid4()),
+        "name": name,
+        "description": description,
+        "tea_amount_ml": teaAmountMl
+    }
+    client.publish_event(pubsub_name=pubsubName, topic_name=topicName_agents, data=json.dumps(agent), data_content_type='application/json', publish_metadata={"partitionKey": agent["id"]})
+    return agent
+
+def publishBootstrappingMessage(client, message):
+    messageData = {"name": "God", "message": message}
+    client.publish_event(pubsub_name=pubsubName, topic_name=topicName_conversations, data=json.dumps(messageData), data_content_type='application/json', publish_metadata={"partitionKey": conversationKey})
+
+def fetchConversations(client, limit, key=conversationKey):
+    """Returns the latest `limit` messages, or None when the conversation doesn't exist yet."""
+    # The head holds the message count and segment size of the segmented log
+    head_response = client.get_state(store_name=stateStore, key=f"{key}:head")
+    if not head_response.data:
+        return None
+    head = json.loads(head_response.data)
+    count = head["count"]
+    segmentSize = head["segmentSize"]
+    if count == 0:
+        return []
+
+    # Only fetch the segments holding the latest `limit` messages; older ones may be compacted away
+    first = max(count - limit, head.get("base", 0))
+    keys = [f"{key}:segment:{i}" for i in range(first // segmentSize, (count - 1) // segmentSize + 1)]
+    items = client.get_bulk_state(store_name=stateStore, keys=keys).items
+    segments = {item.key: item.data for item in items}
+    conversations = []
+    for segmentKey in keys:
+        if segments.get(segmentKey):
+            conversations.extend(json.loads(segments[segmentKey]))
+    return conversations[first % segmentSize:]
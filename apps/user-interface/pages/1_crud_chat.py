@@ -3,7 +3,7 @@ import os
 import asyncio
 import streamlit as st
 from ollama import AsyncClient, ResponseError
-from dapr.clients import DaprClient
+from dapr_clients import sharedDaprClient
 from dapr.clients.grpc._state import StateItem
 
 st.title("Chat with Ollama")
@@ -16,13 +16,13 @@ stateStore = os.getenv('DAPR_STATE_STORE', 'statestore')
 
 def saveMessages(messages):
     """Save chat messages to the Dapr state store."""
-    with DaprClient() as daprClient:
+    with sharedDaprClient() as daprClient:
         state = StateItem(key="crud_chat", value=str(messages))
         daprClient.save_state(stateStore, key=state.key, value=state.value)
 
 def loadMessages():
     """Load chat messages from the Dapr state store."""
-    with DaprClient() as daprClient:
+    with sharedDaprClient() as daprClient:
         resp = daprClient.get_state(stateStore, "crud_chat")
         if resp and resp.data:
             storedData = resp.data
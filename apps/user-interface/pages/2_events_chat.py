@@ -1,57 +1,39 @@
 import streamlit as st
-import uuid
 import os
-import json
-from dapr.clients import DaprClient
+import events_chat
+from dapr_clients import getSharedDaprClient, sharedDaprClient
 
 st.title("Chat using Events")
 
-# Set the environment variables or use default values for publishing
-pubsubName = os.getenv('DAPR_PUBSUB_NAME', 'pubsub')
-topicName_agents = os.getenv('DAPR_AGENTS_TOPIC', 'agents')
-topicName_conversations = os.getenv('DAPR_CONV_TOPIC', 'conversations')
-stateStore = os.getenv('DAPR_STATE_STORE', 'statestore')
+displayLimit = int(os.getenv('CONVERSATION_DISPLAY_LIMIT', '50'))
 
 def publishAgent(name, description, teaAmountMl):
-    with DaprClient() as client:
-        agent = {
-            "id": str(uuid.uuid4()),
-            "name": name,
-            "description": description,
-            "tea_amount_ml": teaAmountMl
-        }
-        agentJson = json.dumps(agent)
+    with sharedDaprClient() as client:
         try:
-            client.publish_event(pubsub_name=pubsubName, topic_name=topicName_agents, data=agentJson, data_content_type='application/json')
-            st.success(f"Successfully published agent {name} with ID {agent['id']} to topic {topicName_agents} using {pubsubName} connection")
+            agent = events_chat.publishAgent(client, name, description, teaAmountMl)
+            st.success(f"Successfully published agent {name} with ID {agent['id']} to topic {events_chat.topicName_agents} using {events_chat.pubsubName} connection")
         except ValueError as e:
             st.error(f"Publishing agent failed with error: {e}")
 
 def publishBootstrappingMessage(message):
-    with DaprClient() as client:
-        messageData = {"name": "God", "message": message}
-        messageJson = json.dumps(messageData)
+    with sharedDaprClient() as client:
         try:
-            client.publish_event(pubsub_name=pubsubName, topic_name=topicName_conversations, data=messageJson, data_content_type='application/json')
+            events_chat.publishBootstrappingMessage(client, message)
             st.success("Chat started successfully.")
         except ValueError as e:
             st.error("Failed to start chat: " + str(e))
 
-def fetchConversations():
-    client = DaprClient()
-    key = "shared_events_chat"  # Use the agreed upon key for shared state
-    try:
-        # Fetch the state using the specific key
-        state_response = client.get_state(store_name=stateStore, key=key)
-        if state_response.data:
-            conversations = json.loads(state_response.data)
+def fetchConversations(limit):
+    with sharedDaprClient() as client:
+        try:
+            conversations = events_chat.fetchConversations(client, limit)
+            if conversations is None:
+                st.warning("No conversation data available. Check state store configuration and data key.")
+                return []
             return conversations
-        else:
-            st.warning("No conversation data available. Check state store configuration and data key.")
+        except Exception as e:
+            st.error(f"Failed to fetch conversation data: {e}")
             return []
-    except Exception as e:
-        st.error(f"Failed to fetch conversation data: {e}")
-        return []
 
 def display_conversations(conversations):
     if conversations:
@@ -77,5 +59,8 @@ if st.sidebar.button("Start Chat"):
     publishBootstrappingMessage(bootstrapMessage)
 
 if st.sidebar.button("Load Latest Messages"):
-    conversations = fetchConversations()
-    display_conversations(conversations)
\ No newline at end of file
+    conversations = fetchConversations(displayLimit)
+    display_conversations(conversations)
+
+with st.sidebar.expander("Dapr client"):
+    st.json(getSharedDaprClient().metrics())